@@ -0,0 +1,68 @@
+"""
+Benchmark of MemoryStore's compressed-at-rest mode: memory held by idle sessions, materialised versus packed,
+and the latency of get_store on a materialised session versus re-inflating a packed one.
+
+MemoryStore の圧縮保持モードのベンチマーク。
+アクセスのないセッションが保持するメモリ(実体化したまま/圧縮後)と、
+実体化済のセッションと圧縮したセッションを展開するときの get_store の所要時間を比べる
+
+python -m benchmarks.bench_memory_store_compression [number of sessions]
+"""
+import sys
+import time
+import tracemalloc
+
+from fastsession import MemoryStore
+
+
+def make_session(i):
+    # ログイン済のユーザーの典型的なセッション
+    return {
+        "user_id": f"user-{i}",
+        "user_name": f"User Name {i}",
+        "roles": ["member", "reader"],
+        "locale": "ja-JP",
+        "csrf_token": f"{i:032x}",
+        "cart": [{"item_id": f"item-{i % 50}-{n}", "quantity": 1 + n % 3, "price": 1200} for n in range(5)],
+        "recently_viewed": [f"item-{(i + n) % 500}" for n in range(20)],
+        "__cause__": "success",
+    }
+
+
+def measure_get_store(store, session_ids):
+    started = time.perf_counter()
+    for session_id in session_ids:
+        store.get_store(session_id)
+    return (time.perf_counter() - started) / len(session_ids)
+
+
+def main(count):
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    store = MemoryStore(compress_idle_after=0, compaction_interval=None)
+    session_ids = [f"session-{i}" for i in range(count)]
+    for i, session_id in enumerate(session_ids):
+        store.create_store(session_id).update(make_session(i))
+
+    materialised = tracemalloc.get_traced_memory()[0] - baseline
+    materialised_latency = measure_get_store(store, session_ids)
+
+    started = time.perf_counter()
+    store.compact_idle_sessions()
+    compaction_seconds = time.perf_counter() - started
+    packed = tracemalloc.get_traced_memory()[0] - baseline
+
+    inflate_latency = measure_get_store(store, session_ids)
+    tracemalloc.stop()
+
+    print(f"sessions:                       {count}")
+    print(f"memory, materialised:           {materialised / count:8.0f} bytes/session")
+    print(f"memory, packed:                 {packed / count:8.0f} bytes/session ({materialised / packed:.1f}x smaller)")
+    print(f"compaction pass:                {compaction_seconds * 1e6 / count:8.1f} us/session")
+    print(f"get_store, materialised:        {materialised_latency * 1e6:8.2f} us")
+    print(f"get_store, re-inflating packed: {inflate_latency * 1e6:8.2f} us")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1,3 +1,11 @@
 from .fast_session_middleware import FastSessionMiddleware
 from .memory_store import MemoryStore
+from .hash_memory_store import HashMemoryStore
+from .sharded_store import ShardedStore
+from .session_client_store import SessionClientStore
 from .timed_signature_serializer import TimedSignatureSerializer
+from .session_creation_limiter import SessionCreationLimiter
+from .session_quota import SessionQuotaExceeded
+from .store_guard import CircuitBreaker, StoreOverloaded, StoreUnavailable
+from .session_policy import SessionPolicy, session_policy
+from .gc_coordinator import FileLease, GCCoordinator, StoreLease
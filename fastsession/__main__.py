@@ -0,0 +1,68 @@
+import argparse
+import sys
+
+from .session_export import export_sessions, import_sessions, load_store
+
+
+def main(argv=None):
+    """
+    Command line interface to export and import sessions as NDJSON.
+
+    セッションをNDJSONとしてエクスポート・インポートするコマンドラインインターフェイス
+
+    python -m fastsession export myapp.sessions:store -o sessions.ndjson
+    python -m fastsession import myapp.sessions:store -i sessions.ndjson
+
+    The store is imported in this new process, so it must reach sessions kept outside of it
+    (e.g. SessionClientStore). A process-local store such as MemoryStore would be a fresh, empty instance
+    and is refused unless --allow-process-local is given (for calling main() inside the process holding the sessions).
+
+    ストアはこの新しいプロセスで読み込むので、プロセスの外にあるセッションに届くストア(SessionClientStore など)が必要。
+    MemoryStore のようなプロセス内のストアは新しい空のインスタンスになるため、
+    --allow-process-local を指定しない限り断る(セッションを持つプロセスの中で main() を呼ぶ場合に指定する)
+    """
+    parser = argparse.ArgumentParser(prog="python -m fastsession")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="export sessions as NDJSON")
+    export_parser.add_argument("store", help="store to export from, as 'module:attribute'")
+    export_parser.add_argument("-o", "--output", default="-", help="output file (default: stdout)")
+    export_parser.add_argument("--chunk-size", type=int, default=1000)
+    export_parser.add_argument("--allow-process-local", action="store_true",
+                               help="accept a process-local store such as MemoryStore")
+
+    import_parser = subparsers.add_parser("import", help="import sessions from NDJSON")
+    import_parser.add_argument("store", help="store to import into, as 'module:attribute'")
+    import_parser.add_argument("-i", "--input", default="-", help="input file (default: stdin)")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    import_parser.add_argument("--allow-process-local", action="store_true",
+                               help="accept a process-local store such as MemoryStore")
+
+    args = parser.parse_args(argv)
+    store = load_store(args.store)
+    if getattr(store, "process_local", False) and not args.allow_process_local:
+        # 新しいプロセスで読み込んだプロセス内のストアは空なので、何もエクスポート(インポート)しないまま成功してしまう
+        parser.error(f"'{args.store}' is a process-local store ({type(store).__name__}) and holds no sessions "
+                     f"of other processes; use a shared store such as SessionClientStore, "
+                     f"or pass --allow-process-local when calling main() inside the process holding the sessions")
+
+    if args.command == "export":
+        if args.output == "-":
+            count = export_sessions(store, sys.stdout, chunk_size=args.chunk_size)
+        else:
+            with open(args.output, "w", encoding="utf-8") as fp:
+                count = export_sessions(store, fp, chunk_size=args.chunk_size)
+        print(f"exported {count} sessions", file=sys.stderr)
+    else:
+        if args.input == "-":
+            count = import_sessions(store, sys.stdin, batch_size=args.batch_size)
+        else:
+            with open(args.input, "r", encoding="utf-8") as fp:
+                count = import_sessions(store, fp, batch_size=args.batch_size)
+        print(f"imported {count} sessions", file=sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
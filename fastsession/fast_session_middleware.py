@@ -1,19 +1,36 @@
+import asyncio
+import copy
+import os
+import random
+import time
 import uuid
+from collections import OrderedDict
 from http.cookies import SimpleCookie
+from types import MappingProxyType
 
 from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
-from starlette.requests import Request
-from starlette.responses import Response
+from starlette.requests import HTTPConnection, Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.types import Receive, Scope, Send
 
 from .memory_store import MemoryStore
+from .offload import Offloader
+from .session_policy import NONE, READ_ONLY, READ_WRITE, match_route_policy, resolve_route_policies
+from .session_conflict import check_conflict_policy, resolve_conflict
+from .single_flight import SingleFlight
+from .store_guard import StoreGuard, StoreUnavailable
 from .timed_signature_serializer import TimedSignatureSerializer
 
 
 class FastSession:
-    def __init__(self, store, session_id, session_save):
+    def __init__(self, store, session_id, session_save, read_only=False, auto_save=False):
         self.session_store = store
         self.session_id = session_id
         self.session_save = session_save
+        self.read_only = read_only  # True の場合、セッションへの変更は保存されない
+        self.auto_save = auto_save  # True の場合、レスポンス時に session_save が呼ばれる
+        self.checked_out = False  # True の場合、リクエストや接続の終了時にストアの release が呼ばれる
+        self.pending_cause = None  # WebSocket のハンドシェイクが受け付けられるまで生成を保留しているセッションの生成理由
 
     def get_session(self):
         return self.session_store
@@ -36,8 +53,14 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
 
     # FastAPIのユーザーセッションを管理するためのミドルウェア。
 
+    # インラインセッションのデータを格納する、署名対象辞書のキー
+    INLINE_DATA_KEY = "__inline__"
+
+    # 再生成したセッションを覚えておく件数の上限
+    RECREATED_SESSIONS_MAX = 10000
+
     def __init__(self, app,
-                 secret_key,  # クッキー署名用のキー
+                 secret_key,  # クッキー署名用のキー。鍵のリスト(新しい順)を指定すると鍵のローテーションができる
                  store=MemoryStore(),  # セッション保存用ストア
                  http_only=True,  # True: CookieがJavaScriptなどのクライアントサイドのスクリプトからアクセス不可となる
                  secure=True,  # True: Https が必要
@@ -46,6 +69,22 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
                  session_cookie="sid",  # セッションクッキーの名前
                  session_object="session",  # request.state以下にぶるさげるSessionオブジェクトの属性名
                  skip_session_header=None,
+                 resign_probability=0.1,  # 旧い鍵で署名されたクッキーをリクエストごとに新しい鍵で再署名する確率
+                 session_creation_limiter=None,  # SessionCreationLimiter を指定すると新規セッションの生成頻度を制限する
+                 store_timeout=None,  # ストアの呼び出しごとのタイムアウト(秒)。指定するとストアはワーカースレッドで呼び出す
+                 store_max_concurrency=None,  # ストアの同時呼び出し数の上限
+                 circuit_breaker=None,  # CircuitBreaker を指定すると連続した失敗で回路を開き、縮退モードにする
+                 degraded_mode="transient",  # ストアが使えないときの動作 "read_only", "transient", "fail_fast"
+                 coalesce_store_calls=True,  # 同じセッションIDの同時取得・再生成をまとめてストアの呼び出しを1回にする
+                 recreated_session_ttl=5,  # 再生成したセッションを、同じクッキーを持つ後続のリクエストと共有する秒数
+                 offload_threshold=None,  # 指定すると、このバイト数以上のペイロードを扱うストアの呼び出しをワーカースレッドで実行する
+                 offload_max_workers=4,  # オフロード用のワーカースレッド数
+                 snapshot_path=None,  # 指定するとASGIのlifespanの起動時にストアを復元し、終了時にワーカーごと(snapshot_path.<pid>)にスナップショットを書き出す
+                 inline_session_max_bytes=0,  # 0より大きい場合、署名済クッキーがこのバイト数以下に収まるセッションはストアを使わずクッキーに格納する(署名のみで暗号化はされない)
+                 conflict_policy=None,  # 指定するとバージョン付きで保存し、他のリクエストと競合したときに "merge", "overwrite", "discard" または関数(base, mine, theirs)で解決する
+                 conflict_max_retries=3,  # 競合を解決して保存し直す回数の上限
+                 gc_coordinator=None,  # GCCoordinator を指定すると、ストアの gc の代わりにリースを持つワーカーだけが少しずつ掃除する
+                 websocket_allowed_origins=None,  # WebSocket のハンドシェイクを受け付ける Origin ("https://example.com" など、"*" は全て)のリスト。指定すると他のオリジンからの接続を拒否する
                  logger=None):
 
         super().__init__(app)
@@ -58,8 +97,46 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
         self.secret_key = secret_key
         self.session_cookie_name = session_cookie
         self.session_store = store
+        self.gc_coordinator = gc_coordinator
+        self.store_gc = gc_coordinator.gc if gc_coordinator is not None else store.gc  # 新規セッション生成時に呼ぶ掃除
         self.serializer = TimedSignatureSerializer(self.secret_key, expired_in=self.max_age)
         self.session_object = session_object
+        self.resign_probability = resign_probability
+        self.inline_session_max_bytes = inline_session_max_bytes
+        self.session_creation_limiter = session_creation_limiter
+        self.snapshot_path = snapshot_path
+        self.snapshot_restored_at = None  # 起動時にスナップショットを復元した時刻
+        self.degraded_mode = degraded_mode
+        self.offloader = Offloader(offload_threshold, offload_max_workers) if offload_threshold is not None else None
+        self.single_flight = SingleFlight() if coalesce_store_calls else None
+        self.recreated_session_ttl = recreated_session_ttl
+        self.recreated_sessions = OrderedDict()  # 旧セッションID(または期限切れのトークン) -> (再生成したセッションID, 共有する期限)
+        self.route_policies = None  # (ルート, セッションの扱い) のリスト。lifespan の起動時に解決する
+        self.store_guard = None
+        if store_timeout is not None or store_max_concurrency is not None or circuit_breaker is not None:
+            self.store_guard = StoreGuard(timeout=store_timeout, max_concurrency=store_max_concurrency,
+                                          circuit_breaker=circuit_breaker)
+
+        # クロスサイト WebSocket ハイジャック対策。ブラウザはクッキーを付けて他サイトからも接続するので Origin で拒否する
+        self.websocket_allowed_origins = None
+        if websocket_allowed_origins is not None:
+            self.websocket_allowed_origins = {origin.lower().rstrip("/") for origin in websocket_allowed_origins}
+
+        self.conflict_policy = conflict_policy
+        self.conflict_max_retries = conflict_max_retries
+        self.conflict_stats = {
+            "saved": 0,  # バージョンを比較して保存した回数
+            "conflicts": 0,  # 他のリクエストの保存と競合した回数
+            "discarded": 0,  # 競合によりこのリクエストの変更を捨てた回数
+            "gave_up": 0,  # 再試行の上限まで競合が続き保存できなかった回数
+        }
+        if conflict_policy is not None:
+            check_conflict_policy(conflict_policy)
+            if not hasattr(store, "save_store_if_version"):
+                raise ValueError(f"conflict_policy requires a store supporting get_store_versioned and save_store_if_version, got {store}")
+
+        if degraded_mode not in ("read_only", "transient", "fail_fast"):
+            raise ValueError(f"degraded_mode must be 'read_only', 'transient' or 'fail_fast', got '{degraded_mode}'")
         self.logger = logger
 
         if self.logger is None:
@@ -74,24 +151,271 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
 
             self.logger = ConsoleLogger()
 
+        if hasattr(store, "set_default_logger"):
+            # ストアの警告(セッションの上限超過など)もミドルウェアのロガーに出す
+            store.set_default_logger(self.logger)
+
         self.logger.debug(
             f"FastSession initialized http_only:{http_only} secure:{secure} session_key:'{session_object}' session_cookie_name:{session_cookie} store:{store}")
 
-    def create_session_cookie(self, session_id):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self.handle_lifespan(scope, receive, send)
+            return
+
+        if scope["type"] == "websocket":
+            await self.handle_websocket(scope, receive, send)
+            return
+
+        await super().__call__(scope, receive, send)
+
+    async def handle_websocket(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Load the session once at the WebSocket handshake and set it to websocket.state, so messages are handled
+        without fetching the session again. A new or re-signed cookie is sent with the handshake response.
+        A session that has to be created is only created in the store once the handshake is accepted,
+        so rejected handshakes leave nothing behind.
+        The handler may save the session explicitly, otherwise it is saved when the connection ends.
+        Inline sessions are not saved after the handshake, as the cookie can no longer be updated.
+        With websocket_allowed_origins set, handshakes from other origins are rejected.
+        """
+        connection = HTTPConnection(scope)
+
+        if not self.is_allowed_websocket_origin(connection):
+            # 他サイトのページからの接続 => ハンドシェイクを拒否する(403)
+            self.logger.info(f"Reject WebSocket handshake from origin:'{connection.headers.get('origin')}'")
+            await send({"type": "websocket.close", "code": 1008})
+            return
+
+        if self.should_skip_session_management_by_checking_header(connection):
+            self.logger.debug(f"Skip session management.")
+            await self.app(scope, receive, send)
+            return
+
+        policy = self.get_request_policy(connection)
+        if policy == NONE:
+            await self.app(scope, receive, send)
+            return
+
+        cookie, inline_session = None, None
+        try:
+            if policy == READ_ONLY:
+                await self.load_session_read_only(connection)
+            else:
+                cookie, inline_session = await self.load_session(connection)
+        except StoreUnavailable as e:
+            self.logger.info(f"Session store unavailable. degraded_mode:{self.degraded_mode} err:{e}")
+            self.store_guard.record_degraded(self.degraded_mode)
+            if self.degraded_mode == "fail_fast" and policy != READ_ONLY:
+                # ハンドシェイクを拒否する(1013: Try Again Later)
+                await send({"type": "websocket.close", "code": 1013})
+                return
+
+            self.create_transient_session(connection, str(uuid.uuid4()), cause="store_unavailable")
+
+        fast_session = getattr(connection.state, self.session_object)
+        if inline_session is not None:
+            # ハンドシェイク後はクッキーを更新できない => インラインセッションはハンドシェイク時点の内容でクッキーに格納する
+            fast_session.read_only = True
+
+        async def send_wrapper(message):
+            if message["type"] == "websocket.accept":
+                set_cookie = cookie
+                if fast_session.pending_cause is not None:
+                    # ハンドシェイクが受け付けられた => 保留していたセッションをストアに生成する
+                    try:
+                        set_cookie = await self.create_pending_session(connection)
+                    except StoreUnavailable as e:
+                        self.logger.info(f"Session store unavailable. degraded_mode:{self.degraded_mode} err:{e}")
+                        self.store_guard.record_degraded(self.degraded_mode)
+                        if self.degraded_mode == "fail_fast":
+                            await send({"type": "websocket.close", "code": 1013})
+                            return
+                        self.create_transient_session(connection, str(uuid.uuid4()), cause="store_unavailable")
+                        self.adopt_pending_session(connection, fast_session)
+                if inline_session is not None:
+                    set_cookie = await self.commit_inline_session(inline_session)
+                if set_cookie is not None:
+                    # ハンドシェイクのレスポンスヘッダでクッキーをセットする
+                    headers = list(message.get("headers") or [])
+                    headers.append((b"set-cookie", set_cookie.output(header="").strip().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # 接続の終了時にセッションを保存する
+            try:
+                await self.save_session_at_close(connection)
+            except StoreUnavailable as e:
+                self.logger.info(f"Session store unavailable. Session changes are not saved. err:{e}")
+            finally:
+                self.release_session(connection)
+
+    def is_allowed_websocket_origin(self, connection):
+        """
+        Check the Origin of a WebSocket handshake against websocket_allowed_origins.
+        Handshakes without an Origin are only allowed with "*", as browsers always send it.
+        """
+        if self.websocket_allowed_origins is None or "*" in self.websocket_allowed_origins:
+            return True
+        origin = connection.headers.get("origin")
+        return origin is not None and origin.lower().rstrip("/") in self.websocket_allowed_origins
+
+    def should_defer_session_creation(self, request):
+        # WebSocket のセッションは、ハンドシェイクが拒否されても残らないよう受け付けられてから生成する
+        return request.scope["type"] == "websocket"
+
+    def defer_session_creation(self, request, cause=None):
+        """
+        Give a WebSocket connection whose session has to be created a placeholder session until the handshake
+        is accepted. Data the handler writes to it before then is carried over (see create_pending_session).
+        """
+        session_store = {}
+        if cause is not None:
+            session_store["__cause__"] = cause
+        fast_session = FastSession(store=session_store, session_id=None, session_save=lambda: None)
+        fast_session.pending_cause = cause or "new"
+        self.logger.debug(f"Session creation deferred until the WebSocket handshake is accepted.")
+        setattr(request.state, self.session_object, fast_session)
+
+    async def create_pending_session(self, connection):
+        """
+        Create the session deferred by defer_session_creation, once the WebSocket handshake is accepted.
+        :return: cookie to set (or None for a transient session)
+        """
+        pending = getattr(connection.state, self.session_object)
+        allocated = await self.allocate_session(connection, cause=pending.pending_cause)
+        if allocated is not None:
+            session_id, session_store, version = allocated
+            self.attach_session(connection, session_id, session_store, version=version)
+        self.adopt_pending_session(connection, pending)
+        return self.create_session_cookie(allocated[0]) if allocated is not None else None
+
+    def adopt_pending_session(self, connection, pending):
+        """
+        Move the session just set to the connection into the placeholder FastSession object, which the handler
+        may already hold, carrying over the data written to the placeholder before the handshake was accepted.
+        """
+        fast_session = getattr(connection.state, self.session_object)
+        fast_session.session_store.update(pending.session_store)
+        pending.__dict__.update(fast_session.__dict__)  # pending_cause も None になる
+        setattr(connection.state, self.session_object, pending)
+
+    async def save_session_at_close(self, connection):
+        """
+        Save the session of a WebSocket connection when the connection ends.
+        """
+        fast_session = getattr(connection.state, self.session_object, None)
+        if fast_session is None or fast_session.read_only:
+            return
+
+        if fast_session.auto_save or hasattr(fast_session.session_store, "flush"):
+            await self.flush_session(connection)
+        else:
+            await self.call_store(fast_session.session_save)
+
+    async def handle_lifespan(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Pass the lifespan protocol through to the app, resolving the session policies of the routes
+        and restoring the store from the snapshot at startup, and writing the snapshot once the app has shut down.
+        """
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.resolve_route_policies(scope.get("app"))
+                if self.snapshot_path is not None:
+                    self.restore_snapshot()
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "lifespan.shutdown.complete" and self.snapshot_path is not None:
+                self.write_snapshot()
+            await send(message)
+
+        await self.app(scope, receive_wrapper, send_wrapper)
+
+    def restore_snapshot(self):
+        """
+        Restore the store from the snapshot files of every worker, merging them.
+        Each worker process writes its own file (see write_snapshot), newer files take precedence.
+        """
+        self.snapshot_restored_at = time.time()
+        if not hasattr(self.session_store, "restore"):
+            return
+
+        for path in self.snapshot_files():
+            # 既にストアにあるセッションは残るので、新しいファイルから順に復元すると新しい内容が優先される
+            count = self.session_store.restore(path)
+            self.logger.info(f"Restored {count} sessions from snapshot '{path}'")
+
+    def write_snapshot(self):
+        """
+        Write the store to snapshot_path suffixed with the process ID, so that several worker processes
+        sharing one snapshot_path do not overwrite each other's snapshot.
+        Files written before this worker restored them at startup are removed, their sessions being merged
+        into this worker's file.
+        """
+        if not hasattr(self.session_store, "snapshot"):
+            return
+
+        path = f"{self.snapshot_path}.{os.getpid()}"
+        result = self.session_store.snapshot(path)
+        self.logger.info(f"Wrote snapshot '{path}' written:{result['written']} skipped:{result['skipped']}")
+
+        if self.snapshot_restored_at is None:
+            return  # 起動時に復元していない => 他のファイルのセッションを引き継いでいない
+        for stale_path in self.snapshot_files():
+            # 起動時に復元したファイル(以前の実行のワーカーのもの)。同時に動いている他のワーカーのファイルは残す
+            if stale_path != path and os.path.getmtime(stale_path) < self.snapshot_restored_at:
+                os.remove(stale_path)
+
+    def snapshot_files(self):
+        """
+        :return: Paths of the snapshot files of every worker, snapshot_path.<pid> (and snapshot_path itself,
+                 written by a single process), newest first
+        """
+        directory, name = os.path.split(os.path.abspath(self.snapshot_path))
+        if not os.path.isdir(directory):
+            return []
+        paths = [os.path.join(directory, entry) for entry in os.listdir(directory)
+                 if entry == name or (entry.startswith(f"{name}.") and entry[len(name) + 1:].isdigit())]
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def create_session_cookie(self, session_id, timestamp=None):
         """
         Create and sign a session cookie.
+        If timestamp is given, the cookie is signed with it (used when re-signing to keep the original expiry).
         """
 
         # セッションID に署名してクッキーオブジェクトに保存する
+        signed_session_id = self.sign_session_id(session_id, timestamp=timestamp)
+        return self.create_cookie(session_id, signed_session_id)
+
+    def sign_session_id(self, session_id, timestamp=None, inline_data=None):
+        """
+        Sign the session ID (and, for inline sessions, the session data) into a token.
+        """
 
         # たとえば、セッションクッキーの名前が "session" とするとき、
         # 　{"session":セッションID} な　「セッションID入り辞書オブジェクト」 を作り、
         # その　セッションID入り辞書オブジェクトに対して署名を行う
         session_id_dict_obj = {self.session_cookie_name: session_id}
 
+        if inline_data is not None:
+            # インラインセッションの場合はセッションデータもクッキーに入れて署名する
+            session_id_dict_obj[self.INLINE_DATA_KEY] = inline_data
+
         # 「セッションID入り辞書オブジェクト」 に署名をしたものは「署名済セッションID文字列」と呼ぶこととする。
         # 辞書オブジェクトがシリアライズされてるので「署名済セッションID入り辞書オブジェクト」ではなく「署名済セッションID文字列」とする。
-        signed_session_id = self.serializer.encode(session_id_dict_obj)  # ser.dumps({'session_id': session_id})
+        return self.serializer.encode(session_id_dict_obj, timestamp=timestamp)  # ser.dumps({'session_id': session_id})
+
+    def create_cookie(self, session_id, signed_session_id):
+        """
+        Create a session cookie object holding the signed session ID string.
+        """
 
         cookie = SimpleCookie()
 
@@ -158,6 +482,13 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
         self.logger.debug(f"Use skip_header option. skip_headers:{header_names} not matched in request headers.")
         return False
 
+    def should_resign_cookie(self) -> bool:
+        """
+        旧い鍵で署名されたクッキーを今回のリクエストで再署名するか否かを返す
+        :return:
+        """
+        return random.random() < self.resign_probability
+
     async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
         """
         Dispatch the request, handling session management.
@@ -170,12 +501,128 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
             response = await call_next(request)
             return response
 
+        policy = self.get_request_policy(request)
+        if policy == NONE:
+            # セッションを扱わないルート
+            # => クッキーの検証もストアへのアクセスもしない
+            return await call_next(request)
+
+        if policy == READ_ONLY:
+            # 既存のセッションを読むだけのルート
+            # => セッションの生成・書き戻し・クッキーの更新をしない
+            try:
+                await self.load_session_read_only(request)
+            except StoreUnavailable as e:
+                self.logger.info(f"Session store unavailable. Serve transient session read-only. err:{e}")
+                self.create_transient_session(request, str(uuid.uuid4()), cause="store_unavailable")
+            return await call_next(request)
+
+        try:
+            cookie, inline_session = await self.load_session(request)
+        except StoreUnavailable as e:
+            # セッションストアが利用できない
+            # => 縮退モードに応じて 503 を返すか、永続化されない一時的なセッションで処理を続ける
+            self.logger.info(f"Session store unavailable. degraded_mode:{self.degraded_mode} err:{e}")
+            self.store_guard.record_degraded(self.degraded_mode)
+            if self.degraded_mode == "fail_fast":
+                return PlainTextResponse("Session store unavailable", status_code=503)
+
+            self.create_transient_session(request, str(uuid.uuid4()), cause="store_unavailable")
+            cookie, inline_session = None, None
+
+        try:
+            response = await call_next(request)
+
+            # ここから response 側の処理
+            try:
+                await self.flush_session(request)
+
+                if inline_session is not None:
+                    # インラインセッションは、レスポンス時点のセッションデータの大きさに応じてクッキーに格納するかストアに移す
+                    cookie = await self.commit_inline_session(inline_session)
+            except StoreUnavailable as e:
+                # 書き戻しに失敗してもレスポンスは返す
+                self.logger.info(f"Session store unavailable. Session changes are not saved. err:{e}")
+        finally:
+            self.release_session(request)
+
+        if cookie is not None:
+            # - セットすべきクッキーがあるとき
+            # => session_id をエンコードしたクッキーをセットする
+
+            cookie_val = cookie.output(header="").strip()
+            self.logger.info(f"Set response header 'Set-Cookie' to signed cookie value")
+            response.headers["Set-Cookie"] = cookie_val  # レスポンスヘッダにセッションID署名済データが入ったクッキーをセットし、クライアント側に反映する
+
+        return response
+
+    def get_request_policy(self, request):
+        """
+        :return: Session policy ("none", "read_only" or "read_write") of the route the request is routed to
+        """
+        if self.route_policies is None:
+            # lifespan を送らないサーバー(や lifespan を起動しないテストクライアント)では最初のリクエストで解決する
+            self.resolve_route_policies(request.scope.get("app"))
+
+        if not self.route_policies:
+            return READ_WRITE
+        return match_route_policy(self.route_policies, request.scope)
+
+    def resolve_route_policies(self, app):
+        """
+        Resolve the session policies declared on the routes of the app, including mounted routers, once.
+
+        アプリのルート(マウントしたルーターを含む)で宣言されたセッションの扱いを一度だけ解決する
+        """
+        self.route_policies = resolve_route_policies(getattr(app, "routes", None) or ())
+
+    async def load_session_read_only(self, request):
+        """
+        Load the existing session for the request as a read-only mapping.
+        If there is no valid session, a transient session is used instead and no session is created.
+        """
+        signed_session_id = request.cookies.get(self.session_cookie_name)
+        decoded_dict = None
+        if signed_session_id is not None:
+            decoded_dict, _ = self.serializer.decode(signed_session_id)
+
+        session_store = None
+        if decoded_dict is not None:
+            session_id = decoded_dict.get(self.session_cookie_name)
+            if self.INLINE_DATA_KEY in decoded_dict:
+                session_store = decoded_dict[self.INLINE_DATA_KEY]
+            else:
+                session_store = await self.fetch_session_store(session_id)
+
+        if session_store is None:
+            # 有効なセッションが無い
+            # => セッションは生成せず、このリクエストだけの一時的なセッションを使う
+            self.logger.info(f"No valid session for read-only route. Use transient session.")
+            self.create_transient_session(request, str(uuid.uuid4()), cause="read_only")
+            return
+
+        setattr(request.state,
+                self.session_object,
+                FastSession(
+                    store=MappingProxyType(session_store),  # 誤って書き換えないよう読み取り専用のビューを渡す
+                    session_id=session_id,
+                    session_save=lambda: None,
+                    read_only=True)
+                )
+
+    async def load_session(self, request):
+        """
+        Load (or create) the session for the request and set the session manager to request.state.
+        :return: cookie to set (or None) and inline session state (or None)
+        """
+
         # リクエストをディスパッチし、セッション管理を行う。
         # クライアントからのリクエストに含まれるクッキーから
         # 「署名済セッションID文字列」を取得する
         signed_session_id = request.cookies.get(self.session_cookie_name)
 
         cookie = None
+        inline_session = None  # インラインセッション(クッキー内にデータを持つセッション)の場合に状態を保持する
 
         if signed_session_id is None:
             # セッションクッキーが無い完全新規アクセス
@@ -184,13 +631,13 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
 
             # セッションID に署名してクッキーオブジェクトに保存する。
             # また request.state 以下にセッションマネージャをぶるさげてセッションの入出力ができるようにする
-            cookie = await self.create_new_session_id_and_store(request, cause="new")
+            cookie, inline_session = await self.create_new_session(request, cause="new")
 
         else:
             # セッションクッキーがある状態でアクセス
 
             # 「署名済セッションID文字列」をデコードして「セッションID入り辞書オブジェクト」を得る
-            decoded_dict, err = self.serializer.decode(signed_session_id)
+            decoded_dict, err, key_info = self.serializer.decode_with_info(signed_session_id)
 
             if decoded_dict is not None:
 
@@ -198,9 +645,21 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
                 self.logger.debug(f"Cookie signature validation success")
                 # 「セッションID入り辞書オブジェクト」から セッションID を取得する
                 session_id = decoded_dict.get(self.session_cookie_name)
-                session_store = self.session_store.get_store(session_id)
 
-                if session_store is None:
+                session_store = None
+                version = None
+                if self.INLINE_DATA_KEY not in decoded_dict:
+                    # 読み取り専用の縮退モードでは、回路が開いていても読み出しは試みる
+                    session_store, version = await self.fetch_session_store_for_update(session_id)
+
+                if self.INLINE_DATA_KEY in decoded_dict:
+                    # クッキー内にセッションデータを持つインラインセッション
+                    # => ストアにはアクセスしない
+                    self.logger.info(f"[session_id:'{session_id}'] Inline session cookie available! set session_mgr to reqeust.state.{self.session_object}")
+                    inline_session = self.load_inline_session(request, session_id, decoded_dict[self.INLINE_DATA_KEY],
+                                                              signed_session_id, key_info["timestamp"])
+
+                elif session_store is None:
                     # 正しい署名のクッキーがあり、そこからデコードしたセッションIDも正常
                     # だがセッションIDにひもづいたセッションストアが正しく取得できなかった
                     # こうなる原因はサーバーを再起動しオンメモリのストアが消えたがユーザーの
@@ -208,7 +667,7 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
                     # => セッションIDを再生成し、ストアを再生成する
 
                     self.logger.info(f"[session_id:'{session_id}'] Session cookie available. But no store for this sessionId found. Maybe store had cleaned.")
-                    cookie = await self.create_new_session_id_and_store(request, cause="valid_cookie_but_no_store")
+                    cookie, inline_session = await self.recreate_session(request, session_id)
 
                 else:
 
@@ -217,15 +676,25 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
                     self.logger.info(
                         f"[session_id:'{session_id}'] Session cookie and Store is available! set session_mgr to reqeust.state.{self.session_object}")
 
-                    setattr(request.state,
-                            self.session_object,
-                            FastSession(
-                                store=session_store,
-                                session_id=session_id,
-                                session_save=lambda: self.session_store.save_store(session_id))
-                            )
+                    read_only = self.store_guard is not None and self.store_guard.is_open()
+                    if read_only:
+                        # 回路が開いている間は読み取り専用とし、書き戻さない
+                        self.logger.info(f"[session_id:'{session_id}'] Session store is degraded. Serve session read-only.")
+                        self.store_guard.record_degraded("read_only")
+
+                    session_store = self.attach_session(request, session_id, session_store, version=version, read_only=read_only)
+
+                    if hasattr(session_store, "set_local"):
+                        # 遅延読み込みのセッションでは、読むだけのリクエストで書き戻しが発生しないようにする
+                        session_store.set_local("__cause__", "success")
+                    else:
+                        session_store["__cause__"] = "success"
 
-                    session_store["__cause__"] = "success"
+                    if not key_info["is_active_key"] and self.should_resign_cookie():
+                        # 旧い鍵で署名されたクッキーは新しい鍵で再署名する。
+                        # 全セッションが一斉に再署名されないよう確率的に分散させ、元の署名時刻(=有効期限)は保つ
+                        self.logger.info(f"[session_id:'{session_id}'] Re-sign session cookie signed with old key:{key_info['key_id']}")
+                        cookie = self.create_session_cookie(session_id, timestamp=key_info["timestamp"])
 
             else:
                 # クッキーの署名検証に失敗
@@ -237,49 +706,463 @@ class FastSessionMiddleware(BaseHTTPMiddleware):
 
                 if err == "SignatureExpired":
                     # セッションの有効期限が切れていた場合
-                    pass
+                    # => 期限切れを報告するのは署名の検証に成功したトークンだけなので、
+                    #    同じトークンを持つ同時のリクエストには1つの新しいセッションを共有させる
+                    cookie, inline_session = await self.recreate_session(request, ("expired", signed_session_id),
+                                                                         cause=f"renew after {err}")
+                else:
+                    cookie, inline_session = await self.create_new_session(request, cause=f"renew after {err}")
 
-                cookie = await self.create_new_session_id_and_store(request, cause=f"renew after {err}")
+        return cookie, inline_session
 
-        response = await call_next(request)
+    async def create_new_session(self, request, cause=None):
+        """
+        Create a new session. If inline sessions are enabled, the session starts in the cookie,
+        otherwise a new store is created.
+        :return: cookie to set (or None) and inline session state (or None)
+        """
+        if self.inline_session_max_bytes > 0:
+            inline_session = self.load_inline_session(request, str(uuid.uuid4()), {}, None, None)
+            if cause is not None:
+                inline_session["data"]["__cause__"] = cause  # セッションが新規生成された理由を格納
+            self.logger.debug(f"[session_id:'{inline_session['session_id']}'(NEW)] New inline session created.")
+            return None, inline_session
 
-        # ここから response 側の処理
-        if cookie is not None:
-            # - セットすべきクッキーがあるとき
-            # => session_id をエンコードしたクッキーをセットする
+        cookie = await self.create_new_session_id_and_store(request, cause=cause)
+        return cookie, None
 
-            cookie_val = cookie.output(header="").strip()
-            self.logger.info(f"Set response header 'Set-Cookie' to signed cookie value")
-            response.headers["Set-Cookie"] = cookie_val  # レスポンスヘッダにセッションID署名済データが入ったクッキーをセットし、クライアント側に反映する
+    def load_inline_session(self, request, session_id, data, signed_session_id, timestamp):
+        """
+        Set up a session whose data is carried in the cookie itself.
+        :return: inline session state used by commit_inline_session
+        """
+        if data.get("__cause__") is not None:
+            data["__cause__"] = "success"
 
-        return response
+        setattr(request.state,
+                self.session_object,
+                FastSession(
+                    store=data,
+                    session_id=session_id,
+                    session_save=lambda: None)  # クッキーはレスポンス時に更新されるので何もしない
+                )
+
+        return {"session_id": session_id, "data": data, "signed_session_id": signed_session_id, "timestamp": timestamp}
+
+    async def commit_inline_session(self, inline_session):
+        """
+        Write an inline session back at response time.
+        While the signed cookie fits in inline_session_max_bytes the data stays in the cookie,
+        once it grows past the threshold the session spills to the store, where it is indexed.
+        Until it spills, an inline session lives only in the cookie and cannot be found or revoked
+        with find_sessions / revoke_user.
+        If the spill fails (quota exceeded, store unavailable), the error is logged, the changes of the request
+        are dropped and the client keeps its current inline cookie.
+        :return: cookie to set, or None if the cookie has not changed
+        """
+        session_id = inline_session["session_id"]
+        data = inline_session["data"]
+        timestamp = inline_session["timestamp"]  # 元の署名時刻を保ち、有効期限が延びないようにする
+
+        try:
+            signed_session_id = self.sign_session_id(session_id, timestamp=timestamp, inline_data=data)
+        except (TypeError, ValueError):
+            # JSONにできない値を含むセッションはクッキーに格納できないのでストアに移す
+            signed_session_id = None
+
+        if signed_session_id is not None and len(signed_session_id) <= self.inline_session_max_bytes:
+            if signed_session_id == inline_session["signed_session_id"]:
+                # セッションデータに変更がないのでクッキーを送り直さない
+                return None
+
+            return self.create_cookie(session_id, signed_session_id)
+
+        self.logger.info(f"[session_id:'{session_id}'] Inline session grew past {self.inline_session_max_bytes} bytes. Spill to store.")
+        created = False
+        try:
+            session_store = await self.call_store(self.session_store.create_store, session_id)
+            created = True
+            session_store.update(data)
+            await self.call_store(self.save_session_store, session_id, session_store)
+            if getattr(self.session_store, "index_key", None) is not None:
+                # ストアに移したセッションは索引し、revoke_user などで見つけられるようにする
+                await self.call_store(self.session_store.update_index, session_id, session_store)
+        except Exception as e:  # SessionQuotaExceeded、StoreUnavailable、ストア自身のエラー
+            # ストアに移せなかった => このリクエストの変更は捨て、クライアントは今のインラインセッションのクッキーを使い続ける
+            self.logger.info(f"[session_id:'{session_id}'] Failed to spill inline session to store. Keep inline cookie. err:{e!r}")
+            if created:
+                await self.discard_spilled_store(session_id)
+            return None
+
+        await self.run_store_gc()
+        return self.create_session_cookie(session_id, timestamp=timestamp)
+
+    async def discard_spilled_store(self, session_id):
+        # 途中まで移したセッションを残さない(削除もできなければ期限切れで消える)
+        try:
+            await self.call_store(self.session_store.delete_store, session_id)
+        except Exception as e:
+            self.logger.info(f"[session_id:'{session_id}'] Failed to delete partially spilled session. err:{e!r}")
+
+    def save_session_store(self, session_id, session_store):
+        """
+        Persist the session store. Stores that write back field by field (LazySession) are flushed first.
+        """
+        if hasattr(session_store, "flush"):
+            session_store.flush()
+        self.session_store.save_store(session_id)
+
+    async def flush_session(self, request):
+        """
+        Write back the changed fields of a lazily loaded session, or save a versioned session,
+        at the end of the request.
+        """
+        fast_session = getattr(request.state, self.session_object, None)
+        if fast_session is None or fast_session.read_only:
+            return
+
+        if fast_session.auto_save:
+            await self.call_store(fast_session.session_save)
+        elif hasattr(fast_session.session_store, "flush"):
+            session_store = fast_session.session_store
+            await self.call_store(session_store.flush, size_hint=session_store.pending_payload_size())
+        elif getattr(self.session_store, "index_key", None) is not None:
+            # save_session を呼ばないハンドラーでも、索引するキーへの書き込みを索引に反映する
+            await self.call_store(self.session_store.update_index, fast_session.session_id, fast_session.session_store)
+
+    def save_versioned_session(self, version_state, session_store):
+        """
+        Save a session only if nobody else saved it since it was loaded. On a conflict the session is
+        re-read and the conflict resolved with conflict_policy, up to conflict_max_retries times.
+        Nothing is written when the session did not change.
+        :param version_state: {"session_id", "base": session as loaded, "version": version as loaded}
+        :param session_store: Session as this request left it
+        :return: True if the session is saved (or unchanged)
+        """
+        session_id = version_state["session_id"]
+        if dict(session_store) == version_state["base"]:
+            return True
+
+        data = session_store
+        for _ in range(self.conflict_max_retries + 1):
+            version = self.session_store.save_store_if_version(session_id, data, version_state["version"])
+            if version is not None:
+                self.conflict_stats["saved"] += 1
+                version_state["base"] = copy.deepcopy(dict(data))
+                version_state["version"] = version
+                return True
+
+            # 読み込んだ後に他のリクエストが保存した
+            # => 最新のセッションを読み直し、競合を解決してから保存し直す
+            self.conflict_stats["conflicts"] += 1
+            theirs, their_version = self.session_store.get_store_versioned(session_id)
+            if theirs is None:
+                # 他のリクエストでセッションが削除された(ログアウトなど) => 復活させない
+                self.logger.info(f"[session_id:'{session_id}'] Session deleted by another request. Changes are not saved.")
+                return False
+
+            data = resolve_conflict(self.conflict_policy, version_state["base"], session_store, theirs)
+            version_state["base"] = copy.deepcopy(dict(theirs))
+            version_state["version"] = their_version
+            if data is None:
+                # このリクエストの変更を捨てて、最新のセッションに合わせる
+                self.logger.info(f"[session_id:'{session_id}'] Session changed by another request. Changes are discarded.")
+                self.conflict_stats["discarded"] += 1
+                session_store.clear()
+                session_store.update(theirs)
+                return False
+
+            if data is not session_store:
+                # 以降の読み書きと保存が解決後の内容に基づくようにする
+                session_store.clear()
+                session_store.update(data)
+                data = session_store
+
+        self.logger.info(f"[session_id:'{session_id}'] Session kept changing. Gave up saving after {self.conflict_max_retries} retries.")
+        self.conflict_stats["gave_up"] += 1
+        return False
+
+    async def run_store_gc(self):
+        """
+        Try the store cleanup. A GCCoordinator does lease file or store I/O and a sweep batch, so when it is due
+        it runs in a worker thread (the store guard's, else the offload pool or the default executor)
+        instead of on the event loop.
+        """
+        if self.gc_coordinator is None or self.store_guard is not None:
+            await self.call_store(self.store_gc)
+            return
+
+        if not self.gc_coordinator.is_due():
+            return  # 間隔内 => ワーカースレッドに渡すまでもなくすぐ戻る
+        if self.offloader is not None:
+            await self.offloader.run(self.store_gc, size=self.offloader.threshold)
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, self.store_gc)
+
+    async def call_store(self, func, *args, allow_when_open=False, size_hint=0):
+        """
+        Call a store method, under the store guard (timeout, concurrency limit, circuit breaker) if configured.
+        Otherwise calls that handle a payload of offload_threshold bytes or more run in the offload worker pool.
+        :param size_hint: Size in bytes of the payload the call encodes or decodes, if known
+        :raises StoreUnavailable: when the guarded call fails
+        """
+        if self.store_guard is not None:
+            # ガード下の呼び出しは常にワーカースレッドで実行される
+            return await self.store_guard.call(func, *args, allow_when_open=allow_when_open)
+        if self.offloader is not None:
+            return await self.offloader.run(func, *args, size=size_hint)
+        return func(*args)
+
+    def create_transient_session(self, request, session_id, cause=None):
+        """
+        Set up a session that lives only for this request and is never persisted.
+        """
+        session_store = {"__transient__": True}
+        if cause is not None:
+            session_store["__cause__"] = cause
+
+        setattr(request.state,
+                self.session_object,
+                FastSession(
+                    store=session_store,
+                    session_id=session_id,
+                    session_save=lambda: None)  # 永続化しない
+                )
 
     async def create_new_session_id_and_store(self, request, cause=None):
         """
         Create a new session ID and its corresponding store.
         """
 
+        if self.should_defer_session_creation(request):
+            self.defer_session_creation(request, cause=cause)
+            return None
+
         # セッションID に署名してクッキーオブジェクトに保存する。また request.state 以下にセッションマネージャをぶるさげてセッションの入出力ができるようにする
+        allocated = await self.allocate_session(request, cause=cause)
+        if allocated is None:
+            return None
+
+        session_id, session_store, version = allocated
+        self.attach_session(request, session_id, session_store, version=version)
+
+        cookie = self.create_session_cookie(session_id)
+        return cookie
+
+    async def allocate_session(self, request, cause=None):
+        """
+        Allocate a new session ID and its store.
+        If new session creation is over the limit, a transient session is set to request.state instead.
+        :return: (session_id, session_store, version), or None for a transient session.
+                 version is None unless conflict_policy is set
+        """
         session_id = str(uuid.uuid4())
 
-        session_store = self.session_store.create_store(session_id)
+        if self.session_creation_limiter is not None and not self.session_creation_limiter.allow(request.scope):
+            # 新規セッションの生成が制限を超えた(クローラーや不正なクッキーの連打など)
+            # => ストアを確保せず、クッキーも発行しない一時的なセッションを割り当てる
+            self.logger.info(f"[session_id:'{session_id}'(TRANSIENT)] Session creation limit exceeded. Use transient session.")
+            self.create_transient_session(request, session_id, cause=cause)
+            return None
+
+        session_store = await self.call_store(self.session_store.create_store, session_id)
         self.logger.debug(f"[session_id:'{session_id}'(NEW)] New session_id and store for session_id created.")
 
         if cause is not None:
             session_store["__cause__"] = cause  # セッションが新規生成された理由を格納
 
+        version = None
+        if self.conflict_policy is not None:
+            # バージョン付きで保存するので、作成したストアを改めてバージョンとともに読む
+            session_store, version = await self.call_store(self.session_store.get_store_versioned, session_id)
+
+        await self.run_store_gc()  # たまったストアのクリーンアップをトライする
+
+        return session_id, session_store, version
+
+    def attach_session(self, request, session_id, session_store, version=None, read_only=False):
+        """
+        Set the session manager of a stored session to request.state.
+        A versioned session is given its own copy, saved with save_versioned_session at the end of the request.
+        :return: The session store the request works on
+        """
+        if read_only:
+            session_save = lambda: None
+        elif version is not None:
+            # 同時にセッションを読んだ他のリクエスト(シングルフライトで共有した読み出し)と干渉しないよう、
+            # 読み込んだ内容は変更せずに比較元として残し、複製に対して読み書きする
+            version_state = {"session_id": session_id, "base": session_store, "version": version}
+            session_store = copy.deepcopy(session_store)
+            session_save = lambda: self.save_versioned_session(version_state, session_store)
+        else:
+            session_save = lambda: self.save_session_store(session_id, session_store)
+
+        if self.offloader is not None and hasattr(session_store, "aprefetch"):
+            # ハンドラーが aprefetch で大きなフィールドのデコードをオフロードできるようにする
+            session_store.offloader = self.offloader
+
         fast_session_obj = FastSession(
             store=session_store,
             session_id=session_id,
-            session_save=lambda: self.session_store.save_store(session_id)
+            session_save=session_save,
+            read_only=read_only,
+            auto_save=version is not None and not read_only
         )
-        self.logger.info(f"[session_id:'{session_id}'(NEW)] Set session_mgr to request.state.{self.session_object} ")
+        if not read_only and version is None and hasattr(self.session_store, "checkout"):
+            # 保存するまでの間に、このリクエストが書き込むstoreをストアが圧縮などで置き換えないよう固定する
+            self.session_store.checkout(session_id)
+            fast_session_obj.checked_out = True
+
+        self.logger.info(f"[session_id:'{session_id}'] Set session_mgr to request.state.{self.session_object} ")
         # request.state に self.session_object に指定された属性名で FastSessionオブジェクトをぶらさげる
         setattr(request.state,
                 self.session_object,
                 fast_session_obj)
+        return session_store
+
+    def release_session(self, request):
+        """
+        Release the session pinned by attach_session at the end of the request or the connection.
+        """
+        fast_session = getattr(request.state, self.session_object, None)
+        if fast_session is None or not fast_session.checked_out:
+            return
 
-        self.session_store.gc()  # たまったストアのクリーンアップをトライする
+        fast_session.checked_out = False
+        self.session_store.release(fast_session.session_id)
 
-        cookie = self.create_session_cookie(session_id)
-        return cookie
+    async def fetch_session_store(self, session_id):
+        """
+        Get the store of a session. Concurrent fetches of the same session ID share one backend call,
+        and each request is given its own session object.
+        """
+        # 読み取り専用の縮退モードでは、回路が開いていても読み出しは試みる
+        allow_when_open = self.degraded_mode == "read_only"
+
+        if hasattr(self.session_store, "fetch_store_payload"):
+            # セッションを自らシリアライズするストアは、取得とデコードを分ける。
+            # まとめるのはエンコード済ペイロードの取得だけで、デコードはリクエストごとに行い、
+            # 大きなペイロードのデコードはオフロードする
+            fetch = lambda: self.call_store(self.session_store.fetch_store_payload, session_id,
+                                            allow_when_open=allow_when_open)
+            if self.single_flight is None:
+                payload = await fetch()
+            else:
+                payload = await self.single_flight.do(("get", session_id), fetch)
+            if payload is None:
+                return None
+            return await self.decode_session_payload(session_id, payload)
+
+        # デコードが必要なペイロードの大きさをストアが知っていれば、オフロードの判断に使う
+        size_hint = 0
+        if self.offloader is not None and hasattr(self.session_store, "payload_size_hint"):
+            size_hint = self.session_store.payload_size_hint(session_id)
+        fetch = lambda: self.call_store(self.session_store.get_store, session_id,
+                                        allow_when_open=allow_when_open, size_hint=size_hint)
+
+        if self.single_flight is None:
+            return await fetch()
+        return await self.single_flight.do(("get", session_id), fetch, share=self.own_session_store)
+
+    async def decode_session_payload(self, session_id, payload):
+        """
+        Decode a payload fetched with fetch_store_payload, in the offload worker pool
+        when the received payload is offload_threshold bytes or more.
+        """
+        if self.offloader is None:
+            return self.session_store.load_store_payload(session_id, payload)
+        return await self.offloader.run(self.session_store.load_store_payload, session_id, payload, size=len(payload))
+
+    @staticmethod
+    def own_session_store(session_store):
+        """
+        Give a request its own session object from a result shared by single-flight.
+        Session objects created per call (e.g. LazySession) are forked. In-memory stores return the live dict of
+        the session to every caller anyway, so it is shared as is.
+
+        シングルフライトで共有した結果から、リクエストごとのセッションオブジェクトを作る。
+        呼び出しごとに作られるセッションオブジェクト(LazySession など)は複製する。
+        オンメモリのストアはどの呼び出し元にもセッションの辞書そのものを返すので、そのまま共有する
+        """
+        fork = getattr(session_store, "fork", None)
+        return fork() if fork is not None else session_store
+
+    async def fetch_session_store_for_update(self, session_id):
+        """
+        Get the store of a session to read and write. With conflict_policy set, the store is read with its version.
+        :return: (session_store, version). version is None unless conflict_policy is set
+        """
+        if self.conflict_policy is None:
+            return await self.fetch_session_store(session_id), None
+
+        allow_when_open = self.degraded_mode == "read_only"
+        if self.single_flight is None:
+            return await self.call_store(self.session_store.get_store_versioned, session_id,
+                                         allow_when_open=allow_when_open)
+
+        # 共有した読み出し結果は各リクエストが attach_session で複製してから使う
+        return await self.single_flight.do(
+            ("get_versioned", session_id),
+            lambda: self.call_store(self.session_store.get_store_versioned, session_id,
+                                    allow_when_open=allow_when_open))
+
+    async def recreate_session(self, request, old_key, cause="valid_cookie_but_no_store"):
+        """
+        Re-create the session of an authentic cookie that can no longer be used: its store is gone,
+        or its signature expired.
+        Concurrent requests carrying the same cookie share one new session, and requests arriving shortly
+        after it was re-created are given the same new session too, so a burst emits a single new cookie.
+        :param old_key: Key identifying the old cookie: its session ID, or for an expired cookie the token itself
+        :return: cookie to set (or None) and inline session state (or None)
+        """
+        if self.single_flight is None:
+            return await self.create_new_session(request, cause=cause)
+
+        recreated = self.recreated_sessions.get(old_key)
+        if recreated is not None and recreated[1] <= time.monotonic():
+            recreated = None
+
+        if self.inline_session_max_bytes > 0:
+            # インラインセッションはストアを使わないので、新しいセッションIDだけを共有する
+            if recreated is not None:
+                self.logger.info(f"[session_id:'{recreated[0]}'] Use inline session re-created just before.")
+                session_id = recreated[0]
+            else:
+                session_id = str(uuid.uuid4())
+                self.remember_recreated_session(old_key, session_id)
+            inline_session = self.load_inline_session(request, session_id, {}, None, None)
+            inline_session["data"]["__cause__"] = cause
+            return None, inline_session
+
+        if recreated is not None:
+            # 直前に同じクッキーから再生成したセッションを使う
+            session_id = recreated[0]
+            session_store, version = await self.fetch_session_store_for_update(session_id)
+            if session_store is not None:
+                self.logger.info(f"[session_id:'{session_id}'] Use session re-created just before.")
+                self.attach_session(request, session_id, session_store, version=version)
+                return self.create_session_cookie(session_id), None
+
+        if self.should_defer_session_creation(request):
+            self.defer_session_creation(request, cause=cause)
+            return None, None
+
+        allocated = await self.single_flight.do(
+            ("recreate", old_key), lambda: self.allocate_session(request, cause=cause),
+            share=lambda allocated: allocated and (allocated[0], self.own_session_store(allocated[1]), allocated[2]))
+        if allocated is None:
+            if getattr(request.state, self.session_object, None) is None:
+                # 生成制限によって共有した呼び出しが一時的なセッションになった
+                self.create_transient_session(request, str(uuid.uuid4()), cause=cause)
+            return None, None
+
+        session_id, session_store, version = allocated
+        self.remember_recreated_session(old_key, session_id)
+        self.attach_session(request, session_id, session_store, version=version)
+        return self.create_session_cookie(session_id), None
+
+    def remember_recreated_session(self, old_key, session_id):
+        self.recreated_sessions[old_key] = (session_id, time.monotonic() + self.recreated_session_ttl)
+        self.recreated_sessions.move_to_end(old_key)
+        while len(self.recreated_sessions) > self.RECREATED_SESSIONS_MAX:
+            self.recreated_sessions.popitem(last=False)
@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class FileLease:
+    """
+    Lease held with an exclusive, non-blocking flock on a file shared by the worker processes of one host.
+    The sweep checkpoint is kept in the same file. The lock is released by the OS if the holder dies.
+
+    同じホストのワーカープロセスが共有するファイルに対する排他・非ブロッキングの flock によるリース。
+    掃除の進捗(チェックポイント)も同じファイルに保存する。保持していたプロセスが落ちると OS がロックを解放する
+    """
+
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError("FileLease requires fcntl (not available on this platform), use StoreLease instead")
+        self.path = path
+        self.fp = None
+        self.checkpoint = None
+
+    def acquire(self):
+        """
+        :return: True if the lease was acquired, False if another worker holds it
+        """
+        fp = open(self.path, "a+")
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fp.close()
+            return False
+
+        fp.seek(0)
+        content = fp.read()
+        self.checkpoint = json.loads(content).get("checkpoint") if content else None
+        self.fp = fp
+        return True
+
+    def release(self, checkpoint=None):
+        """
+        Save the checkpoint and release the lease.
+        """
+        fp = self.fp
+        self.fp = None
+        try:
+            fp.seek(0)
+            fp.truncate()
+            fp.write(json.dumps({"checkpoint": checkpoint}))
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            fp.close()
+
+
+class StoreLease:
+    """
+    Lease held as a record in the shared store, for workers on different hosts.
+    The record expires after ttl seconds so a crashed holder does not block sweeping forever.
+    The store implements acquire_lease(name, owner, ttl) and release_lease(name, owner, checkpoint).
+
+    別々のホストのワーカー向けに、共有ストア内のレコードとして保持するリース。
+    保持したワーカーが落ちても掃除が止まり続けないよう、レコードは ttl 秒で期限切れになる。
+    ストアは acquire_lease(name, owner, ttl) と release_lease(name, owner, checkpoint) を実装する
+    """
+
+    def __init__(self, store, name="gc", ttl=60):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.owner = str(uuid.uuid4())
+        self.checkpoint = None
+
+    def acquire(self):
+        """
+        :return: True if the lease was acquired, False if another worker holds it
+        """
+        lease = self.store.acquire_lease(self.name, self.owner, self.ttl)
+        if lease is None:
+            return False
+        self.checkpoint = lease.get("checkpoint")
+        return True
+
+    def release(self, checkpoint=None):
+        """
+        Save the checkpoint and release the lease.
+        """
+        self.store.release_lease(self.name, self.owner, checkpoint)
+
+
+class GCCoordinator:
+    """
+    Coordinates expiry sweeping of a store shared by several workers. Only the worker holding the lease sweeps,
+    one bounded batch at a time, resuming from the checkpoint left by the previous batch. The other workers skip.
+    The store implements sweep_expired(cursor, limit).
+
+    複数のワーカーが共有するストアの期限切れセッションの掃除を調整する。リースを持つワーカーだけが、
+    前回のバッチが残したチェックポイントから、上限付きのバッチを1回ずつ掃除する。ほかのワーカーは何もしない。
+    ストアは sweep_expired(cursor, limit) を実装する
+    """
+
+    def __init__(self, store, lease, batch_size=1000, interval=60):
+        """
+        :param store: Store to sweep
+        :param lease: FileLease or StoreLease
+        :param batch_size: Maximum number of sessions examined per sweep
+        :param interval: Minimum seconds between sweep attempts of this worker
+        """
+        if not hasattr(store, "sweep_expired"):
+            raise ValueError(f"GCCoordinator requires a store supporting sweep_expired, got {store}")
+
+        self.store = store
+        self.lease = lease
+        self.batch_size = batch_size
+        self.interval = interval
+        self.next_run_at = 0
+        self.run_lock = threading.Lock()  # gc はワーカースレッドから並行して呼ばれうる
+        self.stats = {
+            "runs": 0,  # 掃除した回数
+            "skipped": 0,  # 他のワーカーがリースを持っていたので掃除しなかった回数
+            "swept": 0,  # 削除した期限切れセッション数
+            "cycles": 0,  # ストア全体を掃除し終えた回数
+        }
+
+    def is_due(self):
+        """
+        :return: True if the interval has passed, i.e. gc would try to sweep. Lets callers skip scheduling gc
+                 on a worker thread when it would return at once
+        """
+        return time.monotonic() >= self.next_run_at
+
+    def gc(self):
+        """
+        Sweep one batch if the interval has passed and the lease is free. Called in place of the store's gc.
+        The lease does blocking I/O, so it should be called off the event loop.
+
+        間隔が経過していてリースが空いていれば1バッチ掃除する。ストアの gc の代わりに呼び出す。
+        リースはブロックするI/Oを行うので、イベントループの外で呼び出す
+
+        :return: Number of sessions deleted, or None if this worker did not sweep
+        """
+        with self.run_lock:
+            now = time.monotonic()
+            if now < self.next_run_at:
+                return None
+            self.next_run_at = now + self.interval
+
+        if not self.lease.acquire():
+            self.stats["skipped"] += 1
+            return None
+
+        cursor = self.lease.checkpoint
+        try:
+            deleted, cursor = self.store.sweep_expired(cursor, self.batch_size)
+        finally:
+            # 失敗しても、それまでの進捗(または前回のチェックポイント)を残してリースを返す
+            self.lease.release(cursor)
+
+        self.stats["runs"] += 1
+        self.stats["swept"] += deleted
+        if cursor is None:
+            self.stats["cycles"] += 1
+        return deleted
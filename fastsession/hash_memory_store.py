@@ -0,0 +1,136 @@
+import time
+
+from .lazy_session import LazySession
+from .scan_order import ScanOrder
+
+
+class HashMemoryStore:
+    """
+    An in-memory reference implementation of a hash-style store, where each top-level session key
+    is stored as its own encoded field (like a Redis hash). get_store returns a LazySession that
+    fetches fields on first access and writes back only the changed fields.
+    Remote hash-style stores implement the same get_fields / get_field_names / set_fields / delete_fields methods.
+
+    セッションのトップレベルのキーをそれぞれエンコード済の別フィールドとして保存する(Redis のハッシュのような)
+    ハッシュ型ストアのオンメモリ実装。get_store はフィールドを最初のアクセス時に取得し、
+    変更されたフィールドだけを書き戻す LazySession を返す。
+    リモートのハッシュ型ストアも同じ get_fields / get_field_names / set_fields / delete_fields を実装する
+    """
+
+    # セッションはこのプロセスのメモリにだけあり、別のプロセスからは見えない
+    process_local = True
+
+    def __init__(self, max_session_age=3600 * 12):
+        self.raw_memory_store = {}
+        self.scan_order = ScanOrder()  # sweep_expired をカーソルから再開するための作成順
+        self.max_session_age = max_session_age
+        self.stats = {
+            "get_fields_calls": 0,  # フィールド取得の呼び出し回数
+            "fields_fetched": 0,  # 取得したフィールド数
+            "set_fields_calls": 0,  # フィールド書き込みの呼び出し回数
+            "fields_written": 0,  # 書き込んだフィールド数
+        }
+
+    def has_session_id(self, session_id):
+        return session_id in self.raw_memory_store
+
+    def has_no_session_id(self, session_id):
+        return session_id not in self.raw_memory_store
+
+    def create_store(self, session_id):
+        self.raw_memory_store[session_id] = {
+            "created_at": int(time.time()),
+            "fields": {}}
+        self.scan_order.add(session_id)
+        return LazySession(self, session_id, field_names=[])
+
+    def get_store(self, session_id):
+        if session_id not in self.raw_memory_store:
+            return None
+        return LazySession(self, session_id)
+
+    def save_store(self, session_id):
+        # フィールドの書き戻しは LazySession.flush で行う
+        pass
+
+    def delete_store(self, session_id):
+        if self.raw_memory_store.pop(session_id, None) is None:
+            return False
+        self.scan_order.remove(session_id)
+        return True
+
+    def get_field_names(self, session_id):
+        session_info = self.raw_memory_store.get(session_id)
+        return list(session_info["fields"]) if session_info else []
+
+    def get_fields(self, session_id, names):
+        """
+        Fetch several fields of a session in one call.
+
+        セッションの複数のフィールドを1回の呼び出しで取得する
+
+        :return: Dictionary of field name to encoded value, for the fields that exist
+        """
+        self.stats["get_fields_calls"] += 1
+        session_info = self.raw_memory_store.get(session_id)
+        if session_info is None:
+            return {}
+
+        fields = session_info["fields"]
+        result = {name: fields[name] for name in names if name in fields}
+        self.stats["fields_fetched"] += len(result)
+        return result
+
+    def set_fields(self, session_id, encoded_fields):
+        """
+        Write several encoded fields of a session in one call.
+
+        セッションの複数のエンコード済フィールドを1回の呼び出しで書き込む
+        """
+        session_info = self.raw_memory_store.get(session_id)
+        if session_info is None:
+            return
+
+        self.stats["set_fields_calls"] += 1
+        self.stats["fields_written"] += len(encoded_fields)
+        session_info["fields"].update(encoded_fields)
+
+    def delete_fields(self, session_id, names):
+        session_info = self.raw_memory_store.get(session_id)
+        if session_info is None:
+            return
+
+        for name in names:
+            session_info["fields"].pop(name, None)
+
+    def gc(self):
+        # ストアに100件以上のセッションデータがあるばあい、古いものを削除する
+        if len(self.raw_memory_store) >= 100:
+            self.cleanup_old_sessions()
+
+    def cleanup_old_sessions(self):
+        current_time = int(time.time())
+        sessions_to_delete = [session_id for session_id, session_info in self.raw_memory_store.items()
+                              if current_time - session_info["created_at"] > self.max_session_age]
+
+        for session_id in sessions_to_delete:
+            self.delete_store(session_id)
+
+    def sweep_expired(self, cursor=None, limit=1000):
+        """
+        Delete the expired sessions among at most limit sessions, starting from cursor.
+
+        cursor の位置から最大 limit 件のセッションを調べ、期限切れのものを削除する
+
+        :return: (number of sessions deleted, cursor to continue from, or None once the whole store was swept)
+        """
+        cursor, session_ids = self.scan_order.scan(cursor or 0, limit)
+
+        current_time = int(time.time())
+        deleted = 0
+        for session_id in session_ids:
+            session_info = self.raw_memory_store.get(session_id)
+            if session_info is not None and current_time - session_info["created_at"] > self.max_session_age:
+                deleted += self.delete_store(session_id)
+
+        return deleted, cursor or None
@@ -0,0 +1,220 @@
+import copy
+import json
+from collections.abc import MutableMapping
+
+from .offload import estimate_encoded_size
+
+
+class LazySession(MutableMapping):
+    """
+    A session mapping for hash-style stores, where each top-level session key is stored as its own field.
+    Fields are fetched on first access (several at once with prefetch, or all missing fields in one batch
+    when the session is iterated) and flush writes back only the fields that were changed or deleted.
+    Fields that were read are compared with their fetched encoding on flush, so in-place changes to nested
+    values are written back as well.
+
+    セッションのトップレベルのキーをそれぞれ別のフィールドとして保存するハッシュ型ストア向けのセッション。
+    フィールドは最初にアクセスしたときに取得し(prefetch で複数まとめて、または列挙時に未取得のフィールドを一括で)、
+    flush では変更・削除されたフィールドだけを書き戻す。
+    読み出したフィールドは flush 時に取得時のエンコード結果と比較するので、入れ子の値をその場で変更した場合も書き戻される。
+    """
+
+    def __init__(self, store, session_id, field_names=None):
+        """
+        :param store: Store implementing get_fields, get_field_names, set_fields and delete_fields
+        :param session_id: Session ID
+        :param field_names: Field names of the session if already known (e.g. [] for a new session)
+        """
+        self.store = store
+        self.session_id = session_id
+        self.field_names = set(field_names) if field_names is not None else None
+        self.loaded = {}  # 取得済または書き込まれたフィールド
+        self.fetched_encodings = {}  # 取得時のフィールドのエンコード結果(変更検出用)
+        self.missing = set()  # 取得を試みたが存在しなかったフィールド(再度取得しない)
+        self.dirty = set()  # 書き込まれたフィールド
+        self.deleted = set()  # 削除されたフィールド
+        self.offloader = None  # ミドルウェアが設定する。aprefetch で大きなフィールドのデコードに使う
+
+    def fork(self):
+        """
+        Make an independent session of the same session ID, with its own copy of the fields loaded or
+        written so far, so that requests sharing one fetch do not see each other's changes.
+
+        これまでに取得・書き込みしたフィールドを複製した、同じセッションIDの独立したセッションを作る。
+        1回の取得を共有したリクエストが互いの変更を見ないようにする
+        """
+        session = LazySession(self.store, self.session_id, self.field_names)
+        session.loaded = copy.deepcopy(self.loaded)
+        session.fetched_encodings = dict(self.fetched_encodings)
+        session.missing = set(self.missing)
+        session.dirty = set(self.dirty)
+        session.deleted = set(self.deleted)
+        return session
+
+    def get_field_names(self):
+        if self.field_names is None:
+            self.field_names = set(self.store.get_field_names(self.session_id))
+        return (self.field_names | set(self.loaded)) - self.deleted
+
+    def prefetch(self, *keys):
+        """
+        Fetch the given fields in one batched call, skipping those already loaded.
+
+        指定したフィールドのうち未取得のものを1回の呼び出しでまとめて取得する
+        """
+        missing, fields = self.fetch_fields(keys)
+        if missing:
+            self.load_fields(missing, fields, self.decode_fields(fields))
+
+    async def aprefetch(self, *keys):
+        """
+        Like prefetch, but fields of offload_threshold bytes or more in total are decoded in the middleware's
+        offload worker pool, so decoding them does not stall the event loop. Call it from async handlers
+        before reading large fields.
+
+        prefetch と同じだが、合計が offload_threshold バイト以上のフィールドはミドルウェアのオフロード用の
+        ワーカープールでデコードし、イベントループを止めない。async のハンドラーで大きなフィールドを読む前に呼ぶ
+        """
+        missing, fields = self.fetch_fields(keys)
+        if not missing:
+            return
+        if self.offloader is None:
+            decoded = self.decode_fields(fields)
+        else:
+            size = sum(len(encoded) for encoded in fields.values())
+            decoded = await self.offloader.run(self.decode_fields, fields, size=size)
+        self.load_fields(missing, fields, decoded)
+
+    def fetch_fields(self, keys):
+        """
+        :return: (names of the fields not loaded yet, their encoded values fetched from the store)
+        """
+        missing = [key for key in keys if key not in self.loaded and key not in self.deleted and key not in self.missing]
+        if self.field_names is not None:
+            missing = [key for key in missing if key in self.field_names]
+        if not missing:
+            return [], {}
+        return missing, self.store.get_fields(self.session_id, missing)
+
+    @staticmethod
+    def decode_fields(fields):
+        return {key: json.loads(encoded) for key, encoded in fields.items()}
+
+    def load_fields(self, missing, fields, decoded):
+        for key, encoded in fields.items():
+            if key in self.loaded or key in self.deleted:
+                continue  # デコードしている間に書き込まれた・削除された
+            self.loaded[key] = decoded[key]
+            self.fetched_encodings[key] = encoded
+        self.missing.update(key for key in missing if key not in fields and key not in self.loaded)
+
+    def prefetch_all(self):
+        self.prefetch(*self.get_field_names())
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            self.prefetch(key)
+        if key not in self.loaded:
+            raise KeyError(key)
+        return self.loaded[key]
+
+    def __setitem__(self, key, value):
+        self.loaded[key] = value
+        self.dirty.add(key)
+        self.deleted.discard(key)
+        self.missing.discard(key)
+
+    def set_local(self, key, value):
+        """
+        Set a value visible while the session is in use, without writing it back unless it is changed afterwards.
+        Used for the middleware's bookkeeping, so a request that only reads the session writes nothing.
+
+        セッションを使っている間だけ見える値をセットする。その後変更されない限り書き戻さない。
+        ミドルウェアの管理用の値に使い、セッションを読むだけのリクエストでは何も書き込まないようにする
+        """
+        self.loaded[key] = value
+        self.fetched_encodings[key] = json.dumps(value, separators=(",", ":"))
+        self.dirty.discard(key)
+        self.deleted.discard(key)
+        self.missing.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.loaded.pop(key, None)
+        self.dirty.discard(key)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.deleted:
+            return False
+        if key in self.loaded:
+            return True
+        return key in self.get_field_names()
+
+    def __iter__(self):
+        return iter(list(self.get_field_names()))
+
+    def __len__(self):
+        return len(self.get_field_names())
+
+    def items(self):
+        self.prefetch_all()
+        return super().items()
+
+    def values(self):
+        self.prefetch_all()
+        return super().values()
+
+    def clear(self):
+        for key in list(self.get_field_names()):
+            del self[key]
+
+    def copy(self):
+        self.prefetch_all()
+        return dict(self.loaded)
+
+    def __repr__(self):
+        return f"LazySession(session_id={self.session_id!r}, loaded={self.loaded!r})"
+
+    def pending_payload_size(self):
+        """
+        Estimated size in bytes of the payload flush encodes. Fields read but not assigned are estimated from
+        their size when fetched, assigned or new fields from their values.
+
+        flush がエンコードするペイロードの推定バイト数。読んだだけのフィールドは取得時の大きさから、
+        代入された・新しいフィールドは値から見積もる
+        """
+        size = 0
+        for key, value in self.loaded.items():
+            encoded = self.fetched_encodings.get(key)
+            if encoded is not None and key not in self.dirty:
+                size += len(encoded)
+            else:
+                size += estimate_encoded_size(value)
+        return size
+
+    def flush(self):
+        """
+        Write back only the fields that changed since they were fetched, and delete removed fields.
+
+        取得後に変更されたフィールドだけを書き戻し、削除されたフィールドを削除する
+        """
+        changed = {}
+        for key, value in self.loaded.items():
+            encoded = json.dumps(value, separators=(",", ":"))
+            if encoded != self.fetched_encodings.get(key):
+                changed[key] = encoded
+
+        if changed:
+            self.store.set_fields(self.session_id, changed)
+            self.fetched_encodings.update(changed)
+        if self.deleted:
+            self.store.delete_fields(self.session_id, list(self.deleted))
+            for key in self.deleted:
+                self.fetched_encodings.pop(key, None)
+
+        if self.field_names is not None:
+            self.field_names = (self.field_names | set(changed)) - self.deleted
+        self.dirty.clear()
+        self.deleted.clear()
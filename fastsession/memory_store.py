@@ -1,15 +1,66 @@
+import copy
+import json
+import threading
 import time
+import zlib
+
+from .memory_store_snapshot import SnapshotReader, decode_payload, write_snapshot
+from .scan_order import ScanOrder
+from .session_quota import QuotaSessionDict, SizeHistogram
 
 
 class MemoryStore:
-    def __init__(self):
+    # セッションはこのプロセスのメモリにだけあり、別のプロセスからは見えない
+    process_local = True
+
+    def __init__(self, index_key=None, max_session_bytes=None, quota_policy="enforce", max_session_age=3600 * 12,
+                 compress_idle_after=None, compaction_interval=60, logger=None):
         """
         Initialize an instance of MemoryStore. Create a dictionary to store the data for each session.
 
         MemoryStoreのインスタンスを初期化し、各セッションのデータを格納する辞書を作成する
+
+        :param index_key: Session key to index sessions by (e.g. "user_id"). The index is updated on save_store
+                          and enables find_sessions / revoke_user without scanning every session.
+                          セッションを索引するセッション内のキー(例 "user_id")。save_store 時に更新される
+        :param max_session_bytes: Byte quota per session. When set, session sizes are tracked as keys change
+                                  and reported by stats. セッションごとのバイト数の上限。指定するとサイズを追跡する
+        :param quota_policy: "enforce" to raise SessionQuotaExceeded, "warn" to only log a warning
+                             上限を超えたとき "enforce" は例外を送出し、"warn" は警告ログのみ
+        :param max_session_age: Seconds after creation at which a session expires
+                                作成からセッションが期限切れになるまでの秒数
+        :param compress_idle_after: When set, sessions not accessed for this many seconds are packed into
+                                    compressed bytes by compact_idle_sessions and re-inflated on the next access.
+                                    Sessions checked out with checkout are not packed until released.
+                                    指定すると、この秒数アクセスのないセッションを compact_idle_sessions で圧縮した
+                                    バイト列にまとめ、次のアクセス時に展開する
+        :param compaction_interval: Seconds between background compaction passes, None to only compact on demand
+                                    バックグラウンドで圧縮する間隔(秒)。None の場合は呼び出したときだけ圧縮する
+        :param logger: Logger for quota warnings. FastSessionMiddleware sets its own logger when None
+                       上限超過の警告などを出すロガー。None の場合は FastSessionMiddleware が自身のロガーを設定する
         """
 
         self.raw_memory_store = {}
+        self.scan_order = ScanOrder()  # sweep_expired をカーソルから再開するための作成順
+        self.index_key = index_key
+        self.index = {}  # 索引する値 -> session_id の集合
+        self.indexed_values = {}  # session_id -> 索引している値
+        self.index_lock = threading.RLock()  # ストアの呼び出しはワーカースレッドから並行して行われうる
+        self.max_session_bytes = max_session_bytes
+        self.quota_policy = quota_policy
+        self.logger = logger
+        self.max_session_age = max_session_age
+        self.snapshot_readers = {}  # restore で開いたスナップショット -> それを参照している未デコードのセッション数
+        self.snapshot_lock = threading.RLock()
+        self.version_lock = threading.Lock()  # バージョンの比較と保存を不可分にする
+        self.leases = {}  # リース名 -> {"owner", "expires_at", "checkpoint"}
+        self.lease_lock = threading.Lock()
+        self.compress_idle_after = compress_idle_after
+        self.pack_lock = threading.Lock()  # 圧縮と展開がアクセスと入れ違わないようにする
+        self.compaction_stop = None
+        self.compaction_thread = None
+        if compress_idle_after is not None and compaction_interval is not None:
+            self.start_background_compaction(compaction_interval)
 
     def has_session_id(self, session_id):
         """
@@ -45,10 +96,32 @@ class MemoryStore:
         """
         self.raw_memory_store[session_id] = {
             "created_at": int(time.time()),  # Current UNIX time,
-            "store": {}}
+            "version": 0,  # save_store のたびに増える
+            "accessed_at": time.monotonic(),
+            "store": self.new_session_dict()}
+        self.scan_order.add(session_id)
         self.save_store(session_id)  # 永続化
         return self.raw_memory_store.get(session_id).get("store")
 
+    def set_default_logger(self, logger):
+        """
+        Use the given logger (e.g. FastSessionMiddleware's) unless one was given to the constructor.
+
+        コンストラクタでロガーを渡されていなければ、与えたロガー(FastSessionMiddleware のものなど)を使う
+        """
+        if self.logger is None:
+            self.logger = logger
+
+    def new_session_dict(self, data=None):
+        """
+        Create the dictionary holding a session's data. It tracks its size when a quota is configured.
+
+        セッションのデータを保持する辞書を作成する。上限が設定されている場合はサイズを追跡する辞書になる
+        """
+        if self.max_session_bytes is None:
+            return dict(data) if data else {}
+        return QuotaSessionDict(data, max_bytes=self.max_session_bytes, policy=self.quota_policy, logger=self.logger)
+
     def get_store(self, session_id):
         """
         Get the store for the given session_id.
@@ -59,11 +132,252 @@ class MemoryStore:
         :return: The store corresponding to the session_id, or None if no such store exists
         """
 
-        if self.raw_memory_store.get(session_id):
-            return self.raw_memory_store.get(session_id).get("store")
+        session_info = self.raw_memory_store.get(session_id)
+        if session_info:
+            return self.load_session_info(session_info)["store"]
         else:
             return None
 
+    def get_store_versioned(self, session_id):
+        """
+        Get a private copy of the store for the given session_id together with its version.
+        Changes to the copy are persisted with save_store_if_version.
+
+        与えられたsession_idのstoreの複製を、そのバージョンとともに取得する。
+        複製への変更は save_store_if_version で永続化する
+
+        :param session_id: Session ID for which to get the store
+        :return: (store, version), or (None, None) if no such store exists
+        """
+        with self.version_lock:
+            session_info = self.raw_memory_store.get(session_id)
+            if not session_info:
+                return None, None
+            session_info = self.load_session_info(session_info)
+            return copy.deepcopy(session_info["store"]), session_info.get("version", 0)
+
+    def save_store_if_version(self, session_id, session_store, expected_version):
+        """
+        Persist the store for the given session_id only if its version is still expected_version,
+        i.e. nobody saved the session since it was read with get_store_versioned.
+
+        与えられたsession_idのstoreを、バージョンが expected_version のまま
+        (get_store_versioned で読んでから誰も保存していない)場合に限り永続化する
+
+        :param session_id: Session ID for which to persist the store
+        :param session_store: Session data to persist
+        :param expected_version: Version returned by get_store_versioned
+        :return: New version, or None if the version changed or the session no longer exists
+        """
+        with self.version_lock:
+            session_info = self.raw_memory_store.get(session_id)
+            if not session_info or session_info.get("version", 0) != expected_version:
+                return None
+
+            session_info["store"] = self.new_session_dict(copy.deepcopy(dict(session_store)))
+            self.release_snapshot(session_info)
+            session_info.pop("packed", None)
+            session_info["version"] = expected_version + 1
+
+            if self.index_key is not None:
+                self.update_index(session_id, session_info["store"])
+            return session_info["version"]
+
+    def payload_size_hint(self, session_id):
+        """
+        Size in bytes of the payload get_store has to decode for the given session_id, 0 if none.
+
+        get_store がデコードする必要のあるペイロードのバイト数。不要なら 0
+
+        :param session_id: Session ID
+        :return: Size in bytes
+        """
+        session_info = self.raw_memory_store.get(session_id)
+        if session_info is None:
+            return 0
+        if session_info.get("packed") is not None:
+            return session_info["packed"][1]
+        if session_info.get("snapshot") is not None:
+            return session_info["snapshot"][2]
+        return 0
+
+    def load_session_info(self, session_info):
+        """
+        Make sure the store of a session entry is materialised, decoding it from the snapshot
+        it was restored from, or re-inflating it after it was packed, on access.
+
+        セッションのエントリのstoreを実体化する。restore したセッションは最初のアクセス時にスナップショットからデコードし、
+        圧縮したセッションは展開する
+
+        :param session_info: Entry of raw_memory_store
+        :return: The same entry, with its store materialised
+        """
+        if self.compress_idle_after is not None:
+            # 圧縮と入れ違わないよう、アクセス時刻の更新と展開はロックの中で行う
+            with self.pack_lock:
+                session_info["accessed_at"] = time.monotonic()
+                return self.materialise_session_info(session_info)
+        return self.materialise_session_info(session_info)
+
+    def materialise_session_info(self, session_info):
+        if session_info.get("snapshot") is not None:
+            with self.snapshot_lock:
+                snapshot = session_info.get("snapshot")
+                if snapshot is not None:
+                    reader, offset, length = snapshot
+                    session_info["store"] = self.new_session_dict(reader.load_payload(offset, length))
+                    self.release_snapshot(session_info)
+
+        packed = session_info.get("packed")
+        if packed is not None:
+            session_info["store"] = self.new_session_dict(decode_payload(packed[0]))
+            del session_info["packed"]
+        return session_info
+
+    def peek_session_store(self, session_info):
+        """
+        Read the store of a session entry without materialising it. A packed session, or a session
+        not yet decoded from its snapshot, is decoded into a temporary dict and stays packed in the store.
+        Reading does not count as an access.
+
+        セッションのエントリのstoreを実体化せずに読む。圧縮したセッションやスナップショットから未デコードのセッションは
+        一時的な辞書にデコードし、ストアの中は圧縮したままにする。アクセスとしては数えない
+
+        :param session_info: Entry of raw_memory_store
+        :return: The store, or a temporary dict decoded from the packed or snapshot payload
+        """
+        with self.pack_lock:
+            session_store = session_info.get("store")
+            packed = session_info.get("packed")
+        if session_store is not None:
+            return session_store
+        if packed is not None:
+            return decode_payload(packed[0])
+
+        with self.snapshot_lock:
+            snapshot = session_info.get("snapshot")
+            if snapshot is not None:
+                reader, offset, length = snapshot
+                return reader.load_payload(offset, length)
+        return session_info.get("store")  # 読んでいる間に展開された
+
+    def release_snapshot(self, session_info):
+        """
+        Drop the reference of a session entry to the snapshot it was restored from.
+        The snapshot is closed once none of its sessions is left undecoded.
+
+        セッションのエントリからスナップショットへの参照を外す。
+        未デコードのセッションが残っていないスナップショットは閉じる
+        """
+        with self.snapshot_lock:
+            snapshot = session_info.pop("snapshot", None)
+            if snapshot is None:
+                return
+
+            self.unref_snapshot_reader(snapshot[0])
+
+    def unref_snapshot_reader(self, reader):
+        with self.snapshot_lock:
+            self.snapshot_readers[reader] -= 1
+            if self.snapshot_readers[reader] == 0:
+                del self.snapshot_readers[reader]
+                reader.close()
+
+    def checkout(self, session_id):
+        """
+        Pin a session while a request or a WebSocket connection holds its store, so compact_idle_sessions
+        does not replace the store the holder is writing to. Each checkout is paired with a release.
+
+        リクエストやWebSocket接続がセッションのstoreを保持している間、セッションを固定する。
+        保持している側が書き込んでいるstoreを compact_idle_sessions が置き換えないようにする。checkout ごとに release を呼ぶ
+
+        :param session_id: Session ID
+        """
+        with self.pack_lock:
+            session_info = self.raw_memory_store.get(session_id)
+            if session_info is not None:
+                session_info["checkouts"] = session_info.get("checkouts", 0) + 1
+                session_info["accessed_at"] = time.monotonic()
+
+    def release(self, session_id):
+        """
+        Unpin a session pinned with checkout. It becomes idle from now on.
+
+        checkout で固定したセッションの固定を外す。ここからアイドル時間を数える
+
+        :param session_id: Session ID
+        """
+        with self.pack_lock:
+            session_info = self.raw_memory_store.get(session_id)
+            if session_info is not None and session_info.get("checkouts", 0) > 0:
+                session_info["checkouts"] -= 1
+                session_info["accessed_at"] = time.monotonic()
+
+    def compact_idle_sessions(self):
+        """
+        Pack the sessions not accessed for compress_idle_after seconds into zlib-compressed JSON bytes.
+        Sessions checked out and sessions whose data does not survive a JSON round trip unchanged are left as they are.
+
+        compress_idle_after 秒アクセスのないセッションを zlib 圧縮したJSONのバイト列にまとめる。
+        checkout 中のセッションと、JSONを経由すると内容が変わってしまうセッションはそのままにする
+
+        :return: Number of sessions packed
+        """
+        if self.compress_idle_after is None:
+            return 0
+
+        count = 0
+        for session_id in list(self.raw_memory_store):
+            session_info = self.raw_memory_store.get(session_id)
+            if session_info is None or session_info.get("store") is None:
+                continue  # 圧縮済、またはスナップショットから未デコード
+
+            with self.pack_lock:
+                idle = time.monotonic() - session_info.get("accessed_at", 0)
+                session_store = session_info.get("store")
+                if session_store is None or idle < self.compress_idle_after or session_info.get("checkouts", 0) > 0:
+                    continue
+
+                try:
+                    raw = json.dumps(session_store, separators=(",", ":"))
+                except (TypeError, ValueError):
+                    continue
+                if json.loads(raw) != session_store:
+                    continue  # タプルや数値のキーなど、JSONで表せない値を含む
+
+                # スナップショットのペイロードと同じ形式(zlib圧縮したJSON)。展開後の大きさもオフロードの判断用に持つ
+                session_info["packed"] = (zlib.compress(raw.encode("utf-8")), len(raw))
+                session_info["store"] = None
+                count += 1
+
+        return count
+
+    def start_background_compaction(self, interval=60):
+        """
+        Run compact_idle_sessions every interval seconds in a daemon thread.
+
+        compact_idle_sessions をデーモンスレッドで interval 秒ごとに実行する
+        """
+        if self.compaction_thread is not None:
+            return
+
+        self.compaction_stop = threading.Event()
+
+        def run(stop):
+            while not stop.wait(interval):
+                self.compact_idle_sessions()
+
+        self.compaction_thread = threading.Thread(target=run, args=(self.compaction_stop,),
+                                                  name="fastsession-compaction", daemon=True)
+        self.compaction_thread.start()
+
+    def stop_background_compaction(self):
+        if self.compaction_thread is None:
+            return
+        self.compaction_stop.set()
+        self.compaction_thread.join()
+        self.compaction_thread = None
+
     def save_store(self, session_id):
         """
         Persist the store for the given session_id. As this is an in-memory store,
@@ -82,6 +396,262 @@ class MemoryStore:
             # メモリベースなので、とくになにもしない
             pass
 
+        session_info = self.raw_memory_store.get(session_id)
+        if session_info is not None:
+            # バージョンを比較して保存する側が、この保存を検知できるようにする
+            with self.version_lock:
+                session_info["version"] = session_info.get("version", 0) + 1
+
+        if self.index_key is not None and session_store is not None:
+            self.update_index(session_id, session_store)
+
+    def update_index(self, session_id, session_store):
+        """
+        Update the secondary index entry of the given session_id from its store.
+
+        与えられたsession_idの索引をstoreの内容で更新する
+        """
+        if self.index_key is None or session_id not in self.raw_memory_store:
+            return  # 索引しないストア、または一時的なセッションなどストアにないセッション
+
+        value = session_store.get(self.index_key)
+        try:
+            hash(value)
+        except TypeError:
+            value = None  # ハッシュできない値は索引しない
+
+        with self.index_lock:
+            if self.indexed_values.get(session_id) == value:
+                return
+
+            self.remove_from_index(session_id)
+            if value is not None:
+                self.index.setdefault(value, set()).add(session_id)
+                self.indexed_values[session_id] = value
+
+    def remove_from_index(self, session_id):
+        """
+        Remove the given session_id from the secondary index.
+
+        与えられたsession_idを索引から削除する
+        """
+        with self.index_lock:
+            value = self.indexed_values.pop(session_id, None)
+            if value is None:
+                return
+
+            session_ids = self.index.get(value)
+            if session_ids is not None:
+                session_ids.discard(session_id)
+                if not session_ids:
+                    del self.index[value]
+
+    def find_sessions(self, value):
+        """
+        Find the session_ids whose index_key is the given value, in time proportional to the result.
+
+        index_key の値が value であるsession_idを、該当するセッション数に比例する時間で探す
+
+        :param value: Value of index_key to look for, e.g. a user ID
+        :return: List of session_ids
+        """
+        with self.index_lock:
+            return list(self.index.get(value, ()))
+
+    def revoke_user(self, value):
+        """
+        Delete every session whose index_key is the given value ("log out everywhere").
+
+        index_key の値が value である全セッションを削除する(全端末からのログアウト)
+
+        :param value: Value of index_key, e.g. a user ID
+        :return: Number of sessions deleted
+        """
+        return self.delete_many(self.find_sessions(value))
+
+    def delete_store(self, session_id):
+        """
+        Delete the store for the given session_id.
+
+        与えられたsession_idのstoreを削除する
+
+        :param session_id: Session ID for which to delete the store
+        :return: True if the store existed and was deleted, False otherwise
+        """
+        if self.index_key is not None:
+            self.remove_from_index(session_id)
+        session_info = self.raw_memory_store.pop(session_id, None)
+        if session_info is None:
+            return False
+        self.scan_order.remove(session_id)
+        self.release_snapshot(session_info)
+        return True
+
+    def get_many(self, session_ids):
+        """
+        Get the stores for several session_ids at once.
+
+        複数のsession_idのstoreをまとめて取得する
+
+        :param session_ids: Session IDs for which to get the stores
+        :return: Dictionary of session_id to store, for the session_ids that exist
+        """
+        stores = {}
+        for session_id in session_ids:
+            session_store = self.get_store(session_id)
+            if session_store is not None:
+                stores[session_id] = session_store
+        return stores
+
+    def delete_many(self, session_ids):
+        """
+        Delete the stores for several session_ids at once.
+
+        複数のsession_idのstoreをまとめて削除する
+
+        :param session_ids: Session IDs for which to delete the stores
+        :return: Number of stores deleted
+        """
+        return sum(1 for session_id in session_ids if self.delete_store(session_id))
+
+    def export_session(self, session_id):
+        """
+        Get a session entry in the form yielded by iter_sessions, e.g. to move it to another store.
+        Like iter_sessions, a packed session is not re-inflated in the store.
+
+        iter_sessions と同じ形式でセッションのエントリを取得する(別のストアへの移動などに使う)。
+        iter_sessions と同様に、圧縮したセッションをストアの中で展開しない
+
+        :param session_id: Session ID to export
+        :return: {"created_at": UNIX time, "store": store}, or None if no such session exists
+        """
+        session_info = self.raw_memory_store.get(session_id)
+        if session_info is None:
+            return None
+        return {"created_at": session_info["created_at"], "store": self.peek_session_store(session_info)}
+
+    def iter_sessions(self, chunk_size=1000):
+        """
+        Iterate over all sessions, chunk by chunk, in creation order. Sessions created while iterating are not
+        yielded, sessions deleted while iterating are skipped. Packed sessions and sessions not yet decoded from
+        a snapshot are yielded as temporary dicts and stay packed in the store.
+
+        全セッションを作成順にチャンクごとに列挙する。
+        列挙中に作成されたセッションは含まれず、列挙中に削除されたセッションは飛ばす。
+        圧縮したセッションとスナップショットから未デコードのセッションは一時的な辞書として返し、ストアの中は圧縮したままにする
+
+        :param chunk_size: Number of sessions read from the store at a time
+        :return: Generator of (session_id, {"created_at": UNIX time, "store": store})
+        """
+        # 作成順をカーソルでたどり、キーを複製せずに chunk_size 件ずつ読む。
+        # 列挙中に作成されたセッションまで追いかけ続けないよう、開始時点の最後の作成順の番号で止める
+        self.reconcile_scan_order()
+        until = self.scan_order.last_seq()
+        cursor = 0
+        while True:
+            cursor, session_ids = self.scan_order.scan(cursor, chunk_size, until=until)
+            for session_id in session_ids:
+                session_info = self.raw_memory_store.get(session_id)
+                if session_info is not None:
+                    yield session_id, {"created_at": session_info["created_at"],
+                                       "store": self.peek_session_store(session_info)}
+            if cursor == 0:
+                return
+
+    def reconcile_scan_order(self):
+        """
+        Bring the creation order used by iter_sessions, sweep_expired and snapshot in line with raw_memory_store
+        when sessions were put into or removed from raw_memory_store directly. Costs O(1) while they agree.
+
+        raw_memory_store に直接置かれた・取り除かれたセッションがある場合に、iter_sessions、sweep_expired、
+        snapshot が使う作成順を raw_memory_store に合わせる。一致している間は O(1)
+        """
+        if len(self.scan_order) != len(self.raw_memory_store):
+            self.scan_order.reconcile(list(self.raw_memory_store))
+
+    def import_sessions(self, sessions, batch_size=1000):
+        """
+        Import sessions, as yielded by iter_sessions, writing them in batches.
+        Existing sessions with the same session_id are overwritten.
+
+        iter_sessions が返す形式のセッションをバッチごとに書き込む。
+        同じsession_idのセッションがある場合は上書きする
+
+        :param sessions: Iterable of (session_id, {"created_at": UNIX time, "store": store})
+        :param batch_size: Number of sessions written at a time
+        :return: Number of sessions imported
+        """
+        count = 0
+        batch = {}
+        for session_id, session_info in sessions:
+            session_store = session_info.get("store", {})
+            if self.max_session_bytes is not None:
+                session_store = self.new_session_dict(session_store)
+            batch[session_id] = {
+                "created_at": session_info.get("created_at", int(time.time())),
+                "store": session_store}
+            if len(batch) >= batch_size:
+                count += self.write_batch(batch)
+                batch = {}
+        if batch:
+            count += self.write_batch(batch)
+        return count
+
+    def write_batch(self, batch):
+        for session_id, session_info in batch.items():
+            # 上書きしたセッションのバージョンは進める
+            existing = self.raw_memory_store.get(session_id)
+            session_info["version"] = existing.get("version", 0) + 1 if existing is not None else 0
+            if existing is not None:
+                self.release_snapshot(existing)
+        self.raw_memory_store.update(batch)
+        for session_id in batch:
+            self.scan_order.add(session_id)
+        if self.index_key is not None:
+            for session_id, session_info in batch.items():
+                self.update_index(session_id, session_info["store"])
+        return len(batch)
+
+    def stats(self):
+        """
+        Statistics of the store. When a quota is configured, includes the total size of all sessions
+        and a histogram of session sizes.
+
+        ストアの統計情報。上限が設定されている場合は全セッションの合計サイズとサイズのヒストグラムを含む
+
+        :return: Dictionary of statistics
+        """
+        stats = {"sessions": len(self.raw_memory_store)}
+
+        if self.compress_idle_after is not None:
+            packed = [session_info["packed"] for session_info in list(self.raw_memory_store.values())
+                      if session_info.get("packed") is not None]
+            stats["packed_sessions"] = len(packed)
+            stats["packed_bytes"] = sum(len(payload) for payload, _ in packed)
+            stats["packed_raw_bytes"] = sum(raw_size for _, raw_size in packed)
+
+        if self.max_session_bytes is not None:
+            sizes = [self.session_size(session_info) for session_info in list(self.raw_memory_store.values())]
+            stats["total_bytes"] = sum(sizes)
+            stats["size_histogram"] = SizeHistogram.build(sizes)
+
+        return stats
+
+    @staticmethod
+    def session_size(session_info):
+        """
+        Size in bytes of a session for stats, without decoding it: the tracked size of a materialised session,
+        the encoded length of a packed one, the stored length of one not yet decoded from a snapshot.
+
+        stats 用のセッションのバイト数。デコードせずに求める。展開済のセッションは追跡している大きさ、
+        圧縮したセッションはエンコード後の長さ、スナップショットから未デコードのセッションは格納されている長さ
+        """
+        if session_info.get("packed") is not None:
+            return session_info["packed"][1]
+        if session_info.get("snapshot") is not None:
+            return session_info["snapshot"][2]
+        return getattr(session_info.get("store"), "size", 0)
+
     def gc(self):
         # メモリストアに100件以上のセッションデータがあるばあい、古いものを削除する
         if len(self.raw_memory_store) >= 100:
@@ -90,9 +660,122 @@ class MemoryStore:
     def cleanup_old_sessions(self):
         current_time = int(time.time())
         sessions_to_delete = []
-        for session_id, session_info in self.raw_memory_store.items():
-            if current_time - session_info["created_at"] > 3600 * 12:  # 作成から12時間を経過したセッションデータは削除する
+        # 他のスレッドがセッションを作成・削除しても反復が壊れないよう、スナップショットを取ってから調べる
+        for session_id, session_info in list(self.raw_memory_store.items()):
+            if current_time - session_info["created_at"] > self.max_session_age:  # 作成から期限(デフォルト12時間)を経過したセッションデータは削除する
                 sessions_to_delete.append(session_id)
 
-        for session_id in sessions_to_delete:
-            del self.raw_memory_store[session_id]
+        self.delete_many(sessions_to_delete)
+
+    def sweep_expired(self, cursor=None, limit=1000):
+        """
+        Delete the expired sessions among at most limit sessions, starting from cursor.
+        Calling it again with the returned cursor continues the sweep, so a large store is swept incrementally.
+
+        cursor の位置から最大 limit 件のセッションを調べ、期限切れのものを削除する。
+        返されたカーソルで呼び出し直すと続きから掃除するので、大きなストアも少しずつ掃除できる
+
+        :param cursor: Cursor returned by the previous call, None to start from the beginning
+        :param limit: Maximum number of sessions examined
+        :return: (number of sessions deleted, cursor to continue from, or None once the whole store was swept)
+        """
+        # カーソルは最後に調べたセッションの作成順の番号なので、どの位置からでも先頭から数え直さずに再開できる
+        if cursor is None:
+            self.reconcile_scan_order()  # 掃除の一巡ごとに、直接置かれたセッションも対象にする
+        cursor, session_ids = self.scan_order.scan(cursor or 0, limit)
+
+        current_time = int(time.time())
+        expired = []
+        for session_id in session_ids:
+            session_info = self.raw_memory_store.get(session_id)
+            if session_info is None:
+                self.scan_order.remove(session_id)  # raw_memory_store から直接取り除かれた
+            elif current_time - session_info["created_at"] > self.max_session_age:
+                expired.append(session_id)
+
+        return self.delete_many(expired), cursor or None
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Acquire the named lease record unless another owner holds it and it has not expired.
+        Shared stores implement this with an atomic conditional write.
+
+        別の所有者が期限内のリースを持っていなければ、名前付きのリースのレコードを取得する。
+        共有ストアでは不可分な条件付き書き込みで実装する
+
+        :return: Lease record {"owner", "expires_at", "checkpoint"}, or None if another owner holds it
+        """
+        with self.lease_lock:
+            lease = self.leases.get(name)
+            now = time.time()
+            if lease is not None and lease["owner"] not in (None, owner) and lease["expires_at"] > now:
+                return None
+
+            checkpoint = lease["checkpoint"] if lease is not None else None
+            self.leases[name] = {"owner": owner, "expires_at": now + ttl, "checkpoint": checkpoint}
+            return dict(self.leases[name])
+
+    def release_lease(self, name, owner, checkpoint=None):
+        """
+        Release the named lease record, keeping the checkpoint for the next owner.
+
+        名前付きのリースのレコードを解放し、次の所有者のためにチェックポイントを残す
+        """
+        with self.lease_lock:
+            lease = self.leases.get(name)
+            if lease is None or lease["owner"] != owner:
+                return  # 期限切れで他の所有者に移った
+            self.leases[name] = {"owner": None, "expires_at": 0, "checkpoint": checkpoint}
+
+    def snapshot(self, path):
+        """
+        Write all sessions to a compact binary snapshot file, streaming them one by one.
+        Sessions whose data is not JSON serialisable are skipped.
+
+        全セッションをコンパクトなバイナリのスナップショットファイルに1件ずつ書き出す。
+        JSONにできないデータを持つセッションは飛ばす
+
+        :param path: Snapshot file path
+        :return: Dictionary with the number of sessions "written" and "skipped"
+        """
+        return write_snapshot(path, self.iter_sessions(), index_key=self.index_key)
+
+    def restore(self, path):
+        """
+        Load sessions from a snapshot file written by snapshot. The file is memory-mapped and only the record
+        headers are read, each session is decoded lazily on first access. Expired sessions are skipped
+        and sessions already in the store are kept.
+
+        snapshot で書き出したスナップショットファイルからセッションを読み込む。
+        ファイルは mmap し、レコードのヘッダだけを読み、各セッションは最初のアクセス時にデコードする。
+        期限切れのセッションは読み飛ばし、既にストアにあるセッションはそのまま残す
+
+        :param path: Snapshot file path
+        :return: Number of sessions restored
+        """
+        reader = SnapshotReader(path)
+
+        current_time = int(time.time())
+        count = 0
+        with self.snapshot_lock:
+            # セッションが参照している間はスナップショットを開いたままにする
+            self.snapshot_readers[reader] = 1
+            for session_id, created_at, index_value, offset, length in reader.iter_records():
+                if current_time - created_at > self.max_session_age or session_id in self.raw_memory_store:
+                    continue
+
+                self.snapshot_readers[reader] += 1
+                self.raw_memory_store[session_id] = {
+                    "created_at": created_at,
+                    "store": None,
+                    "snapshot": (reader, offset, length)}
+                self.scan_order.add(session_id)
+
+                if self.index_key is not None and index_value is not None:
+                    self.update_index(session_id, {self.index_key: index_value})
+                count += 1
+
+            # 読み込み中の参照を外す(1件も読み込まなかった場合はここで閉じる)
+            self.unref_snapshot_reader(reader)
+
+        return count
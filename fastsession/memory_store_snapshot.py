@@ -0,0 +1,114 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+# スナップショットファイルの形式
+#   ヘッダ: MAGIC
+#   レコード(セッションごと): RECORD_HEADER(session_idの長さ, created_at, 索引値の長さ, ペイロードの長さ)
+#                             + session_id(UTF-8) + 索引値(JSON) + ペイロード(zlib圧縮したJSON)
+# Snapshot file format
+#   header: MAGIC
+#   record (one per session): RECORD_HEADER(session_id length, created_at, index value length, payload length)
+#                             + session_id (UTF-8) + index value (JSON) + payload (zlib-compressed JSON)
+MAGIC = b"FSSNAP\x01\x00"
+RECORD_HEADER = struct.Struct("<HqII")
+
+
+def decode_payload(payload):
+    return json.loads(zlib.decompress(payload))
+
+
+def write_snapshot(path, sessions, index_key=None):
+    """
+    Stream sessions to a compact binary snapshot file. The file is written to a temporary path
+    and renamed into place, so a crash never leaves a truncated snapshot behind. The temporary path is unique
+    to each call, so workers writing the same path do not clobber each other's temporary file.
+    Sessions whose data is not JSON serialisable are skipped.
+
+    セッションをコンパクトなバイナリのスナップショットファイルに逐次書き出す。
+    一時ファイルに書いてから置き換えるので、途中で落ちても壊れたスナップショットは残らない。
+    一時ファイルは書き出しごとに別の名前なので、同じパスに書き出す複数のワーカーが互いの一時ファイルを壊すことはない。
+    JSONにできないデータを持つセッションは飛ばす
+
+    :param path: Snapshot file path
+    :param sessions: Iterable of (session_id, {"created_at": UNIX time, "store": store})
+    :param index_key: Session key whose value is stored next to the payload so the index can be rebuilt lazily
+    :return: Dictionary with the number of sessions "written" and "skipped"
+    """
+    written = 0
+    skipped = 0
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{name}.", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(MAGIC)
+            for session_id, session_info in sessions:
+                session_store = session_info["store"]
+                try:
+                    payload = zlib.compress(json.dumps(session_store, separators=(",", ":")).encode("utf-8"))
+                    index_value = session_store.get(index_key) if index_key is not None else None
+                    index_bytes = json.dumps(index_value).encode("utf-8") if index_value is not None else b""
+                except (TypeError, ValueError):
+                    skipped += 1
+                    continue
+
+                session_id_bytes = session_id.encode("utf-8")
+                fp.write(RECORD_HEADER.pack(len(session_id_bytes), session_info["created_at"], len(index_bytes), len(payload)))
+                fp.write(session_id_bytes)
+                fp.write(index_bytes)
+                fp.write(payload)
+                written += 1
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        # 書き出しに失敗した一時ファイルは残さない
+        os.unlink(tmp_path)
+        raise
+
+    return {"written": written, "skipped": skipped}
+
+
+class SnapshotReader:
+    """
+    Memory-maps a snapshot file and reads record headers without touching the payloads.
+    Payloads are decoded one at a time with load_payload, when a session is first accessed.
+
+    スナップショットファイルを mmap し、ペイロードに触れずにレコードのヘッダだけを読む。
+    ペイロードはセッションに最初にアクセスしたときに load_payload で1件ずつデコードする
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.mm.close()
+            raise ValueError(f"'{path}' is not a session snapshot file")
+
+    def iter_records(self):
+        """
+        :return: Generator of (session_id, created_at, index_value, payload_offset, payload_length)
+        """
+        mm = self.mm
+        offset = len(MAGIC)
+        end = len(mm)
+
+        while offset + RECORD_HEADER.size <= end:
+            session_id_len, created_at, index_len, payload_len = RECORD_HEADER.unpack_from(mm, offset)
+            offset += RECORD_HEADER.size
+            session_id = mm[offset:offset + session_id_len].decode("utf-8")
+            offset += session_id_len
+            index_value = json.loads(mm[offset:offset + index_len]) if index_len else None
+            offset += index_len
+            yield session_id, created_at, index_value, offset, payload_len
+            offset += payload_len
+
+    def load_payload(self, offset, length):
+        return decode_payload(self.mm[offset:offset + length])
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Offloader:
+    """
+    Runs calls that encode or decode large session payloads in a bounded worker thread pool,
+    so they do not stall the event loop. Calls below the size threshold run inline to avoid the handoff
+    overhead, and the time they block the event loop is measured.
+
+    大きなセッションのペイロードをエンコード・デコードする呼び出しを、上限付きのワーカースレッドプールで実行し、
+    イベントループを止めないようにする。閾値未満の呼び出しは受け渡しのオーバーヘッドを避けるためその場で実行し、
+    イベントループを止めた時間を計測する
+    """
+
+    def __init__(self, threshold=64 * 1024, max_workers=4):
+        """
+        :param threshold: Payload size in bytes from which calls are offloaded
+        :param max_workers: Number of worker threads
+        """
+        self.threshold = threshold
+        self.max_workers = max_workers
+        self.executor = None  # 最初にオフロードするときに生成する
+        self.stats = {
+            "inline": 0,  # その場で実行した回数
+            "offloaded": 0,  # ワーカーで実行した回数
+            "inline_block_seconds": 0.0,  # その場で実行してイベントループを止めた合計時間
+            "max_inline_block_seconds": 0.0,  # その場で実行してイベントループを止めた最長時間
+        }
+
+    async def run(self, func, *args, size=0):
+        """
+        :param func: Function to call
+        :param args: Arguments of the function
+        :param size: Size in bytes of the payload the call will encode or decode
+        :return: Result of the function
+        """
+        if size < self.threshold:
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                blocked = time.perf_counter() - started
+                self.stats["inline"] += 1
+                self.stats["inline_block_seconds"] += blocked
+                self.stats["max_inline_block_seconds"] = max(self.stats["max_inline_block_seconds"], blocked)
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fastsession-offload")
+
+        self.stats["offloaded"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+# 推定で調べる要素数と深さの上限(大きなコンテナは先頭の要素から全体を見積もる)
+ESTIMATE_SAMPLE = 8
+ESTIMATE_MAX_DEPTH = 4
+
+
+def estimate_encoded_size(value, depth=0):
+    """
+    Cheap estimate of the JSON-encoded size in bytes of a value, without encoding it.
+    Large containers are estimated from their first ESTIMATE_SAMPLE elements, so the cost does not grow with the value.
+
+    値をエンコードせずに、JSONにエンコードしたときのバイト数を安く見積もる。
+    大きなコンテナは先頭の ESTIMATE_SAMPLE 個の要素から見積もるので、値が大きくても手間は増えない
+    """
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if value is None or isinstance(value, (bool, int, float)):
+        return 8
+    if depth >= ESTIMATE_MAX_DEPTH:
+        return 16
+
+    if isinstance(value, dict):
+        sample = list(itertools.islice(value.items(), ESTIMATE_SAMPLE))
+        sampled = sum(estimate_encoded_size(key, depth + 1) + estimate_encoded_size(item, depth + 1) + 2
+                      for key, item in sample)
+    elif isinstance(value, (list, tuple)):
+        sample = list(itertools.islice(value, ESTIMATE_SAMPLE))
+        sampled = sum(estimate_encoded_size(item, depth + 1) + 1 for item in sample)
+    else:
+        return 16
+
+    if not sample:
+        return 2
+    return 2 + sampled * len(value) // len(sample)
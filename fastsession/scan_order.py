@@ -0,0 +1,92 @@
+import bisect
+import threading
+
+
+class ScanOrder:
+    """
+    Keys of a store in creation order, for scans and sweeps that resume from a cursor.
+    Each key is given an increasing creation number and the cursor is the number of the last key examined,
+    so keys created or deleted between calls do not shift it, and resuming costs O(log n) whatever the position.
+    Deleted keys are left in place and dropped once they make up more than half of the entries.
+
+    カーソルから再開する走査や掃除のために、ストアのキーを作成順に保持する。
+    キーには増加する作成順の番号を付け、カーソルは最後に調べたキーの番号とする。
+    そのため呼び出しの間にキーが作成・削除されてもカーソルはずれず、どの位置からでも O(log n) で再開できる。
+    削除したキーはその場に残し、エントリの半分を超えたら取り除く
+    """
+
+    def __init__(self):
+        self.entries = []  # (作成順の番号, キー) を作成順に並べたもの。削除済のエントリも残る
+        self.seqs = {}  # キー -> 作成順の番号
+        self.next_seq = 1
+        self.removed_count = 0  # entries に残っている削除済のエントリ数
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        with self.lock:
+            if key in self.seqs:
+                return  # 上書き => 作成順は変えない
+            seq = self.next_seq
+            self.next_seq += 1
+            self.seqs[key] = seq
+            self.entries.append((seq, key))
+
+    def remove(self, key):
+        with self.lock:
+            if self.seqs.pop(key, None) is None:
+                return
+            self.removed_count += 1
+            if self.removed_count > len(self.entries) // 2:
+                # 番号の順は変わらないので、途中のカーソルもそのまま使える
+                self.entries = [(seq, key) for seq, key in self.entries if self.seqs.get(key) == seq]
+                self.removed_count = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.seqs)
+
+    def reconcile(self, keys):
+        """
+        Make the keys exactly the given keys: add the missing ones at the end, in the given order,
+        and remove the ones not given.
+
+        キーを与えたキーにちょうど一致させる。足りないキーは与えた順に末尾へ追加し、与えられなかったキーは取り除く
+        """
+        keys = dict.fromkeys(keys)
+        for key in keys:
+            self.add(key)
+        with self.lock:
+            stale = [key for key in self.seqs if key not in keys]
+        for key in stale:
+            self.remove(key)
+
+    def last_seq(self):
+        """
+        :return: Creation number of the last key added, to bound a scan to the keys present when it started
+        """
+        with self.lock:
+            return self.next_seq - 1
+
+    def scan(self, cursor, count, until=None):
+        """
+        Examine at most count entries after the cursor and return the live keys among them.
+        Every key present for the whole scan is returned exactly once.
+
+        カーソルより後のエントリを最大 count 件調べ、その中の削除されていないキーを返す。
+        走査の間ずっと存在するキーはちょうど1回ずつ返る
+
+        :param cursor: 0 to start, or the cursor returned by the previous call
+        :param count: Maximum number of entries examined
+        :param until: When set, the scan ends at this creation number (see last_seq)
+        :return: (next cursor or 0 when the scan is complete, list of keys)
+        """
+        with self.lock:
+            index = bisect.bisect_left(self.entries, (cursor + 1,))
+            limit = len(self.entries) if until is None else bisect.bisect_left(self.entries, (until + 1,))
+            end = min(index + count, limit)
+            keys = []
+            for seq, key in self.entries[index:end]:
+                if self.seqs.get(key) == seq:
+                    keys.append(key)
+                cursor = seq
+            return (cursor if end < limit else 0), keys
@@ -0,0 +1,417 @@
+import copy
+import json
+import socket
+import threading
+import time
+import weakref
+import zlib
+
+from .offload import estimate_encoded_size
+from .session_protocol import (CREATED_AT, CURSOR, FRAME_HEADER, MAX_FRAME_LENGTH, OP_ACQUIRE_LEASE, OP_DELETE,
+                               OP_EXISTS, OP_GET, OP_GET_VERSIONED, OP_RELEASE_LEASE, OP_SCAN, OP_SET, OP_SET_IF_VERSION,
+                               OP_SWEEP, OP_SWEEP_EXPIRED, OP_TOUCH, SCAN_ARGS, STATUS_ERROR, STATUS_OK, SWEEP_RESULT, U32,
+                               VERSION, default_socket_path, decode_response, encode_request)
+
+
+class SessionServerError(Exception):
+    """
+    Raised when the session server reports an error.
+
+    セッションサーバーがエラーを返した場合に送出される
+    """
+
+
+class StaleConnection(Exception):
+    """
+    Raised inside pipeline when a reused connection turns out to be closed before the server saw the request.
+
+    再利用した接続が、サーバーがリクエストを受け取る前に閉じていたと分かった場合に pipeline の内部で送出される
+    """
+
+
+class RemoteSession(dict):
+    """
+    Session dict fetched from the session server. flush sends it back only if it changed since it was fetched.
+
+    セッションサーバーから取得したセッションの辞書。flush は取得後に変更があった場合だけ送り返す
+    """
+
+    def __init__(self, store, session_id, created_at, data=None, encoded=None):
+        super().__init__(data or {})
+        self.store = store
+        self.session_id = session_id
+        self.created_at = created_at
+        self.encoded = encoded  # 取得時(または最後に送った)エンコード結果
+
+    def fork(self):
+        """
+        Make an independent copy that flushes against the same fetched encoding.
+
+        取得時と同じエンコード結果と比較して flush する、独立した複製を作る
+        """
+        session = RemoteSession(self.store, self.session_id, self.created_at, copy.deepcopy(dict(self)), self.encoded)
+        self.store.open_sessions[id(session)] = session
+        return session
+
+    def pending_payload_size(self):
+        # 読み込み後に書き込まれた値も含めるよう、現在の内容から見積もる
+        return estimate_encoded_size(self)
+
+    def flush(self):
+        encoded = self.store.encode(self)
+        if encoded == self.encoded:
+            return
+        self.store.execute([(OP_SET, self.session_id, CREATED_AT.pack(self.created_at) + encoded)])
+        self.encoded = encoded
+
+
+class SessionClientStore:
+    """
+    Store backed by the local session server (python -m fastsession.session_server), so that all worker
+    processes of a host share sessions without an external database. Implements the MemoryStore interface.
+    Connections to the server are reused, and operations on several sessions are sent as one batch.
+
+    ローカルのセッションサーバー(python -m fastsession.session_server)を使うストア。
+    外部のデータベースなしに、同じホストの全ワーカープロセスでセッションを共有できる。MemoryStore のインターフェイスを実装する。
+    サーバーへの接続は再利用し、複数セッションへの操作は1つのバッチで送る
+    """
+
+    def __init__(self, path=None, max_connections=8, timeout=5.0, compress_min_size=1024):
+        """
+        :param path: Unix domain socket path of the session server. Defaults to default_socket_path()
+        :param max_connections: Number of idle connections kept for reuse
+        :param timeout: Socket timeout in seconds
+        :param compress_min_size: Session data of this many bytes or more is compressed
+        """
+        self.path = path or default_socket_path()
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.compress_min_size = compress_min_size
+        self.idle_connections = []
+        self.lock = threading.Lock()
+        self.open_sessions = weakref.WeakValueDictionary()  # id -> save_store で書き戻すための、使用中の取得済セッション
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def acquire_connection(self):
+        """
+        :return: (socket, True if it is an idle connection being reused)
+        """
+        with self.lock:
+            if self.idle_connections:
+                return self.idle_connections.pop(), True
+        return self.connect(), False
+
+    def release_connection(self, sock):
+        with self.lock:
+            if len(self.idle_connections) < self.max_connections:
+                self.idle_connections.append(sock)
+                return
+        sock.close()
+
+    def close(self):
+        with self.lock:
+            connections, self.idle_connections = self.idle_connections, []
+        for sock in connections:
+            sock.close()
+
+    @staticmethod
+    def read_exactly(sock, length):
+        chunks = []
+        while length > 0:
+            chunk = sock.recv(min(length, 1 << 16))
+            if not chunk:
+                raise ConnectionError("session server closed the connection")
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b"".join(chunks)
+
+    def execute(self, ops):
+        """
+        Send a batch of operations in one frame and return their results.
+
+        操作のバッチを1つのフレームで送り、結果を返す
+
+        :param ops: List of (opcode, session_id, payload bytes)
+        :return: List of (status, payload bytes)
+        """
+        return self.pipeline([ops])[0]
+
+    def pipeline(self, batches):
+        """
+        Send several batches back to back without waiting for replies, then read the replies in order.
+        The batches are retried once on a new connection only if a reused connection proved closed before
+        the server could have received them: the send failed with a reset or broken pipe, or the server
+        closed the connection cleanly before sending any reply byte. Once a request may have reached the
+        server, e.g. on a timeout, the error is raised so writes are never applied twice.
+
+        複数のバッチを応答を待たずに続けて送り、その後で応答を順に読む。
+        再利用した接続がサーバーに届く前に閉じていたと分かる場合に限り、新しい接続で1回だけ再試行する。
+        すなわち送信がリセットやブロークンパイプで失敗した場合か、サーバーが応答を1バイトも送らずに接続を正常に閉じた場合である。
+        タイムアウトなどリクエストがサーバーに届いた可能性がある場合は、書き込みを2回適用しないよう例外を送出する
+
+        :param batches: List of batches, each a list of (opcode, session_id, payload bytes)
+        :return: List of results per batch, each a list of (status, payload bytes)
+        """
+        frames = [encode_request(ops) for ops in batches]
+        for frame in frames:
+            if len(frame) - FRAME_HEADER.size > MAX_FRAME_LENGTH:
+                raise SessionServerError(f"batch of {len(frame)} bytes exceeds the maximum frame length")
+        frames = b"".join(frames)
+        sock, reused = self.acquire_connection()
+        try:
+            try:
+                replies = self.exchange(sock, frames, len(batches))
+            except StaleConnection:
+                if not reused:
+                    raise
+                # 再試行では、同じように切れているかもしれない他のアイドル接続を使わない
+                sock.close()
+                sock = self.connect()
+                replies = self.exchange(sock, frames, len(batches))
+        except StaleConnection as exc:
+            sock.close()
+            raise ConnectionError("session server closed the connection") from exc
+        except BaseException:
+            sock.close()
+            raise
+
+        self.release_connection(sock)
+        for results in replies:
+            for status, payload in results:
+                if status == STATUS_ERROR:
+                    raise SessionServerError(payload.decode("utf-8"))
+        return replies
+
+    def exchange(self, sock, frames, count):
+        """
+        Send the frames and read count replies. Raises StaleConnection only when the server cannot
+        have received the request.
+
+        フレームを送り、count 件の応答を読む。サーバーがリクエストを受け取っていないと言える場合に限り StaleConnection を送出する
+        """
+        try:
+            sock.sendall(frames)
+        except (BrokenPipeError, ConnectionResetError) as exc:
+            raise StaleConnection() from exc
+        first = sock.recv(FRAME_HEADER.size)
+        if not first:
+            raise StaleConnection()  # 応答前の正常なEOF => 相手は既に閉じていた
+        replies = []
+        header = first + self.read_exactly(sock, FRAME_HEADER.size - len(first))
+        for index in range(count):
+            if index:
+                header = self.read_exactly(sock, FRAME_HEADER.size)
+            (length,) = FRAME_HEADER.unpack(header)
+            replies.append(decode_response(self.read_exactly(sock, length)))
+        return replies
+
+    def encode(self, data):
+        encoded = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        if len(encoded) >= self.compress_min_size:
+            return b"z" + zlib.compress(encoded)
+        return b"j" + encoded
+
+    @staticmethod
+    def decode(encoded):
+        if encoded[:1] == b"z":
+            return json.loads(zlib.decompress(encoded[1:]))
+        return json.loads(encoded[1:])
+
+    def fetch_store_payload(self, session_id):
+        """
+        Fetch the encoded session from the server without decoding it, so the caller can decode it
+        with load_store_payload, e.g. in a worker thread when the payload is large.
+
+        セッションをデコードせずにサーバーから取得する。呼び出し側は load_store_payload でデコードする
+        (ペイロードが大きければワーカースレッドでなど)
+
+        :return: Payload bytes, or None if no such session exists
+        """
+        (status, payload), = self.execute([(OP_GET, session_id, b"")])
+        return payload if status == STATUS_OK else None
+
+    def load_store_payload(self, session_id, payload):
+        """
+        Decode a payload fetched with fetch_store_payload into the session's store.
+
+        fetch_store_payload で取得したペイロードをセッションのstoreにデコードする
+        """
+        (created_at,) = CREATED_AT.unpack_from(payload, 0)
+        encoded = payload[CREATED_AT.size:]
+        session = RemoteSession(self, session_id, created_at, self.decode(encoded), encoded)
+        self.open_sessions[id(session)] = session
+        return session
+
+    def has_session_id(self, session_id):
+        return self.count_existing([session_id]) == 1
+
+    def has_no_session_id(self, session_id):
+        return not self.has_session_id(session_id)
+
+    def create_store(self, session_id):
+        session = RemoteSession(self, session_id, int(time.time()))
+        session.flush()
+        self.open_sessions[id(session)] = session
+        return session
+
+    def get_store(self, session_id):
+        return self.get_many([session_id]).get(session_id)
+
+    def get_store_versioned(self, session_id):
+        """
+        Get a private copy of the store for the given session_id together with its version on the server.
+        Changes to the copy are persisted with save_store_if_version.
+
+        与えられたsession_idのstoreの複製を、サーバー上のバージョンとともに取得する。
+        複製への変更は save_store_if_version で永続化する
+
+        :return: (store, version), or (None, None) if no such store exists
+        """
+        (status, payload), = self.execute([(OP_GET_VERSIONED, session_id, b"")])
+        if status != STATUS_OK:
+            return None, None
+        (version,) = VERSION.unpack_from(payload, CREATED_AT.size)
+        return self.decode(payload[CREATED_AT.size + VERSION.size:]), version
+
+    def save_store_if_version(self, session_id, session_store, expected_version):
+        """
+        Persist the store for the given session_id only if its version on the server is still expected_version.
+        The server compares and writes in one operation, so the check holds across worker processes.
+
+        サーバー上のバージョンが expected_version のままの場合に限り、与えられたsession_idのstoreを永続化する。
+        サーバーは比較と書き込みを1つの操作で行うので、ワーカープロセスをまたいでも成り立つ
+
+        :return: New version, or None if the version changed or the session no longer exists
+        """
+        payload = VERSION.pack(expected_version) + self.encode(dict(session_store))
+        (status, payload), = self.execute([(OP_SET_IF_VERSION, session_id, payload)])
+        if status != STATUS_OK:
+            return None
+        return VERSION.unpack(payload)[0]
+
+    def save_store(self, session_id):
+        for session in list(self.open_sessions.values()):
+            if session.session_id == session_id:
+                session.flush()
+
+    def delete_store(self, session_id):
+        return self.delete_many([session_id]) == 1
+
+    def get_many(self, session_ids):
+        session_ids = list(session_ids)
+        if not session_ids:
+            return {}
+        results = self.execute([(OP_GET, session_id, b"") for session_id in session_ids])
+        return {session_id: self.load_store_payload(session_id, payload)
+                for session_id, (status, payload) in zip(session_ids, results) if status == STATUS_OK}
+
+    def delete_many(self, session_ids):
+        session_ids = list(session_ids)
+        if not session_ids:
+            return 0
+        results = self.execute([(OP_DELETE, session_id, b"") for session_id in session_ids])
+        return sum(1 for status, _ in results if status == STATUS_OK)
+
+    def count_existing(self, session_ids):
+        """
+        Check several sessions for existence in one batch, without fetching their data.
+
+        複数のセッションの存在を、データを取得せずに1つのバッチで確認する
+
+        :return: Number of sessions that exist
+        """
+        session_ids = list(session_ids)
+        if not session_ids:
+            return 0
+        results = self.execute([(OP_EXISTS, session_id, b"") for session_id in session_ids])
+        return sum(1 for status, _ in results if status == STATUS_OK)
+
+    def touch_many(self, session_ids):
+        """
+        Refresh the last access time of several sessions in one batch without fetching them,
+        so they are not expired by a server started with max_idle.
+
+        複数のセッションの最終アクセス時刻を、取得せずに1つのバッチで更新する。
+        max_idle を指定して起動したサーバーで期限切れにならないようにする
+
+        :return: Number of sessions that exist and were refreshed
+        """
+        session_ids = list(session_ids)
+        if not session_ids:
+            return 0
+        results = self.execute([(OP_TOUCH, session_id, b"") for session_id in session_ids])
+        return sum(1 for status, _ in results if status == STATUS_OK)
+
+    def export_session(self, session_id):
+        session = self.get_store(session_id)
+        if session is None:
+            return None
+        return {"created_at": session.created_at, "store": session}
+
+    def iter_sessions(self, chunk_size=1000):
+        cursor = 0
+        while True:
+            (_, payload), = self.execute([(OP_SCAN, "", SCAN_ARGS.pack(cursor, chunk_size))])
+            (cursor,) = CURSOR.unpack_from(payload, 0)
+            session_ids = [session_id for session_id in payload[CURSOR.size:].decode("utf-8").split("\n") if session_id]
+            for session_id, session in self.get_many(session_ids).items():
+                yield session_id, {"created_at": session.created_at, "store": session}
+            if cursor == 0:
+                return
+
+    def import_sessions(self, sessions, batch_size=1000):
+        count = 0
+        batch = []
+        for session_id, session_info in sessions:
+            created_at = session_info.get("created_at", int(time.time()))
+            batch.append((OP_SET, session_id, CREATED_AT.pack(created_at) + self.encode(session_info.get("store", {}))))
+            if len(batch) >= batch_size:
+                count += len(self.execute(batch))
+                batch = []
+        if batch:
+            count += len(self.execute(batch))
+        return count
+
+    def gc(self):
+        (_, payload), = self.execute([(OP_SWEEP, "", b"")])
+        return U32.unpack(payload)[0]
+
+    def sweep_expired(self, cursor=None, limit=1000):
+        """
+        Delete the expired sessions among at most limit sessions on the server, starting from cursor.
+
+        サーバーの cursor の位置から最大 limit 件のセッションを調べ、期限切れのものを削除する
+
+        :return: (number of sessions deleted, cursor to continue from, or None once the whole server was swept)
+        """
+        (_, payload), = self.execute([(OP_SWEEP_EXPIRED, "", SCAN_ARGS.pack(cursor or 0, limit))])
+        deleted, cursor = SWEEP_RESULT.unpack(payload)
+        return deleted, cursor or None
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Acquire the named lease record on the server unless another owner holds it and it has not expired.
+
+        別の所有者が期限内のリースを持っていなければ、サーバー上の名前付きのリースのレコードを取得する
+
+        :return: Lease record {"owner", "expires_at", "checkpoint"}, or None if another owner holds it
+        """
+        args = json.dumps({"owner": owner, "ttl": ttl}).encode("utf-8")
+        (status, payload), = self.execute([(OP_ACQUIRE_LEASE, name, args)])
+        if status != STATUS_OK:
+            return None
+        return json.loads(payload)
+
+    def release_lease(self, name, owner, checkpoint=None):
+        """
+        Release the named lease record on the server, keeping the checkpoint for the next owner.
+
+        サーバー上の名前付きのリースのレコードを解放し、次の所有者のためにチェックポイントを残す
+        """
+        args = json.dumps({"owner": owner, "checkpoint": checkpoint}).encode("utf-8")
+        self.execute([(OP_RELEASE_LEASE, name, args)])
@@ -0,0 +1,53 @@
+MERGE = "merge"  # 他のリクエストの変更に、このリクエストで変更したトップレベルのキーを重ねる(デフォルト)
+OVERWRITE = "overwrite"  # このリクエストの内容で上書きする(後勝ち)
+DISCARD = "discard"  # このリクエストの変更を捨て、他のリクエストの変更を残す(先勝ち)
+
+CONFLICT_POLICIES = (MERGE, OVERWRITE, DISCARD)
+
+
+def check_conflict_policy(policy):
+    if not callable(policy) and policy not in CONFLICT_POLICIES:
+        raise ValueError(f"conflict_policy must be one of {CONFLICT_POLICIES} or a callable, got '{policy}'")
+    return policy
+
+
+def merge_sessions(base, mine, theirs):
+    """
+    Three-way merge of sessions on their top-level keys. The keys this request added, changed or deleted
+    since it loaded the session are applied on top of the session saved by another request.
+    When both changed the same key, this request's value wins.
+
+    セッションのトップレベルのキーで3方向マージする。このリクエストが読み込んでから追加・変更・削除したキーを、
+    他のリクエストが保存したセッションに重ねる。同じキーを両方が変更した場合はこのリクエストの値を採る
+
+    :param base: Session as this request loaded it
+    :param mine: Session as this request left it
+    :param theirs: Session as currently saved in the store
+    :return: Merged session dictionary
+    """
+    merged = dict(theirs)
+    for key, value in mine.items():
+        if key not in base or base[key] != value:
+            merged[key] = value
+    for key in base:
+        if key not in mine:
+            merged.pop(key, None)
+    return merged
+
+
+def resolve_conflict(policy, base, mine, theirs):
+    """
+    Decide what to save when another request saved the session since this request loaded it.
+
+    このリクエストが読み込んだ後に他のリクエストがセッションを保存していた場合に、何を保存するかを決める
+
+    :param policy: "merge", "overwrite", "discard", or a callable (base, mine, theirs) -> session dictionary or None
+    :return: Session dictionary to save, or None to discard this request's changes
+    """
+    if policy == MERGE:
+        return merge_sessions(base, mine, theirs)
+    if policy == OVERWRITE:
+        return dict(mine)
+    if policy == DISCARD:
+        return None
+    return policy(base, mine, theirs)
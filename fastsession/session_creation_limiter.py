@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate` tokens per second up to `capacity` tokens.
+
+    1秒あたり rate 個のトークンが capacity 個まで補充されるトークンバケット
+    """
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        """
+        Add the tokens accumulated since the last refill.
+
+        前回の補充以降にたまったトークンを補充する
+        """
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def has_token(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SessionCreationLimiter:
+    """
+    Limits how often new sessions are created, with a token bucket per client plus a global budget.
+    Requests over the limit should be served with a transient session that is never persisted.
+
+    クライアントごとのトークンバケットと全体の予算で、新規セッションの生成頻度を制限する。
+    制限を超えたリクエストには永続化されない一時的なセッションを割り当てることを想定している。
+    """
+
+    def __init__(self,
+                 per_client_rate=1.0,  # クライアントごとに1秒あたり生成できるセッション数。None で無制限
+                 per_client_burst=20,  # クライアントごとに一度に生成できるセッション数
+                 global_rate=100.0,  # 全体で1秒あたり生成できるセッション数。None で無制限
+                 global_burst=1000,  # 全体で一度に生成できるセッション数
+                 max_clients=10000,  # 保持するクライアントごとのバケットの上限(古いものから捨てる)
+                 client_key=None):  # scope からクライアントを識別するキーを返す関数。省略時はクライアントのIPアドレス
+
+        self.per_client_rate = per_client_rate
+        self.per_client_burst = per_client_burst
+        self.max_clients = max_clients
+        self.client_key = client_key if client_key is not None else self.client_address
+        self.client_buckets = OrderedDict()
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate is not None else None
+        self.lock = threading.Lock()
+        self.stats = {
+            "allowed": 0,  # 生成を許可した回数
+            "limited_by_client": 0,  # クライアントごとの制限で拒否した回数
+            "limited_by_global": 0,  # 全体の予算で拒否した回数
+        }
+
+    @staticmethod
+    def client_address(scope):
+        """
+        Default client key: the client IP address from the ASGI scope.
+
+        デフォルトのクライアント識別キー。ASGI scope のクライアントIPアドレス
+        """
+        client = scope.get("client")
+        return client[0] if client else None
+
+    def get_client_bucket(self, key, now):
+        bucket = self.client_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.per_client_rate, self.per_client_burst, now=now)
+            self.client_buckets[key] = bucket
+            if len(self.client_buckets) > self.max_clients:
+                self.client_buckets.popitem(last=False)  # 最も長く使われていないバケットを捨てる
+        else:
+            self.client_buckets.move_to_end(key)
+        return bucket
+
+    def allow(self, scope):
+        """
+        Check whether a new session may be created for the request and consume a token if so.
+
+        リクエストに対して新規セッションを生成してよいか判定し、よければトークンを消費する
+
+        :param scope: ASGI scope of the request
+        :return: True if a new session may be created, False if over the limit
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            client_bucket = None
+            if self.per_client_rate is not None:
+                client_bucket = self.get_client_bucket(self.client_key(scope), now)
+                if not client_bucket.has_token(now):
+                    self.stats["limited_by_client"] += 1
+                    return False
+
+            if self.global_bucket is not None and not self.global_bucket.has_token(now):
+                self.stats["limited_by_global"] += 1
+                return False
+
+            # 両方のバケットにトークンがあることを確認してから消費する
+            if client_bucket is not None:
+                client_bucket.take()
+            if self.global_bucket is not None:
+                self.global_bucket.take()
+
+            self.stats["allowed"] += 1
+            return True
@@ -0,0 +1,70 @@
+import importlib
+import json
+
+
+def export_sessions(store, fp, chunk_size=1000):
+    """
+    Write every session of the store to fp as NDJSON, one session per line.
+    Sessions are streamed chunk by chunk so memory use does not grow with the number of sessions.
+
+    ストアの全セッションを1行1セッションのNDJSONとして fp に書き出す。
+    チャンクごとに流すので、セッション数が増えてもメモリ使用量は増えない
+
+    :param store: Store implementing iter_sessions
+    :param fp: Text file object to write to
+    :param chunk_size: Number of sessions read from the store at a time
+    :return: Number of sessions exported
+    """
+    count = 0
+    for session_id, session_info in store.iter_sessions(chunk_size=chunk_size):
+        line = {"session_id": session_id, "created_at": session_info["created_at"], "store": session_info["store"]}
+        fp.write(json.dumps(line, separators=(",", ":")) + "\n")
+        count += 1
+    return count
+
+
+def read_sessions(fp):
+    """
+    Read sessions written by export_sessions lazily, line by line.
+
+    export_sessions が書き出したセッションを1行ずつ読み出す
+
+    :param fp: Text file object to read from
+    :return: Generator of (session_id, {"created_at": UNIX time, "store": store})
+    """
+    for line in fp:
+        line = line.strip()
+        if not line:
+            continue
+        obj = json.loads(line)
+        yield obj["session_id"], {"created_at": obj["created_at"], "store": obj["store"]}
+
+
+def import_sessions(store, fp, batch_size=1000):
+    """
+    Import sessions written by export_sessions into the store, in batches.
+
+    export_sessions が書き出したセッションをバッチごとにストアに取り込む
+
+    :param store: Store implementing import_sessions
+    :param fp: Text file object to read from
+    :param batch_size: Number of sessions written at a time
+    :return: Number of sessions imported
+    """
+    return store.import_sessions(read_sessions(fp), batch_size=batch_size)
+
+
+def load_store(spec):
+    """
+    Load a store object from a "module:attribute" spec, e.g. "myapp.sessions:store".
+
+    "module:attribute" 形式の指定からストアオブジェクトを読み込む。例 "myapp.sessions:store"
+    """
+    module_name, sep, attr = spec.partition(":")
+    if not sep or not attr:
+        raise ValueError(f"store must be given as 'module:attribute', got '{spec}'")
+
+    obj = importlib.import_module(module_name)
+    for name in attr.split("."):
+        obj = getattr(obj, name)
+    return obj
@@ -0,0 +1,122 @@
+from starlette.routing import Host, Match, Mount
+
+# ルートごとのセッションの扱い
+NONE = "none"  # セッションを一切扱わない
+READ_ONLY = "read_only"  # 既存のセッションを読むだけ(生成・書き戻しをしない)
+READ_WRITE = "read_write"  # 通常のセッション管理(デフォルト)
+
+POLICIES = (NONE, READ_ONLY, READ_WRITE)
+
+POLICY_ATTRIBUTE = "__fastsession_policy__"
+
+
+def check_policy(policy):
+    if policy not in POLICIES:
+        raise ValueError(f"session policy must be one of {POLICIES}, got '{policy}'")
+    return policy
+
+
+def session_policy(policy):
+    """
+    Route decorator declaring how the session middleware treats requests to the endpoint.
+
+    エンドポイントへのリクエストをセッションミドルウェアがどう扱うかを宣言するデコレータ
+
+    @app.get("/items")
+    @session_policy("read_only")
+    async def items(request: Request): ...
+
+    :param policy: "none", "read_only" or "read_write"
+    """
+    check_policy(policy)
+
+    def decorator(endpoint):
+        setattr(endpoint, POLICY_ATTRIBUTE, policy)
+        return endpoint
+
+    return decorator
+
+
+class SessionPolicy:
+    """
+    FastAPI dependency declaring the session policy of a route or router.
+
+    ルートまたはルーターのセッションの扱いを宣言する FastAPI の依存関係
+
+    @app.get("/items", dependencies=[Depends(SessionPolicy("read_only"))])
+    """
+
+    def __init__(self, policy):
+        self.policy = check_policy(policy)
+
+    def __call__(self):
+        return None
+
+
+def get_route_policy(route):
+    """
+    :return: Session policy declared on the route, or None if it has none
+    """
+    policy = getattr(getattr(route, "endpoint", None), POLICY_ATTRIBUTE, None)
+    if policy is not None:
+        return policy
+
+    # FastAPI のルート(ルーターの dependencies もルートに引き継がれている)
+    for dependency in getattr(route, "dependencies", None) or ():
+        if isinstance(getattr(dependency, "dependency", None), SessionPolicy):
+            policy = dependency.dependency.policy
+    return policy
+
+
+def iter_routes(routes):
+    """
+    Iterate the routes in matching order, expanding routers included with FastAPI's include_router.
+    """
+    for route in routes:
+        if callable(getattr(route, "effective_route_contexts", None)):
+            # 新しい FastAPI ではインクルードしたルーターがまとめて1つのルートになっている
+            # => ルーターの依存関係を引き継いだ個々のルートに展開する
+            yield from route.effective_route_contexts()
+        else:
+            yield route
+
+
+def resolve_route_policies(routes):
+    """
+    Resolve the session policy of each route once. Routes after the last one declaring a non-default policy
+    are dropped, so when no route declares one, requests are not matched at all.
+    Earlier default routes are kept so that matching follows the router's order.
+    The routes of a mounted router (Mount or Host) are resolved the same way and kept under the mount.
+
+    各ルートのセッションの扱いを一度だけ解決する。デフォルト以外を宣言した最後のルートより後ろのルートは除くので、
+    どのルートも宣言していなければリクエストの照合は一切行わない。
+    照合がルーターと同じ順になるよう、それより前のデフォルトのルートは残す。
+    マウントしたルーター(Mount や Host)のルートも同じように解決し、マウントの下に持つ
+
+    :param routes: Routes of the application router
+    :return: List of (route, policy), policy being the resolved list of the mounted routes for a mount
+    """
+    resolved = []
+    for route in iter_routes(routes):
+        if isinstance(route, (Mount, Host)):
+            # マウントの中で何も宣言していなければデフォルトのルートと同じ扱い
+            resolved.append((route, resolve_route_policies(route.routes) or READ_WRITE))
+        else:
+            resolved.append((route, get_route_policy(route) or READ_WRITE))
+    while resolved and resolved[-1][1] == READ_WRITE:
+        resolved.pop()
+    return resolved
+
+
+def match_route_policy(route_policies, scope):
+    """
+    :return: Session policy of the route matching the request, READ_WRITE if none matches
+    """
+    for route, policy in route_policies:
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            if isinstance(policy, list):
+                # マウントの中のルートは、ルーターと同じくマウントのパスを除いたスコープで照合する
+                return match_route_policy(policy, {**scope, **child_scope})
+            return policy
+    return READ_WRITE
@@ -0,0 +1,131 @@
+import os
+import struct
+import tempfile
+
+# セッションサーバーのプロトコル
+#   フレーム: 長さ(u32) + 本体。クライアントは応答を待たずに複数のフレームを送ってよく(パイプライン)、
+#             サーバーは受け取った順に応答する
+#   要求の本体: 操作数(u16) + 操作ごとに 操作コード(u8), session_idの長さ(u16), session_id, ペイロードの長さ(u32), ペイロード
+#   応答の本体: 結果数(u16) + 結果ごとに 状態(u8), ペイロードの長さ(u32), ペイロード
+#   不正な操作は STATUS_ERROR とエラーメッセージを返し、同じバッチの他の操作はそのまま実行する。
+#   MAX_FRAME_LENGTH を超えるフレームにはエラーを返して接続を閉じる
+# Session server protocol
+#   frame: length (u32) + body. Clients may send several frames without waiting for replies (pipelining),
+#          the server replies in the order frames were received
+#   request body: number of ops (u16) + per op: opcode (u8), session_id length (u16), session_id, payload length (u32), payload
+#   response body: number of results (u16) + per result: status (u8), payload length (u32), payload
+#   a malformed op gets STATUS_ERROR with the error message, the other ops of the batch still run.
+#   A frame longer than MAX_FRAME_LENGTH gets an error and the connection is closed
+
+OP_GET = 1  # ペイロード: なし / 応答: created_at(i64) + セッションデータ
+OP_SET = 2  # ペイロード: created_at(i64) + セッションデータ。無ければ作成する。バージョンを進める
+OP_EXISTS = 3  # ペイロード: なし / 応答: 状態のみ(STATUS_OK なら存在する)
+OP_DELETE = 4  # ペイロード: なし / 応答: 状態のみ
+OP_SCAN = 5  # ペイロード: カーソル(u64) + 件数(u32) / 応答: 次のカーソル(u64、0なら終わり) + 改行区切りのsession_id
+OP_SWEEP = 6  # ペイロード: なし / 応答: 削除した件数(u32)
+OP_SWEEP_EXPIRED = 7  # ペイロード: カーソル(u64) + 件数(u32) / 応答: 削除した件数(u32) + 次のカーソル(u64、0なら終わり)
+OP_ACQUIRE_LEASE = 8  # session_id: リース名 / ペイロード: {"owner", "ttl"} のJSON / 応答: リースのレコードのJSON。他の所有者が持っていれば STATUS_CONFLICT
+OP_RELEASE_LEASE = 9  # session_id: リース名 / ペイロード: {"owner", "checkpoint"} のJSON / 応答: 状態のみ
+OP_GET_VERSIONED = 10  # ペイロード: なし / 応答: created_at(i64) + バージョン(u64) + セッションデータ
+OP_SET_IF_VERSION = 11  # ペイロード: 期待するバージョン(u64) + セッションデータ / 応答: 新しいバージョン(u64)。バージョンが違えば STATUS_CONFLICT
+OP_TOUCH = 12  # ペイロード: なし / 応答: 状態のみ(最終アクセス時刻を更新し、max_idle による期限を延ばす)
+
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_ERROR = 2
+STATUS_CONFLICT = 3
+
+MAX_FRAME_LENGTH = 64 * 1024 * 1024  # サーバーが受け付けるフレーム本体の最大長。長さだけ大きく宣言した接続にメモリを確保しない
+
+FRAME_HEADER = struct.Struct("<I")
+COUNT = struct.Struct("<H")
+OP_HEADER = struct.Struct("<BH")
+RESULT_HEADER = struct.Struct("<BI")
+PAYLOAD_LENGTH = struct.Struct("<I")
+CREATED_AT = struct.Struct("<q")
+SCAN_ARGS = struct.Struct("<QI")
+CURSOR = struct.Struct("<Q")
+VERSION = struct.Struct("<Q")
+SWEEP_RESULT = struct.Struct("<IQ")
+U32 = struct.Struct("<I")
+
+
+def default_socket_path():
+    """
+    Default Unix domain socket path of the session server, in a directory private to the current user:
+    $XDG_RUNTIME_DIR if set, otherwise a per-user directory under the temporary directory.
+
+    セッションサーバーのデフォルトの Unix ドメインソケットのパス。現在のユーザー専用のディレクトリに置く。
+    $XDG_RUNTIME_DIR があればそこに、無ければ一時ディレクトリの下のユーザーごとのディレクトリに置く
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "fastsession.sock")
+    return os.path.join(tempfile.gettempdir(), f"fastsession-{os.getuid()}", "fastsession.sock")
+
+
+def encode_request(ops):
+    """
+    :param ops: List of (opcode, session_id, payload bytes)
+    :return: Frame bytes
+    """
+    parts = [COUNT.pack(len(ops))]
+    for op, session_id, payload in ops:
+        session_id_bytes = session_id.encode("utf-8")
+        parts.append(OP_HEADER.pack(op, len(session_id_bytes)))
+        parts.append(session_id_bytes)
+        parts.append(PAYLOAD_LENGTH.pack(len(payload)))
+        parts.append(payload)
+    body = b"".join(parts)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+def decode_request(body):
+    """
+    :param body: Frame body bytes
+    :return: List of (opcode, session_id, payload bytes)
+    """
+    view = memoryview(body)
+    (count,) = COUNT.unpack_from(view, 0)
+    offset = COUNT.size
+    ops = []
+    for _ in range(count):
+        op, session_id_len = OP_HEADER.unpack_from(view, offset)
+        offset += OP_HEADER.size
+        session_id = bytes(view[offset:offset + session_id_len]).decode("utf-8")
+        offset += session_id_len
+        (payload_len,) = PAYLOAD_LENGTH.unpack_from(view, offset)
+        offset += PAYLOAD_LENGTH.size
+        ops.append((op, session_id, bytes(view[offset:offset + payload_len])))
+        offset += payload_len
+    return ops
+
+
+def encode_response(results):
+    """
+    :param results: List of (status, payload bytes)
+    :return: Frame bytes
+    """
+    parts = [COUNT.pack(len(results))]
+    for status, payload in results:
+        parts.append(RESULT_HEADER.pack(status, len(payload)))
+        parts.append(payload)
+    body = b"".join(parts)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+def decode_response(body):
+    """
+    :param body: Frame body bytes
+    :return: List of (status, payload bytes)
+    """
+    view = memoryview(body)
+    (count,) = COUNT.unpack_from(view, 0)
+    offset = COUNT.size
+    results = []
+    for _ in range(count):
+        status, payload_len = RESULT_HEADER.unpack_from(view, offset)
+        offset += RESULT_HEADER.size
+        results.append((status, bytes(view[offset:offset + payload_len])))
+        offset += payload_len
+    return results
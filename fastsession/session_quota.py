@@ -0,0 +1,154 @@
+import json
+import logging
+
+# ロガーを渡されなかった場合に使う
+default_logger = logging.getLogger("fastsession")
+
+# ミドルウェアが書き込む管理用のキー。ハンドラーの書き込みではないので上限の対象にも大きさにも含めない
+INTERNAL_KEYS = frozenset(("__cause__", "__transient__"))
+
+
+class SessionQuotaExceeded(Exception):
+    """
+    Raised when a write would make a session larger than its byte quota.
+
+    書き込みによってセッションがバイト数の上限を超える場合に送出される
+    """
+
+    def __init__(self, key, size, max_bytes):
+        super().__init__(f"session size {size} bytes would exceed quota of {max_bytes} bytes (key: {key!r})")
+        self.key = key
+        self.size = size
+        self.max_bytes = max_bytes
+
+
+def measure_field(key, value):
+    """
+    Approximate serialised size in bytes of one top-level session field.
+
+    セッションのトップレベルの1フィールドの、シリアライズ後のおおよそのバイト数
+    """
+    return len(json.dumps(key, default=str)) + len(json.dumps(value, default=str))
+
+
+class QuotaSessionDict(dict):
+    """
+    A session dict that keeps track of its serialised size as top-level keys change, so the size
+    is known without reserialising the whole session. Only the changed field is measured on each write.
+    Mutating a nested value in place (e.g. session["cart"].append(...)) is not seen until the key is assigned again.
+
+    トップレベルのキーが変わるたびにシリアライズ後の大きさを追跡するセッション辞書。
+    書き込みのたびに変更されたフィールドだけを測るので、セッション全体を再シリアライズせずに大きさがわかる。
+    入れ子の値をその場で変更した場合(例 session["cart"].append(...))は、そのキーに再代入するまで反映されない。
+    """
+
+    def __init__(self, data=None, max_bytes=None, policy="enforce", logger=None):
+        """
+        :param data: Initial session data (measured but not checked against the quota).
+                     The middleware's bookkeeping keys (INTERNAL_KEYS) are never measured
+        :param max_bytes: Byte quota of the session, None for no quota
+        :param policy: "enforce" to raise SessionQuotaExceeded, "warn" to log a warning and accept the write
+        :param logger: Logger for the "warn" policy (e.g. the middleware's), the "fastsession" logger when None
+        """
+        super().__init__()
+        if policy not in ("enforce", "warn"):
+            raise ValueError(f"policy must be 'enforce' or 'warn', got '{policy}'")
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.logger = logger if logger is not None else default_logger
+        self.field_sizes = {}
+        self.size = 0
+
+        if data:
+            for key, value in data.items():
+                dict.__setitem__(self, key, value)
+                if key in INTERNAL_KEYS:
+                    continue
+                self.field_sizes[key] = measure_field(key, value)
+                self.size += self.field_sizes[key]
+
+    def check_quota(self, key, new_size):
+        if self.max_bytes is None or new_size <= self.max_bytes:
+            return
+
+        if self.policy == "enforce":
+            raise SessionQuotaExceeded(key, new_size, self.max_bytes)
+
+        # ミドルウェアのロガーは info と debug だけを持つことがある
+        log = getattr(self.logger, "warning", self.logger.info)
+        log(f"session size {new_size} bytes exceeds quota of {self.max_bytes} bytes (key: {key!r})")
+
+    def __setitem__(self, key, value):
+        if key in INTERNAL_KEYS:
+            dict.__setitem__(self, key, value)
+            return
+
+        field_size = measure_field(key, value)
+        new_size = self.size - self.field_sizes.get(key, 0) + field_size
+        self.check_quota(key, new_size)
+
+        dict.__setitem__(self, key, value)
+        self.field_sizes[key] = field_size
+        self.size = new_size
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.size -= self.field_sizes.pop(key, 0)
+
+    def pop(self, key, *args):
+        if key in self:
+            self.size -= self.field_sizes.pop(key, 0)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.size -= self.field_sizes.pop(key, 0)
+        return key, value
+
+    def clear(self):
+        dict.clear(self)
+        self.field_sizes.clear()
+        self.size = 0
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class SizeHistogram:
+    """
+    Histogram of session sizes with fixed power-of-four buckets.
+
+    4のべき乗の固定バケットによるセッションサイズのヒストグラム
+    """
+
+    BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+    @classmethod
+    def build(cls, sizes):
+        """
+        :param sizes: Iterable of session sizes in bytes
+        :return: Dictionary of bucket label ("<=256", ..., ">1048576") to number of sessions
+        """
+        histogram = {f"<={bound}": 0 for bound in cls.BUCKETS}
+        histogram[f">{cls.BUCKETS[-1]}"] = 0
+
+        for size in sizes:
+            for bound in cls.BUCKETS:
+                if size <= bound:
+                    histogram[f"<={bound}"] += 1
+                    break
+            else:
+                histogram[f">{cls.BUCKETS[-1]}"] += 1
+
+        return histogram
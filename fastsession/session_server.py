@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import json
+import os
+import stat
+import time
+
+from .scan_order import ScanOrder
+from .session_protocol import (CREATED_AT, CURSOR, FRAME_HEADER, MAX_FRAME_LENGTH, OP_ACQUIRE_LEASE, OP_DELETE,
+                               OP_EXISTS, OP_GET, OP_GET_VERSIONED, OP_RELEASE_LEASE, OP_SCAN, OP_SET, OP_SET_IF_VERSION,
+                               OP_SWEEP, OP_SWEEP_EXPIRED, OP_TOUCH, SCAN_ARGS, STATUS_CONFLICT, STATUS_ERROR, STATUS_NOT_FOUND,
+                               STATUS_OK, SWEEP_RESULT, U32, VERSION, decode_request, default_socket_path,
+                               encode_response)
+
+
+class SessionServer:
+    """
+    A standalone session server that keeps sessions in memory and serves the workers of one host
+    over a Unix domain socket, using the length-prefixed binary protocol of session_protocol.
+    Session data is kept as the encoded bytes sent by clients, the server never decodes it.
+
+    セッションをメモリに保持し、同じホストのワーカーに Unix ドメインソケット越しに提供するセッションサーバー。
+    プロトコルは session_protocol の長さ付きバイナリプロトコル。
+    セッションデータはクライアントが送ったエンコード済のバイト列のまま保持し、サーバーではデコードしない
+    """
+
+    # OP_SWEEP が1回に調べるセッション数。その間に他のクライアントの操作を処理する
+    SWEEP_CHUNK_SIZE = 1000
+
+    def __init__(self, path=None, max_session_age=3600 * 12, socket_mode=0o600, max_frame_length=MAX_FRAME_LENGTH,
+                 max_idle=None):
+        """
+        :param path: Unix domain socket path. Defaults to default_socket_path(), a directory private to the user.
+                     The directory must be owned by the user and not writable by anyone else
+        :param max_session_age: Seconds after creation at which a session expires
+        :param socket_mode: Permissions of the socket file. Only the owner can connect by default
+        :param max_frame_length: Longest frame body accepted. A longer frame gets an error and its connection is closed
+        :param max_idle: When set, sessions not read, written or touched for this many seconds expire as well
+        """
+        self.path = path or default_socket_path()
+        self.max_session_age = max_session_age
+        self.socket_mode = socket_mode
+        self.max_frame_length = max_frame_length
+        self.max_idle = max_idle
+        self.sessions = {}  # session_id -> [created_at, バージョン, データ, 最終アクセス時刻]
+        self.scan_order = ScanOrder()  # 走査・掃除をカーソルから再開するための作成順
+        self.leases = {}  # リース名 -> {"owner", "expires_at", "checkpoint"}
+        self.server = None
+        self.connections = set()  # 接続中のクライアントの writer
+
+    async def start(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.check_directory(directory)
+        await self.remove_stale_socket()
+
+        # bind した時点から他のユーザーが接続できないよう、umask で権限を絞ってソケットを作る
+        umask = os.umask(0o077)
+        try:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=self.path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, self.socket_mode)
+
+    def check_directory(self, directory):
+        """
+        Make sure the socket directory cannot be tampered with by other users: it must be a real directory
+        owned by the current user, not writable by group or others, and only accessible by the group or others
+        the socket itself is opened to.
+
+        ソケットのディレクトリを他のユーザーが操作できないことを確認する。シンボリックリンクでない現在のユーザーのディレクトリで、
+        グループ・その他が書き込めず、ソケット自体を開放した相手以外はアクセスできないこと
+        """
+        st = os.lstat(directory)
+        allowed = 0o700
+        if self.socket_mode & 0o070:
+            allowed |= 0o050
+        if self.socket_mode & 0o007:
+            allowed |= 0o005
+        if not stat.S_ISDIR(st.st_mode):
+            raise PermissionError(f"socket directory {directory} is not a directory")
+        if st.st_uid != os.getuid():
+            raise PermissionError(f"socket directory {directory} is not owned by the current user")
+        if stat.S_IMODE(st.st_mode) & ~allowed:
+            raise PermissionError(f"socket directory {directory} is accessible by other users "
+                                  f"(mode {stat.S_IMODE(st.st_mode):o})")
+
+    async def remove_stale_socket(self):
+        """
+        Remove the socket file left by a previous server process.
+        Refuse to remove anything that is not a socket, or a socket another server still accepts connections on.
+
+        前回のサーバープロセスが残したソケットファイルを削除する。
+        ソケットでないファイルや、別のサーバーがまだ接続を受け付けているソケットは削除しない
+        """
+        try:
+            st = os.lstat(self.path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(st.st_mode):
+            raise FileExistsError(f"{self.path} exists and is not a socket")
+
+        try:
+            _, writer = await asyncio.open_unix_connection(self.path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        else:
+            writer.close()
+            raise OSError(f"a session server is already running on {self.path}")
+
+        os.unlink(self.path)
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                (length,) = FRAME_HEADER.unpack(header)
+                if length > self.max_frame_length:
+                    # 本体を読まずに断る。以降のフレームの境界が分からないので接続も閉じる
+                    writer.write(encode_response([(STATUS_ERROR, f"frame of {length} bytes exceeds "
+                                                                 f"{self.max_frame_length} bytes".encode("utf-8"))]))
+                    await writer.drain()
+                    break
+                body = await reader.readexactly(length)
+                writer.write(await self.handle_frame(body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def handle_frame(self, body):
+        try:
+            ops = decode_request(body)
+        except ValueError as exc:  # struct.error と UnicodeDecodeError を含む
+            return encode_response([(STATUS_ERROR, f"malformed request: {exc}".encode("utf-8"))])
+
+        results = []
+        for op, session_id, payload in ops:
+            if op == OP_SWEEP:
+                # 全体の掃除はチャンクごとにイベントループへ戻り、他のクライアントを止めない
+                results.append((STATUS_OK, U32.pack(await self.sweep(int(time.time())))))
+            else:
+                results.append(self.execute_safely(op, session_id, payload))
+        return encode_response(results)
+
+    def execute_safely(self, op, session_id, payload):
+        """
+        Execute one operation of a batch, turning a malformed operation into a STATUS_ERROR result
+        so the other operations of the batch and the connection are not affected.
+
+        バッチ内の1つの操作を実行する。不正な操作は STATUS_ERROR の結果にし、同じバッチの他の操作や接続には影響させない
+        """
+        try:
+            return self.execute(op, session_id, payload)
+        except Exception as exc:
+            return STATUS_ERROR, f"op {op} failed: {type(exc).__name__}: {exc}".encode("utf-8")
+
+    def execute(self, op, session_id, payload):
+        """
+        Execute one operation of a batch.
+
+        バッチ内の1つの操作を実行する
+
+        :return: (status, payload bytes)
+        """
+        now = int(time.time())
+
+        if op == OP_GET:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return STATUS_NOT_FOUND, b""
+            entry[3] = now
+            return STATUS_OK, CREATED_AT.pack(entry[0]) + entry[2]
+
+        if op == OP_SET:
+            (created_at,) = CREATED_AT.unpack_from(payload, 0)
+            self.add_session(session_id, created_at, payload[CREATED_AT.size:])
+            return STATUS_OK, b""
+
+        if op == OP_GET_VERSIONED:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return STATUS_NOT_FOUND, b""
+            entry[3] = now
+            return STATUS_OK, CREATED_AT.pack(entry[0]) + VERSION.pack(entry[1]) + entry[2]
+
+        if op == OP_SET_IF_VERSION:
+            # 操作はイベントループで1つずつ実行されるので、バージョンの比較と書き込みは不可分になる
+            (expected_version,) = VERSION.unpack_from(payload, 0)
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return STATUS_NOT_FOUND, b""
+            if entry[1] != expected_version:
+                return STATUS_CONFLICT, b""
+            entry[1] += 1
+            entry[2] = payload[VERSION.size:]
+            entry[3] = now
+            return STATUS_OK, VERSION.pack(entry[1])
+
+        if op == OP_TOUCH:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return STATUS_NOT_FOUND, b""
+            entry[3] = now
+            return STATUS_OK, b""
+
+        if op == OP_EXISTS:
+            if session_id not in self.sessions:
+                return STATUS_NOT_FOUND, b""
+            return STATUS_OK, b""
+
+        if op == OP_DELETE:
+            if not self.remove_session(session_id):
+                return STATUS_NOT_FOUND, b""
+            return STATUS_OK, b""
+
+        if op == OP_SCAN:
+            cursor, count = SCAN_ARGS.unpack(payload)
+            next_cursor, session_ids = self.scan_order.scan(cursor, count)
+            return STATUS_OK, CURSOR.pack(next_cursor) + "\n".join(session_ids).encode("utf-8")
+
+        if op == OP_SWEEP_EXPIRED:
+            cursor, count = SCAN_ARGS.unpack(payload)
+            return STATUS_OK, SWEEP_RESULT.pack(*self.sweep_expired(now, cursor, count))
+
+        if op == OP_ACQUIRE_LEASE:
+            args = json.loads(payload)
+            lease = self.acquire_lease(session_id, args["owner"], args["ttl"])
+            if lease is None:
+                return STATUS_CONFLICT, b""
+            return STATUS_OK, json.dumps(lease).encode("utf-8")
+
+        if op == OP_RELEASE_LEASE:
+            args = json.loads(payload)
+            self.release_lease(session_id, args["owner"], args.get("checkpoint"))
+            return STATUS_OK, b""
+
+        return STATUS_ERROR, f"unknown op {op}".encode("utf-8")
+
+    def add_session(self, session_id, created_at, data):
+        # 上書きしたセッションのバージョンは進め、バージョンを比較して保存する側が検知できるようにする
+        entry = self.sessions.get(session_id)
+        self.sessions[session_id] = [created_at, entry[1] + 1 if entry is not None else 0, data, int(time.time())]
+        self.scan_order.add(session_id)
+
+    def remove_session(self, session_id):
+        if self.sessions.pop(session_id, None) is None:
+            return False
+        self.scan_order.remove(session_id)
+        return True
+
+    def is_expired(self, entry, now):
+        if now - entry[0] > self.max_session_age:
+            return True
+        return self.max_idle is not None and now - entry[3] > self.max_idle
+
+    async def sweep(self, now):
+        """
+        Delete every expired session, SWEEP_CHUNK_SIZE sessions at a time, yielding to the event loop
+        between chunks so other clients are served while a large server is swept.
+
+        期限切れの全セッションを SWEEP_CHUNK_SIZE 件ずつ削除する。
+        チャンクの間でイベントループに戻り、大きなサーバーを掃除している間も他のクライアントに応答する
+
+        :return: Number of sessions deleted
+        """
+        deleted, cursor = self.sweep_expired(now, 0, self.SWEEP_CHUNK_SIZE)
+        while cursor:
+            await asyncio.sleep(0)
+            count, cursor = self.sweep_expired(now, cursor, self.SWEEP_CHUNK_SIZE)
+            deleted += count
+        return deleted
+
+    def sweep_expired(self, now, cursor, count):
+        """
+        Delete the expired sessions among at most count sessions after the cursor.
+
+        カーソルより後の最大 count 件のセッションを調べ、期限切れのものを削除する
+
+        :return: (number of sessions deleted, next cursor or 0 when the whole server was swept)
+        """
+        next_cursor, session_ids = self.scan_order.scan(cursor, count)
+        deleted = 0
+        for session_id in session_ids:
+            entry = self.sessions.get(session_id)
+            if entry is not None and self.is_expired(entry, now):
+                deleted += self.remove_session(session_id)
+        return deleted, next_cursor
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Acquire the named lease unless another owner holds it and it has not expired.
+        Operations are executed one at a time on the event loop, so the check and the write are atomic.
+
+        別の所有者が期限内のリースを持っていなければ、名前付きのリースを取得する。
+        操作はイベントループで1つずつ実行されるので、確認と書き込みは不可分になる
+
+        :return: Lease record {"owner", "expires_at", "checkpoint"}, or None if another owner holds it
+        """
+        lease = self.leases.get(name)
+        now = time.time()
+        if lease is not None and lease["owner"] not in (None, owner) and lease["expires_at"] > now:
+            return None
+
+        checkpoint = lease["checkpoint"] if lease is not None else None
+        self.leases[name] = {"owner": owner, "expires_at": now + ttl, "checkpoint": checkpoint}
+        return dict(self.leases[name])
+
+    def release_lease(self, name, owner, checkpoint=None):
+        lease = self.leases.get(name)
+        if lease is None or lease["owner"] != owner:
+            return  # 期限切れで他の所有者に移った
+        self.leases[name] = {"owner": None, "expires_at": 0, "checkpoint": checkpoint}
+
+
+def main(argv=None):
+    """
+    Run the session server.
+
+    セッションサーバーを起動する
+
+    python -m fastsession.session_server --socket /run/fastsession/fastsession.sock
+    """
+    parser = argparse.ArgumentParser(prog="python -m fastsession.session_server")
+    parser.add_argument("--socket", default=None,
+                        help="Unix domain socket path (default: fastsession.sock in a directory private to the user)")
+    parser.add_argument("--socket-mode", type=lambda mode: int(mode, 8), default=0o600,
+                        help="permissions of the socket file in octal (default: 600)")
+    parser.add_argument("--max-session-age", type=int, default=3600 * 12, help="session lifetime in seconds")
+    parser.add_argument("--max-idle", type=int, default=None,
+                        help="seconds without a read, write or touch after which a session expires (default: none)")
+    args = parser.parse_args(argv)
+
+    server = SessionServer(args.socket, max_session_age=args.max_session_age, socket_mode=args.socket_mode,
+                           max_idle=args.max_idle)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    main()
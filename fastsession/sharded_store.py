@@ -0,0 +1,389 @@
+import bisect
+import hashlib
+import itertools
+import threading
+
+
+class ConsistentHashRing:
+    """
+    A consistent hash ring with virtual nodes. Adding or removing one of N nodes
+    only moves about 1/N of the keys.
+
+    仮想ノードを使うコンシステントハッシュリング。N個のノードのうち1つを追加・削除しても、
+    移動するキーはおよそ 1/N だけ
+    """
+
+    def __init__(self, nodes=(), vnodes=100):
+        self.vnodes = vnodes
+        # (ソート済の仮想ノードのハッシュ値, 同じ順の仮想ノードを持つノード名)。
+        # get_node はワーカースレッドからも呼ばれるので、変更時は新しいタプルを作って1つの属性として差し替える
+        self.points = ((), ())
+        self.nodes = frozenset()
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        points = list(zip(*self.points))
+        points.extend((self.hash(f"{node}#{i}"), node) for i in range(self.vnodes))
+        points.sort()
+        self.points = (tuple(h for h, _ in points), tuple(owner for _, owner in points))
+        self.nodes = self.nodes | {node}
+
+    def remove_node(self, node):
+        if node not in self.nodes:
+            return
+        kept = [(h, owner) for h, owner in zip(*self.points) if owner != node]
+        self.points = (tuple(h for h, _ in kept), tuple(owner for _, owner in kept))
+        self.nodes = self.nodes - {node}
+
+    def get_node(self, key):
+        """
+        :return: Name of the node owning the key, or None if the ring is empty
+        """
+        hashes, owners = self.points
+        if not hashes:
+            return None
+        index = bisect.bisect(hashes, self.hash(key)) % len(hashes)
+        return owners[index]
+
+    def copy(self):
+        ring = ConsistentHashRing(vnodes=self.vnodes)
+        ring.points = self.points  # タプルは変更されないので共有できる
+        ring.nodes = self.nodes
+        return ring
+
+
+class ShardedStore:
+    """
+    Spreads sessions over several backend stores implementing the MemoryStore interface,
+    routing each session ID with a consistent hash ring.
+    After add_node / remove_node, sessions still on their previous owner are moved to the new owner
+    when they are read (read-through migration), or all at once with migrate_all.
+
+    MemoryStore のインターフェイスを実装した複数のバックエンドストアにセッションを分散させる。
+    セッションIDはコンシステントハッシュリングで振り分ける。
+    add_node / remove_node 後、以前の担当ノードに残っているセッションは読み出し時に新しい担当ノードへ移す(読み出し時の移行)。
+    migrate_all で一括で移すこともできる
+    """
+
+    def __init__(self, stores, vnodes=100, migrate_on_read=True):
+        """
+        :param stores: Dictionary of node name to backend store
+        :param vnodes: Number of virtual nodes per node
+        :param migrate_on_read: Move sessions from their previous owner when they are read after a ring change
+        """
+        self.stores = dict(stores)
+        self.ring = ConsistentHashRing(self.stores, vnodes=vnodes)
+        self.previous_rings = []  # ノード構成を変更する前のリング(移行中のみ、新しい順)。移行中に続けて変更しても全て覚えておく
+        self.retired_stores = {}  # 移行が終わるまで読み出しに使う、削除したノードのストア
+        self.migrate_on_read = migrate_on_read
+        self.checked_out = {}  # session_id -> checkout したノードのストア(release で同じノードに返すため)
+        self.checkout_lock = threading.Lock()
+        self.stats = {"migrated": 0}
+
+    def node_store(self, node):
+        store = self.stores.get(node)
+        return store if store is not None else self.retired_stores.get(node)
+
+    def store_for(self, session_id):
+        return self.stores[self.ring.get_node(session_id)]
+
+    def previous_stores_for(self, session_id):
+        """
+        :return: Previous owner stores of the session that differ from the current owner, newest ring first
+        """
+        current_node = self.ring.get_node(session_id)
+        stores = []
+        for ring in self.previous_rings:
+            previous_node = ring.get_node(session_id)
+            store = self.node_store(previous_node)
+            if previous_node != current_node and store is not None and store not in stores:
+                stores.append(store)
+        return stores
+
+    def holding_store_for(self, session_id):
+        """
+        :return: Store actually holding the session: its current owner, or while migrating,
+                 the previous owner of a session not moved yet
+        """
+        store = self.store_for(session_id)
+        if self.previous_rings and store.has_no_session_id(session_id):
+            store = self.previous_store_for(session_id) or store  # 読み出し時に移行していないセッション
+        return store
+
+    def previous_store_for(self, session_id):
+        """
+        :return: Previous owner store still holding the session, or None.
+                 A session may sit on the owner of any earlier ring when the topology changed several times
+                 during one migration.
+        """
+        stores = self.previous_stores_for(session_id)
+        if len(stores) == 1:
+            return stores[0]
+        for store in stores:
+            if store.has_session_id(session_id):
+                return store
+        return None
+
+    def add_node(self, node, store):
+        """
+        Add a backend node. About 1/N of the sessions move to it.
+
+        バックエンドノードを追加する。およそ 1/N のセッションがこのノードに移る
+        """
+        self.begin_migration()
+        self.stores[node] = store
+        self.ring.add_node(node)
+
+    def remove_node(self, node):
+        """
+        Remove a backend node. Its store is kept for reads until finish_migration.
+        The last node cannot be removed, as sessions would have no owner left.
+
+        バックエンドノードを削除する。そのストアは finish_migration まで読み出しに使う。
+        セッションの担当ノードがなくなるので、最後のノードは削除できない
+        """
+        if node not in self.stores:
+            raise ValueError(f"unknown node '{node}'")
+        if len(self.stores) == 1:
+            raise ValueError(f"cannot remove '{node}', the last node of the sharded store")
+        self.begin_migration()
+        # リングから外すまでは、他のスレッドがこのノードを引いても見つかるようにしておく
+        self.retired_stores[node] = self.stores[node]
+        self.ring.remove_node(node)
+        del self.stores[node]
+
+    def begin_migration(self):
+        self.previous_rings.insert(0, self.ring.copy())
+
+    def finish_migration(self):
+        """
+        Forget the previous rings and removed nodes. Sessions not migrated by then are no longer found.
+
+        以前のリングと削除したノードを忘れる。それまでに移行されなかったセッションは見つからなくなる
+        """
+        self.previous_rings = []
+        self.retired_stores = {}
+
+    def migrate_session(self, session_id):
+        """
+        Move a session from its previous owner to its current owner.
+
+        セッションを以前の担当ノードから現在の担当ノードへ移す
+
+        :return: True if the session was moved
+        """
+        previous_store = self.previous_store_for(session_id)
+        if previous_store is None:
+            return False
+
+        session_info = previous_store.export_session(session_id)
+        if session_info is None:
+            return False
+
+        self.store_for(session_id).import_sessions([(session_id, session_info)])
+        previous_store.delete_store(session_id)
+        self.stats["migrated"] += 1
+        return True
+
+    def migrate_all(self, chunk_size=1000):
+        """
+        Move every session that is not on its current owner, then finish the migration.
+
+        現在の担当ノードにない全セッションを移し、移行を終える
+
+        :return: Number of sessions moved
+        """
+        if not self.previous_rings:
+            return 0
+
+        count = 0
+        for node, store in list(self.stores.items()) + list(self.retired_stores.items()):
+            misplaced = [session_id for session_id, _ in store.iter_sessions(chunk_size=chunk_size)
+                         if self.ring.get_node(session_id) != node]
+            for session_id in misplaced:
+                session_info = store.export_session(session_id)
+                if session_info is None:
+                    continue
+                self.store_for(session_id).import_sessions([(session_id, session_info)])
+                store.delete_store(session_id)
+                count += 1
+
+        self.stats["migrated"] += count
+        self.finish_migration()
+        return count
+
+    def checkout(self, session_id):
+        """
+        Pin a session on the node holding it, for nodes supporting checkout (see MemoryStore.checkout).
+        The node is remembered, so the matching release reaches it even if the ring changes in between.
+
+        セッションを保持しているノードで固定する(checkout に対応したノードのみ。MemoryStore.checkout を参照)。
+        ノードを覚えておき、その間にリングが変わっても対応する release が同じノードに届くようにする
+        """
+        store = self.holding_store_for(session_id)
+        if not hasattr(store, "checkout"):
+            return
+
+        store.checkout(session_id)
+        with self.checkout_lock:
+            self.checked_out.setdefault(session_id, []).append(store)
+
+    def release(self, session_id):
+        """
+        Unpin a session pinned with checkout, on the node it was pinned on.
+
+        checkout で固定したセッションの固定を、固定したノードで外す
+        """
+        with self.checkout_lock:
+            stores = self.checked_out.get(session_id)
+            if not stores:
+                return
+            store = stores.pop()
+            if not stores:
+                del self.checked_out[session_id]
+        store.release(session_id)
+
+    def has_session_id(self, session_id):
+        if self.store_for(session_id).has_session_id(session_id):
+            return True
+        return any(store.has_session_id(session_id) for store in self.previous_stores_for(session_id))
+
+    def has_no_session_id(self, session_id):
+        return not self.has_session_id(session_id)
+
+    def create_store(self, session_id):
+        return self.store_for(session_id).create_store(session_id)
+
+    def get_store(self, session_id):
+        session_store = self.store_for(session_id).get_store(session_id)
+        if session_store is not None or not self.previous_rings:
+            return session_store
+
+        if self.migrate_on_read and self.migrate_session(session_id):
+            return self.store_for(session_id).get_store(session_id)
+
+        previous_store = self.previous_store_for(session_id)
+        return previous_store.get_store(session_id) if previous_store is not None else None
+
+    def get_store_versioned(self, session_id):
+        if self.store_for(session_id).has_no_session_id(session_id) and self.previous_rings:
+            # 移行中のセッションは現在の担当ノードに移してから読む(バージョンは担当ノードのものになる)
+            self.migrate_session(session_id)
+        return self.store_for(session_id).get_store_versioned(session_id)
+
+    def save_store_if_version(self, session_id, session_store, expected_version):
+        return self.store_for(session_id).save_store_if_version(session_id, session_store, expected_version)
+
+    def save_store(self, session_id):
+        self.store_for(session_id).save_store(session_id)
+
+    def delete_store(self, session_id):
+        deleted = self.store_for(session_id).delete_store(session_id)
+        for previous_store in self.previous_stores_for(session_id):
+            deleted = previous_store.delete_store(session_id) or deleted
+        return deleted
+
+    def group_by_node(self, session_ids):
+        groups = {}
+        for session_id in session_ids:
+            groups.setdefault(self.ring.get_node(session_id), []).append(session_id)
+        return groups
+
+    def get_many(self, session_ids):
+        if self.previous_rings:
+            # 移行中は読み出し時の移行を行うため1件ずつ取得する
+            stores = {session_id: self.get_store(session_id) for session_id in session_ids}
+            return {session_id: session_store for session_id, session_store in stores.items() if session_store is not None}
+
+        stores = {}
+        for node, node_session_ids in self.group_by_node(session_ids).items():
+            stores.update(self.stores[node].get_many(node_session_ids))
+        return stores
+
+    def delete_many(self, session_ids):
+        return sum(1 for session_id in session_ids if self.delete_store(session_id))
+
+    def iter_sessions(self, chunk_size=1000):
+        stores = list(self.stores.values()) + list(self.retired_stores.values())
+        return itertools.chain.from_iterable(store.iter_sessions(chunk_size=chunk_size) for store in stores)
+
+    def import_sessions(self, sessions, batch_size=1000):
+        count = 0
+        batches = {}
+        for session_id, session_info in sessions:
+            node = self.ring.get_node(session_id)
+            batch = batches.setdefault(node, [])
+            batch.append((session_id, session_info))
+            if len(batch) >= batch_size:
+                count += self.stores[node].import_sessions(batch, batch_size=batch_size)
+                batches[node] = []
+        for node, batch in batches.items():
+            if batch:
+                count += self.stores[node].import_sessions(batch, batch_size=batch_size)
+        return count
+
+    @property
+    def process_local(self):
+        return any(getattr(store, "process_local", False) for store in self.stores.values())
+
+    @property
+    def index_key(self):
+        return getattr(next(iter(self.stores.values()), None), "index_key", None)
+
+    def set_default_logger(self, logger):
+        for store in list(self.stores.values()) + list(self.retired_stores.values()):
+            if hasattr(store, "set_default_logger"):
+                store.set_default_logger(logger)
+
+    def update_index(self, session_id, session_store):
+        # 移行していないセッションは、保持している以前の担当ノードの索引を更新する
+        self.holding_store_for(session_id).update_index(session_id, session_store)
+
+    def find_sessions(self, value):
+        stores = list(self.stores.values()) + list(self.retired_stores.values())
+        return [session_id for store in stores for session_id in store.find_sessions(value)]
+
+    def revoke_user(self, value):
+        stores = list(self.stores.values()) + list(self.retired_stores.values())
+        return sum(store.revoke_user(value) for store in stores)
+
+    def gc(self):
+        for store in list(self.stores.values()) + list(self.retired_stores.values()):
+            store.gc()
+
+    def sweep_expired(self, cursor=None, limit=1000):
+        """
+        Sweep the nodes one after another in node name order, including removed nodes kept until
+        finish_migration. The cursor is [node name, cursor of the node].
+
+        ノード名の順に1ノードずつ掃除する。finish_migration まで残している削除したノードも含む。
+        カーソルは [ノード名, そのノードのカーソル]
+        """
+        nodes = sorted(set(self.stores) | set(self.retired_stores))
+        if not nodes:
+            return 0, None
+        node, node_cursor = cursor if cursor is not None else (nodes[0], None)
+        store = self.node_store(node)
+        if store is None:
+            # 掃除の途中でノードが忘れられた => 次のノードから続ける
+            later_nodes = [name for name in nodes if name > node]
+            if not later_nodes:
+                return 0, None
+            node, node_cursor = later_nodes[0], None
+            store = self.node_store(node)
+
+        deleted, node_cursor = store.sweep_expired(node_cursor, limit)
+        if node_cursor is not None:
+            return deleted, [node, node_cursor]
+
+        next_index = nodes.index(node) + 1
+        if next_index == len(nodes):
+            return deleted, None
+        return deleted, [nodes[next_index], None]
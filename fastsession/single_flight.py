@@ -0,0 +1,43 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one in-flight call whose result
+    (or exception) is shared by every caller. A mutable result can be given to each caller as its own copy.
+
+    同じキーの同時呼び出しを1つの実行中の呼び出しにまとめ、その結果(または例外)を全ての呼び出し元で共有する。
+    変更可能な結果は、呼び出し元ごとの複製として渡すことができる
+    """
+
+    def __init__(self):
+        self.calls = {}  # キー -> 実行中のタスク
+        self.stats = {
+            "calls": 0,  # 実際に実行した呼び出し数
+            "shared": 0,  # 実行中の呼び出しの結果を共有した数
+        }
+
+    async def do(self, key, func, share=None):
+        """
+        :param key: Key identifying the call
+        :param func: Function returning the awaitable to run when no call with the same key is in flight
+        :param share: When set, every caller, including the one that started the call, gets share(result)
+                      instead of the result itself, so no two callers hold the same mutable object
+        :return: Result of the (shared) call
+        """
+        task = self.calls.get(key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self.stats["shared"] += 1
+        else:
+            self.stats["calls"] += 1
+            task = asyncio.ensure_future(func())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.forget(key, done))
+
+        # 呼び出し元の1つがキャンセルされても、共有しているタスクはキャンセルしない
+        result = await asyncio.shield(task)
+        return share(result) if share is not None else result
+
+    def forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
@@ -0,0 +1,258 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StoreUnavailable(Exception):
+    """
+    Raised when a store call times out, fails, or is rejected because the circuit is open.
+
+    ストアの呼び出しがタイムアウト・失敗した場合、または回路が開いていて拒否された場合に送出される
+    """
+
+
+class StoreOverloaded(StoreUnavailable):
+    """
+    Raised when a store call could not get one of the max_concurrency slots within the timeout.
+    The backend was not called, so the circuit breaker does not count it as a failure.
+
+    タイムアウトまでに max_concurrency の枠を得られなかった場合に送出される。
+    バックエンドは呼んでいないので、サーキットブレーカーは失敗として数えない
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for `reset_timeout` seconds.
+    After that a single probe call is let through (half open): success closes the circuit, failure opens it again.
+
+    連続 failure_threshold 回の失敗で開き、reset_timeout 秒間は呼び出しを拒否する。
+    その後1回だけ試しの呼び出しを通し(半開)、成功すれば閉じ、失敗すれば再び開く
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        self.stats = {
+            "state": self.state,
+            "transitions": {},  # "closed->open" などの状態遷移ごとの回数
+        }
+
+    def transition(self, state):
+        key = f"{self.state}->{state}"
+        self.stats["transitions"][key] = self.stats["transitions"].get(key, 0) + 1
+        self.state = state
+        self.stats["state"] = state
+
+    def allow_request(self):
+        """
+        :return: True if a call may go to the store now
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.transition(self.HALF_OPEN)
+
+            # 半開状態では試しの呼び出しを1つだけ通す
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.probing = False
+            if self.state != self.CLOSED:
+                self.transition(self.CLOSED)
+
+    def record_skipped(self):
+        """
+        Record that a call let through never reached the store, so the next call may probe instead.
+
+        通した呼び出しがストアまで届かなかったことを記録し、次の呼び出しが試しの呼び出しになれるようにする
+        """
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.transition(self.OPEN)
+
+
+class StoreGuard:
+    """
+    Runs store calls in a worker thread with a per-call timeout, a bound on concurrent calls and an optional
+    circuit breaker, so a stalled backend cannot hold requests for longer than the timeout.
+
+    ストアの呼び出しをワーカースレッドで実行し、呼び出しごとのタイムアウト、同時呼び出し数の上限、
+    任意のサーキットブレーカーを適用する。バックエンドが詰まってもリクエストはタイムアウト以上待たされない
+    """
+
+    # 呼び出し側の誤り(エンコードできない値など)。バックエンドの障害ではないので回路の状態を変えず、そのまま送出する
+    CALLER_ERRORS = (TypeError, ValueError, KeyError, AttributeError)
+
+    def __init__(self, timeout=None, max_concurrency=None, circuit_breaker=None, max_workers=32):
+        """
+        :param timeout: Seconds after which a call is given up. Waiting for a slot and the backend call
+                        are each bounded by it
+        :param max_concurrency: Maximum number of backend calls in flight, including calls that timed out
+                                but whose worker thread is still blocked on the backend
+        :param circuit_breaker: CircuitBreaker, or None
+        :param max_workers: Number of worker threads when max_concurrency is not set
+        """
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_workers = max_concurrency if max_concurrency is not None else max_workers
+        self.semaphore = None  # イベントループ上で最初に使うときに生成する
+        self.executor = None  # 最初に呼び出すときに生成する専用のワーカースレッドプール
+        self.circuit_breaker = circuit_breaker
+        self.stats = {
+            "calls": 0,  # 呼び出し回数
+            "timeouts": 0,  # タイムアウトした回数
+            "errors": 0,  # 例外で失敗した回数
+            "rejected": 0,  # 回路が開いていて拒否した回数
+            "overloaded": 0,  # 同時呼び出し数の枠を得られず諦めた回数
+            "degraded": {},  # 縮退モードごとの縮退したリクエスト数
+        }
+
+    def is_open(self):
+        return self.circuit_breaker is not None and self.circuit_breaker.is_open()
+
+    def record_degraded(self, mode):
+        self.stats["degraded"][mode] = self.stats["degraded"].get(mode, 0) + 1
+
+    async def call(self, func, *args, allow_when_open=False):
+        """
+        Call a (synchronous) store method under the guard. Only the backend call itself is timed
+        and counted by the circuit breaker: waiting for a slot is reported as overload,
+        and errors of the caller (CALLER_ERRORS) are raised unchanged.
+
+        ストアの(同期)メソッドをガード下で呼び出す。時間を計りサーキットブレーカーが数えるのはバックエンドの呼び出しだけで、
+        枠の待ちは過負荷として報告し、呼び出し側の誤り(CALLER_ERRORS)はそのまま送出する
+
+        :param func: Store method
+        :param args: Arguments of the store method
+        :param allow_when_open: Let the call through even if the circuit is open (used for reads in read-only mode)
+        :return: Result of the store method
+        :raises StoreUnavailable: on timeout, failure or when the circuit is open
+        :raises StoreOverloaded: when no slot was free within the timeout
+        """
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow_request():
+            if not allow_when_open:
+                self.stats["rejected"] += 1
+                raise StoreUnavailable(f"circuit open, {func.__name__} rejected")
+            # 回路が開いていても通す呼び出しの結果では、回路の状態を変えない
+            breaker = None
+
+        try:
+            await self.acquire_slot()
+        except asyncio.TimeoutError:
+            self.stats["overloaded"] += 1
+            if breaker is not None:
+                breaker.record_skipped()
+            raise StoreOverloaded(f"{func.__name__} found no free slot within {self.timeout} seconds")
+        except BaseException:
+            if breaker is not None:
+                breaker.record_skipped()
+            raise
+
+        self.stats["calls"] += 1
+        try:
+            result = await asyncio.wait_for(self.submit(func, args), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            if breaker is not None:
+                breaker.record_failure()
+            raise StoreUnavailable(f"{func.__name__} timed out after {self.timeout} seconds")
+        except self.CALLER_ERRORS:
+            if breaker is not None:
+                breaker.record_skipped()
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            if breaker is not None:
+                breaker.record_failure()
+            raise StoreUnavailable(f"{func.__name__} failed: {e!r}") from e
+        except BaseException:
+            if breaker is not None:
+                breaker.record_skipped()
+            raise
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+    async def acquire_slot(self):
+        """
+        Wait, at most timeout seconds, for one of the max_concurrency slots. run() gives it back
+        once the worker thread finishes.
+
+        max_concurrency の枠を最大 timeout 秒待って取得する。枠は submit() がワーカースレッドの終了時に返す
+        """
+        if self.max_concurrency is None:
+            return
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+
+    def submit(self, func, args):
+        """
+        Start the store call in a worker thread.
+
+        ストアの呼び出しをワーカースレッドで開始する
+
+        :return: asyncio future of the result
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fastsession-store")
+
+        if self.semaphore is None:
+            return asyncio.wrap_future(self.executor.submit(functools.partial(func, *args)))
+
+        # 枠は call() が取得済
+        try:
+            future = self.executor.submit(functools.partial(func, *args))
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+        # タイムアウトで待つのをやめても、ワーカースレッドはバックエンドを待ち続けている
+        # => 枠はスレッドの終了時に返し、バックエンドへの同時呼び出し数が上限を超えないようにする
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphore
+
+        def release(_):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(semaphore.release)
+
+        future.add_done_callback(release)
+        return asyncio.wrap_future(future)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
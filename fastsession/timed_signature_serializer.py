@@ -1,4 +1,7 @@
-from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadTimeSignature
+import hashlib
+
+from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
+from itsdangerous.encoding import want_bytes
 
 
 class TimedSignatureSerializer:
@@ -6,57 +9,130 @@ class TimedSignatureSerializer:
         与えられた秘密鍵と有効期限を用いて、辞書型オブジェクトを署名付き文字列に変換するクラス。
         TimedJSONWebSignatureSerializer が Deprecated になったので近い機能を実装した
         This class converts a dictionary object into a signed string using the given secret key and expiration time.
+
+        secret_key には鍵リング(新しい順の鍵のリスト)も指定できる。先頭の鍵で署名し、
+        トークンの先頭に付与した短いキーIDから検証用の鍵を O(1) で引く。
+        secret_key may also be a key ring (a list of keys, newest first). Tokens are signed with the first key and
+        carry a short key ID prefix so that verification looks up the right key in O(1).
     """
 
+    KEY_ID_SEPARATOR = "."
+
     def __init__(self, secret_key, expired_in=0):
-        self.ser = URLSafeTimedSerializer(secret_key)
+        if isinstance(secret_key, (list, tuple)):
+            key_ring = list(secret_key)
+        else:
+            key_ring = [secret_key]
+
+        if len(key_ring) == 0:
+            raise ValueError("secret_key must contain at least one key")
+
+        # キーID -> シリアライザ の辞書 (dict の挿入順 = 鍵リングの順)
+        # Key ID -> serializer (dict insertion order follows the key ring order)
+        self.serializers = {}
+        for key in key_ring:
+            self.serializers.setdefault(self.make_key_id(key), URLSafeTimedSerializer(key))
+
+        self.active_key_id = next(iter(self.serializers))
+        self.ser = self.serializers[self.active_key_id]
         self.expired_in = expired_in
 
-    def encode(self, dict_obj):
+    @staticmethod
+    def make_key_id(secret_key):
+        """
+        秘密鍵から短いキーIDを導出する(鍵リングの並べ替えに影響されない)
+        Derive a short key ID from a secret key (stable regardless of the order of the key ring).
+        """
+        return hashlib.sha256(want_bytes(secret_key)).hexdigest()[:8]
+
+    def encode(self, dict_obj, timestamp=None):
         """
         辞書オブジェクトを署名付きの文字列にエンコード
         署名にはタイムスタンプが付与されるので、デコード時に署名の期限切れも判定可能
         :param dict_obj: 辞書オブジェクトを想定
+        :param timestamp: 署名に使うタイムスタンプ(UNIX時間)。再署名時に元の有効期限を保つために使う
         :return: 署名付き文字列
 
         Encodes a dictionary object into a signed string.
         The signature includes a timestamp, so it is possible to determine if the signature has expired at the time of decoding.
         :param dict_obj: A dictionary object is expected.
+        :param timestamp: UNIX time to sign with. Used when re-signing so the original expiry is kept.
         :return: Signed string
         """
-        return self.ser.dumps(dict_obj)
+        if timestamp is None:
+            token = self.ser.dumps(dict_obj)
+        else:
+            signer = self.ser.make_signer()
+            signer.get_timestamp = lambda: int(timestamp)
+            token = signer.sign(want_bytes(self.ser.dump_payload(dict_obj))).decode("utf-8")
+
+        return f"{self.active_key_id}{self.KEY_ID_SEPARATOR}{token}"
 
     def decode(self, token):
         """
         署名付き文字列(token)を元のPythonのオブジェクトにデコード
         署名が有効期限切れの場合、署名が改ざんなどにより無効の場合は None
         :param token:
-        :param max_age:
         :return: デコードされたPythonのオブジェクトとエラーメッセージ
 
         Decodes a signed string (token) back into the original Python object.
         If the signature has expired or is invalid due to tampering, returns None.
         :param token:
-        :param max_age:
         :return: Decoded Python object and error message
         """
+        decoded_obj, err, _ = self.decode_with_info(token)
+        return decoded_obj, err
+
+    def decode_with_info(self, token):
+        """
+        decode と同じだが、署名に使われた鍵の情報も返す
+        :param token:
+        :return: デコードされたオブジェクト、エラーメッセージ、
+                 {"key_id": キーID, "is_active_key": 現在の署名鍵か, "timestamp": 署名時刻(UNIX時間)}
+
+        Same as decode, but also returns information about the key the token was signed with.
+        :param token:
+        :return: Decoded object, error message and
+                 {"key_id": key ID, "is_active_key": whether it is the current signing key, "timestamp": UNIX time of signing}
+        """
         if token == None:
-            return None, "NoTokenSpecified"
-        try:
-            if self.expired_in == 0:
-                decoded_obj = self.ser.loads(token)
-            else:
-                decoded_obj = self.ser.loads(token, max_age=self.expired_in)
-        except SignatureExpired as e:
-            # 署名が期限切れ
-            # The signature has expired
-            return None, "SignatureExpired"
-        except BadTimeSignature as e:
-            # 署名が無効
-            # The signature is invalid
-            return None, "InvalidSignature"
-
-        return decoded_obj, None
+            return None, "NoTokenSpecified", None
+
+        key_id, sep, signed = token.partition(self.KEY_ID_SEPARATOR)
+        serializer = self.serializers.get(key_id) if sep else None
+
+        if serializer is not None:
+            candidates = [(key_id, serializer)]
+        else:
+            # キーIDの無い旧形式のトークンは鍵リングを順に試す
+            # Legacy tokens without a key ID are tried against each key of the ring
+            candidates = list(self.serializers.items())
+            signed = token
+
+        err = "InvalidSignature"
+        for candidate_key_id, candidate in candidates:
+            try:
+                if self.expired_in == 0:
+                    decoded_obj, signed_at = candidate.loads(signed, return_timestamp=True)
+                else:
+                    decoded_obj, signed_at = candidate.loads(signed, max_age=self.expired_in, return_timestamp=True)
+            except SignatureExpired as e:
+                # 署名が期限切れ
+                # The signature has expired
+                return None, "SignatureExpired", None
+            except BadSignature as e:
+                # 署名が無効
+                # The signature is invalid
+                continue
+
+            info = {
+                "key_id": candidate_key_id,
+                "is_active_key": candidate_key_id == self.active_key_id and serializer is not None,
+                "timestamp": int(signed_at.timestamp()),
+            }
+            return decoded_obj, None, info
+
+        return None, err, None
 
 
 CASUAL_UT = False
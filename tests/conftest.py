@@ -0,0 +1,60 @@
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from fastsession import FastSessionMiddleware, MemoryStore
+
+
+class CountingMemoryStore(MemoryStore):
+    """
+    MemoryStore that counts get_store and create_store calls, optionally taking a while to answer them.
+
+    get_store と create_store の呼び出し回数を数え、指定すれば応答に時間がかかる MemoryStore
+    """
+
+    def __init__(self, get_delay=0, create_delay=0):
+        super().__init__()
+        self.get_delay = get_delay
+        self.create_delay = create_delay
+        self.get_calls = 0
+        self.create_calls = 0
+
+    def get_store(self, session_id):
+        self.get_calls += 1
+        time.sleep(self.get_delay)
+        return super().get_store(session_id)
+
+    def create_store(self, session_id):
+        self.create_calls += 1
+        time.sleep(self.create_delay)
+        return super().create_store(session_id)
+
+
+async def counter_route(request):
+    session = request.state.session.get_session()
+    session["test_counter"] = session.get("test_counter", 0) + 1
+    return PlainTextResponse(f"Counter: {session['test_counter']}")
+
+
+def create_client(store, routes=None, **kwargs):
+    """
+    Create a test client of an app with FastSessionMiddleware on the given store.
+
+    与えたストアで FastSessionMiddleware を使うアプリのテストクライアントを作る
+
+    :param routes: Routes of the app. Defaults to counter_route at "/"
+    :param kwargs: Further arguments of FastSessionMiddleware
+    """
+    app = Starlette(routes=routes if routes is not None else [Route("/", endpoint=counter_route)])
+    app.add_middleware(FastSessionMiddleware,
+                       secret_key='test-secret',
+                       store=store,
+                       max_age=3600,
+                       secure=False,
+                       session_cookie="sid",
+                       **kwargs
+                       )
+    return TestClient(app)
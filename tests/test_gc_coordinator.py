@@ -0,0 +1,209 @@
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from fastsession import FastSessionMiddleware, FileLease, GCCoordinator, MemoryStore, ShardedStore, StoreLease
+
+
+def create_store_with_expired_sessions(count, expired_every=2):
+    store = MemoryStore()
+    for i in range(count):
+        store.create_store(f"id-{i}")
+        if i % expired_every == 0:
+            store.raw_memory_store[f"id-{i}"]["created_at"] = int(time.time()) - store.max_session_age - 10
+    return store
+
+
+def test_sweep_expired_in_batches():
+    """
+    Test that sweep_expired works through the store in bounded batches and resumes from the cursor.
+
+    sweep_expired が上限付きのバッチでストアを掃除し、カーソルの位置から再開することをテスト
+    """
+    store = create_store_with_expired_sessions(100)
+
+    deleted, cursor = store.sweep_expired(None, 30)
+    assert deleted == 15
+    assert cursor == 30  # 最後に調べたセッションの作成順の番号。削除しても後ろのセッションの位置はずれない
+
+    total = deleted
+    while cursor is not None:
+        deleted, cursor = store.sweep_expired(cursor, 30)
+        total += deleted
+
+    assert total == 50
+    assert len(store.raw_memory_store) == 50
+    assert all(int(key.split("-")[1]) % 2 == 1 for key in store.raw_memory_store)
+
+
+def test_sweep_cursor_is_not_shifted_by_new_sessions():
+    """
+    Test that sessions created between batches do not make the sweep skip or revisit sessions.
+
+    バッチの間に作成されたセッションによって、掃除がセッションを飛ばしたり調べ直したりしないことをテスト
+    """
+    store = create_store_with_expired_sessions(100)
+
+    deleted, cursor = store.sweep_expired(None, 30)
+    total = deleted
+    for i in range(100, 120):
+        store.create_store(f"id-{i}")
+    while cursor is not None:
+        deleted, cursor = store.sweep_expired(cursor, 30)
+        total += deleted
+
+    assert total == 50
+    assert len(store.raw_memory_store) == 70
+
+
+def test_sharded_store_sweeps_node_by_node():
+    """
+    Test that ShardedStore sweeps its nodes one after another with a composite cursor.
+
+    ShardedStore が複合カーソルでノードを1つずつ掃除することをテスト
+    """
+    store = ShardedStore({f"node-{i}": create_store_with_expired_sessions(40) for i in range(3)})
+
+    total, cursor, batches = 0, None, 0
+    while True:
+        deleted, cursor = store.sweep_expired(cursor, 25)
+        total += deleted
+        batches += 1
+        if cursor is None:
+            break
+
+    assert total == 60
+    assert batches == 6
+
+
+def test_only_one_worker_sweeps_with_file_lease(tmp_path):
+    """
+    Test that while one worker holds the file lease, the others skip, and the checkpoint is handed over.
+
+    あるワーカーがファイルのリースを持つ間はほかのワーカーは何もせず、チェックポイントが引き継がれることをテスト
+    """
+    store = create_store_with_expired_sessions(100)
+    lease_path = str(tmp_path / "gc.lease")
+    worker_1 = GCCoordinator(store, FileLease(lease_path), batch_size=40, interval=0)
+    worker_2 = GCCoordinator(store, FileLease(lease_path), batch_size=40, interval=0)
+
+    holder = FileLease(lease_path)
+    assert holder.acquire()
+    assert worker_1.gc() is None
+    assert worker_1.stats["skipped"] == 1
+    holder.release(None)
+
+    assert worker_1.gc() == 20
+    assert worker_2.gc() == 20  # worker_1 のチェックポイントから続ける
+    assert worker_1.gc() == 10
+    assert worker_1.stats["cycles"] == 1
+    assert len(store.raw_memory_store) == 50
+
+
+def test_store_lease():
+    """
+    Test that a store-level lease excludes other owners until released or expired.
+
+    ストアのリースは解放されるか期限切れになるまで、ほかの所有者を締め出すことをテスト
+    """
+    store = MemoryStore()
+    lease_1 = StoreLease(store, ttl=60)
+    lease_2 = StoreLease(store, ttl=60)
+
+    assert lease_1.acquire()
+    assert not lease_2.acquire()
+    lease_1.release(42)
+
+    assert lease_2.acquire()
+    assert lease_2.checkpoint == 42
+
+    store.leases["gc"]["expires_at"] = 0  # lease_2 が落ちて期限切れになった
+    assert lease_1.acquire()
+
+
+def test_coordinator_respects_interval():
+    """
+    Test that a worker does not try to sweep again before the interval has passed.
+
+    間隔が経過するまでワーカーが掃除を再び試みないことをテスト
+    """
+    store = create_store_with_expired_sessions(10)
+    coordinator = GCCoordinator(store, StoreLease(store), batch_size=5, interval=3600)
+
+    assert coordinator.gc() == 3
+    assert coordinator.gc() is None
+    assert coordinator.stats["runs"] == 1
+
+
+def test_middleware_uses_coordinator_for_gc(tmp_path):
+    """
+    Test that the middleware sweeps through the coordinator when new sessions are created.
+
+    新規セッションの生成時に、ミドルウェアがコーディネーター経由で掃除することをテスト
+    """
+
+    async def index_route(request):
+        return PlainTextResponse("OK")
+
+    store = create_store_with_expired_sessions(10)
+    coordinator = GCCoordinator(store, FileLease(str(tmp_path / "gc.lease")), interval=0)
+    app = Starlette(routes=[Route("/", endpoint=index_route)])
+    app.add_middleware(FastSessionMiddleware, secret_key="test-secret", store=store, secure=False,
+                       gc_coordinator=coordinator)
+
+    TestClient(app).get("/")
+    assert coordinator.stats["swept"] == 5
+    assert len(store.raw_memory_store) == 6
+
+
+def test_middleware_runs_coordinator_off_the_event_loop(tmp_path):
+    """
+    Test that the middleware runs the coordinator's lease I/O and sweep in a worker thread, and that concurrent
+    gc calls on worker threads sweep at most once per interval.
+
+    ミドルウェアがコーディネーターのリースのI/Oと掃除をワーカースレッドで実行すること、
+    ワーカースレッドからの同時の gc 呼び出しでも間隔ごとに最大1回しか掃除しないことをテスト
+    """
+    import threading
+
+    async def index_route(request):
+        return PlainTextResponse("OK")
+
+    store = create_store_with_expired_sessions(10)
+    coordinator = GCCoordinator(store, FileLease(str(tmp_path / "gc.lease")), interval=0)
+    gc_threads = []
+    gc = coordinator.gc
+    coordinator.gc = lambda: gc_threads.append(threading.current_thread()) or gc()
+    app = Starlette(routes=[Route("/", endpoint=index_route)])
+    app.add_middleware(FastSessionMiddleware, secret_key="test-secret", store=store, secure=False,
+                       gc_coordinator=coordinator)
+
+    loop_threads = []
+
+    async def loop_route(request):
+        loop_threads.append(threading.current_thread())
+        return PlainTextResponse("OK")
+
+    app.add_route("/loop", loop_route)
+    client = TestClient(app)
+    client.get("/loop")
+    assert gc_threads and gc_threads[0] is not loop_threads[0]
+
+    coordinator = GCCoordinator(create_store_with_expired_sessions(10), FileLease(str(tmp_path / "gc2.lease")),
+                                interval=60)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def run():
+        barrier.wait()
+        results.append(coordinator.gc())
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(1 for result in results if result is not None) == 1
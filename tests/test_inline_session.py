@@ -0,0 +1,133 @@
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from fastsession import MemoryStore
+from tests.conftest import create_client
+
+
+def create_inline_client(store, endpoint):
+    return create_client(store, routes=[Route("/", endpoint=endpoint)], inline_session_max_bytes=512)
+
+
+def test_small_session_is_kept_in_cookie():
+    """
+    Test that a small session is carried in the cookie without touching the store.
+
+    小さなセッションはストアを使わずクッキーで保持されることをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        session["test_counter"] = session.get("test_counter", 0) + 1
+        return PlainTextResponse(f"Counter: {session['test_counter']}")
+
+    store = MemoryStore()
+    client = create_inline_client(store, test_route)
+
+    for i in range(1, 4):
+        response = client.get("/")
+        assert f"Counter: {i}" in response.text
+
+    assert store.raw_memory_store == {}  # ストアは使われていない
+
+
+def test_unchanged_inline_session_does_not_set_cookie():
+    """
+    Test that the cookie is not sent again when the inline session has not changed.
+
+    インラインセッションに変更がなければクッキーを送り直さないことをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        session.setdefault("locale", "ja")
+        return PlainTextResponse(session["locale"])
+
+    client = create_inline_client(MemoryStore(), test_route)
+
+    response = client.get("/")
+    assert "sid" in response.cookies
+    response = client.get("/")  # __cause__ が "success" に変わるので送り直す
+    assert "sid" in response.cookies
+    response = client.get("/")
+    assert response.text == "ja"
+    assert "sid" not in response.cookies
+
+
+def test_large_session_spills_to_store():
+    """
+    Test that a session growing past the threshold moves to the store and keeps its data.
+
+    閾値を超えたセッションはストアに移り、データが引き継がれることをテスト
+    """
+
+    async def test_route(request):
+        session_mgr = request.state.session
+        session = session_mgr.get_session()
+        session["test_counter"] = session.get("test_counter", 0) + 1
+        if session["test_counter"] == 2:
+            session["cart"] = ["item-%04d" % i for i in range(200)]
+        return PlainTextResponse(f"Counter: {session['test_counter']} Items: {len(session.get('cart', []))}")
+
+    store = MemoryStore()
+    client = create_inline_client(store, test_route)
+
+    response = client.get("/")
+    assert "Counter: 1 Items: 0" in response.text
+    assert store.raw_memory_store == {}
+
+    response = client.get("/")
+    assert "Counter: 2 Items: 200" in response.text
+    assert len(store.raw_memory_store) == 1  # ストアに移った
+    assert len(response.cookies["sid"]) < 512  # クッキーにはセッションIDのみ
+
+    response = client.get("/")
+    assert "Counter: 3 Items: 200" in response.text
+
+
+def test_failed_spill_keeps_inline_cookie():
+    """
+    Test that when spilling to the store fails (here the session quota is exceeded), the response still succeeds
+    and the client keeps its current inline cookie.
+
+    ストアへの移動に失敗しても(ここではセッションのバイト数の上限を超える)、レスポンスは成功し、
+    クライアントは今のインラインセッションのクッキーを使い続けることをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        session["test_counter"] = session.get("test_counter", 0) + 1
+        if request.query_params.get("fill"):
+            session["cart"] = ["item-%04d" % i for i in range(200)]
+        return PlainTextResponse(f"Counter: {session['test_counter']}")
+
+    store = MemoryStore(max_session_bytes=1024)
+    client = create_inline_client(store, test_route)
+    assert client.get("/").text == "Counter: 1"
+
+    response = client.get("/?fill=1")
+    assert response.status_code == 200
+    assert "sid" not in response.cookies
+    assert store.raw_memory_store == {}
+    assert client.get("/").text == "Counter: 2"  # 失敗したリクエストの変更は捨てられた
+
+
+def test_spilled_session_is_indexed():
+    """
+    Test that a session spilled to the store is indexed, so it can be found and revoked.
+
+    ストアに移したセッションは索引され、検索・失効できることをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        session["user_id"] = "alice"
+        session["cart"] = ["item-%04d" % i for i in range(200)]
+        return PlainTextResponse("ok")
+
+    store = MemoryStore(index_key="user_id")
+    client = create_inline_client(store, test_route)
+    client.get("/")
+
+    assert store.find_sessions("alice") == list(store.raw_memory_store)
+    assert store.revoke_user("alice") == 1
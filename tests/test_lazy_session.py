@@ -0,0 +1,142 @@
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from fastsession import FastSessionMiddleware, HashMemoryStore
+
+
+def test_fields_are_fetched_on_first_access():
+    """
+    Test that fields are fetched only when accessed, and several at once with prefetch.
+
+    フィールドはアクセスされたときだけ取得され、prefetch では複数まとめて取得されることをテスト
+    """
+    store = HashMemoryStore()
+    session = store.create_store("test-id")
+    session.update({"locale": "ja", "cart": list(range(100)), "wizard": {"step": 3}})
+    session.flush()
+
+    session = store.get_store("test-id")
+    assert store.stats["get_fields_calls"] == 0
+
+    assert session["locale"] == "ja"
+    assert store.stats["fields_fetched"] == 1  # cart と wizard は取得していない
+
+    session.prefetch("cart", "wizard")
+    assert store.stats["get_fields_calls"] == 2
+    assert session["wizard"] == {"step": 3}
+    assert store.stats["get_fields_calls"] == 2
+
+    assert sorted(session) == ["cart", "locale", "wizard"]
+    assert "missing" not in session
+
+
+def test_flush_writes_back_only_changed_fields():
+    """
+    Test that flush writes back only changed fields, including in-place changes of nested values.
+
+    flush は変更されたフィールドだけを書き戻し、入れ子の値のその場での変更も書き戻すことをテスト
+    """
+    store = HashMemoryStore()
+    session = store.create_store("test-id")
+    session.update({"locale": "ja", "cart": [1], "wizard": {"step": 3}})
+    session.flush()
+    store.stats["fields_written"] = 0
+
+    session = store.get_store("test-id")
+    session["cart"].append(2)  # 入れ子の値をその場で変更
+    _ = session["locale"]  # 読むだけ
+    del session["wizard"]
+    session.flush()
+
+    assert store.stats["fields_written"] == 1
+    session = store.get_store("test-id")
+    assert session.copy() == {"locale": "ja", "cart": [1, 2]}
+
+
+def test_middleware_with_hash_store():
+    """
+    Test that the middleware writes back lazily loaded sessions at the end of each request.
+
+    ミドルウェアがリクエストの最後に遅延読み込みしたセッションを書き戻すことをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        if "test_counter" not in session:
+            session["test_counter"] = 0
+            session["cart"] = list(range(1000))
+
+        session["test_counter"] += 1
+
+        return PlainTextResponse(f"Counter: {session['test_counter']}")
+
+    store = HashMemoryStore()
+    app = Starlette(routes=[Route("/", endpoint=test_route)])
+    app.add_middleware(FastSessionMiddleware,
+                       secret_key='test-secret',
+                       store=store,
+                       max_age=3600,
+                       secure=False,
+                       session_cookie="sid"
+                       )
+    client = TestClient(app)
+
+    for i in range(1, 4):
+        assert f"Counter: {i}" in client.get("/").text
+
+    assert store.stats["fields_fetched"] == 2  # 2回目と3回目のリクエストで test_counter だけを取得
+
+
+def test_read_only_requests_write_nothing():
+    """
+    Test that requests which only read the session write no fields back, and that a missing key
+    is fetched only once.
+
+    セッションを読むだけのリクエストではフィールドを書き戻さず、存在しないキーは一度だけ取得することをテスト
+    """
+
+    async def read_route(request):
+        session = request.state.session.get_session()
+        session.get("missing")
+        session.get("missing")
+        return PlainTextResponse(f"theme: {session.get('theme')}")
+
+    store = HashMemoryStore()
+    app = Starlette(routes=[Route("/", endpoint=read_route)])
+    app.add_middleware(FastSessionMiddleware, secret_key='test-secret', store=store, secure=False)
+    client = TestClient(app)
+
+    client.get("/")
+    session_id = next(iter(store.raw_memory_store))
+    session = store.get_store(session_id)
+    session["theme"] = "dark"
+    session.flush()
+
+    set_calls = store.stats["set_fields_calls"]
+    get_calls = store.stats["get_fields_calls"]
+    for _ in range(5):
+        assert client.get("/").text == "theme: dark"
+
+    assert store.stats["set_fields_calls"] == set_calls
+    assert store.stats["get_fields_calls"] == get_calls + 10  # リクエストごとに "missing" と "theme" を1回ずつ
+
+
+def test_rewriting_same_value_is_not_written_back():
+    """
+    Test that assigning a field the value it was fetched with does not write it back.
+
+    取得したときと同じ値をフィールドに代入しても書き戻さないことをテスト
+    """
+    store = HashMemoryStore()
+    store.create_store("id-1")
+    session = store.get_store("id-1")
+    session["theme"] = "dark"
+    session.flush()
+
+    session = store.get_store("id-1")
+    session["theme"] = session["theme"]
+    calls = store.stats["set_fields_calls"]
+    session.flush()
+    assert store.stats["set_fields_calls"] == calls
@@ -0,0 +1,175 @@
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from fastsession import FastSessionMiddleware, MemoryStore
+
+
+def test_snapshot_and_restore(tmp_path):
+    """
+    Test that sessions written to a snapshot are restored lazily and expired ones are skipped.
+
+    スナップショットに書き出したセッションが遅延して復元され、期限切れのものは読み飛ばされることをテスト
+    """
+    path = str(tmp_path / "sessions.snapshot")
+
+    store = MemoryStore()
+    for i in range(10):
+        store.create_store(f"id-{i}")["n"] = i
+    store.raw_memory_store["id-0"]["created_at"] -= 3600 * 13  # 期限切れにする
+    store.create_store("not-json")["obj"] = object()
+
+    assert store.snapshot(path) == {"written": 10, "skipped": 1}
+
+    restored = MemoryStore()
+    assert restored.restore(path) == 9
+    assert restored.get_store("id-0") is None
+    assert restored.raw_memory_store["id-5"]["store"] is None  # まだデコードされていない
+    assert restored.get_store("id-5") == {"n": 5}
+    assert restored.raw_memory_store["id-5"]["created_at"] == store.raw_memory_store["id-5"]["created_at"]
+
+
+def test_restore_rebuilds_index(tmp_path):
+    """
+    Test that the secondary index is available right after restore, without decoding sessions.
+
+    restore 直後からセッションをデコードせずに索引が使えることをテスト
+    """
+    path = str(tmp_path / "sessions.snapshot")
+
+    store = MemoryStore(index_key="user_id")
+    for i in range(4):
+        store.create_store(f"id-{i}")["user_id"] = "alice" if i < 3 else "bob"
+    store.snapshot(path)
+
+    restored = MemoryStore(index_key="user_id")
+    restored.restore(path)
+    assert sorted(restored.find_sessions("alice")) == ["id-0", "id-1", "id-2"]
+    assert restored.revoke_user("alice") == 3
+    assert restored.get_store("id-3") == {"user_id": "bob"}
+
+
+def test_snapshot_on_lifespan(tmp_path):
+    """
+    Test that the middleware writes the snapshot at shutdown and restores it at startup.
+
+    ミドルウェアが終了時にスナップショットを書き出し、起動時に復元することをテスト
+    """
+    path = str(tmp_path / "sessions.snapshot")
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        session["test_counter"] = session.get("test_counter", 0) + 1
+        return PlainTextResponse(f"Counter: {session['test_counter']}")
+
+    def create_app():
+        app = Starlette(routes=[Route("/", endpoint=test_route)])
+        app.add_middleware(FastSessionMiddleware,
+                           secret_key='test-secret',
+                           store=MemoryStore(),
+                           max_age=3600,
+                           secure=False,
+                           session_cookie="sid",
+                           snapshot_path=path
+                           )
+        return app
+
+    with TestClient(create_app()) as client:
+        assert "Counter: 1" in client.get("/").text
+        assert "Counter: 2" in client.get("/").text
+        cookie = client.cookies["sid"]
+
+    # 再起動後もセッションが続く
+    with TestClient(create_app()) as client:
+        client.cookies.set("sid", cookie)
+        assert "Counter: 3" in client.get("/").text
+
+
+def test_snapshot_reader_closed_once_sessions_are_materialised(tmp_path):
+    """
+    Test that the memory-mapped snapshot is closed once every restored session is decoded or deleted.
+
+    復元した全セッションがデコードまたは削除されると、mmap したスナップショットが閉じられることをテスト
+    """
+    path = str(tmp_path / "sessions.snapshot")
+    store = MemoryStore()
+    for i in range(3):
+        store.create_store(f"id-{i}")["n"] = i
+    store.snapshot(path)
+
+    restored = MemoryStore()
+    restored.restore(path)
+    reader = next(iter(restored.snapshot_readers))
+
+    restored.get_store("id-0")
+    restored.delete_store("id-1")
+    assert not reader.mm.closed
+    restored.get_store("id-2")
+    assert reader.mm.closed
+    assert restored.snapshot_readers == {}
+
+    restored.create_store("id-1")
+    restored.restore(path)  # 全セッションが既にあるので、何も参照しないスナップショットはすぐ閉じる
+    assert restored.snapshot_readers == {}
+
+
+def test_concurrent_snapshots_to_the_same_path(tmp_path):
+    """
+    Test that workers writing snapshots to the same path do not clobber each other's temporary file.
+
+    同じパスにスナップショットを書き出すワーカーが、互いの一時ファイルを壊さないことをテスト
+    """
+    import os
+    import threading
+
+    path = str(tmp_path / "sessions.snapshot")
+    stores = []
+    for worker in range(4):
+        store = MemoryStore()
+        for i in range(500):
+            store.create_store(f"w{worker}-{i}")["data"] = "x" * 100
+        stores.append(store)
+
+    threads = [threading.Thread(target=store.snapshot, args=(path,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert os.listdir(tmp_path) == ["sessions.snapshot"]
+    assert MemoryStore().restore(path) == 500  # どれか1つのワーカーの完全なスナップショット
+
+
+def test_each_worker_writes_its_own_snapshot(tmp_path):
+    """
+    Test that each worker process writes its snapshot to its own file, that startup merges the files
+    of every worker, and that files merged at startup are replaced by this worker's file at shutdown.
+
+    ワーカープロセスごとに別のファイルへスナップショットを書き出し、起動時に全ワーカーのファイルをまとめて復元し、
+    起動時にまとめたファイルは終了時にこのワーカーのファイルに置き換わることをテスト
+    """
+    path = str(tmp_path / "sessions.snapshot")
+    for pid, session_id in [(111, "worker-1"), (222, "worker-2")]:
+        store = MemoryStore()
+        store.create_store(session_id)["by"] = session_id
+        store.snapshot(f"{path}.{pid}")
+        os.utime(f"{path}.{pid}", (time.time() - 60, time.time() - 60))  # 以前の実行のワーカーのファイル
+
+    store = MemoryStore()
+    app = Starlette(routes=[])
+    app.add_middleware(FastSessionMiddleware, secret_key='test-secret', store=store, secure=False,
+                       snapshot_path=path)
+    with TestClient(app):
+        assert store.get_store("worker-1") == {"by": "worker-1"}
+        assert store.get_store("worker-2") == {"by": "worker-2"}
+        running = MemoryStore()
+        running.snapshot(f"{path}.333")  # 同時に動いている他のワーカーが起動後に書き出した
+        os.utime(f"{path}.333", (time.time() + 60, time.time() + 60))
+
+    assert sorted(os.listdir(tmp_path)) == sorted(["sessions.snapshot.333", f"sessions.snapshot.{os.getpid()}"])
+    merged = MemoryStore()
+    assert merged.restore(f"{path}.{os.getpid()}") == 2
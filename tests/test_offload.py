@@ -0,0 +1,154 @@
+import threading
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from fastsession import FastSessionMiddleware, HashMemoryStore, MemoryStore
+from fastsession.lazy_session import LazySession
+from fastsession.offload import Offloader, estimate_encoded_size
+from fastsession.session_client_store import RemoteSession
+
+
+@pytest.mark.asyncio
+async def test_offloader_runs_large_payloads_in_worker():
+    """
+    Test that calls below the threshold run inline and larger ones run in the worker pool.
+
+    閾値未満の呼び出しはその場で、それ以上はワーカープールで実行されることをテスト
+    """
+    offloader = Offloader(threshold=1024, max_workers=2)
+    main_thread = threading.current_thread()
+
+    assert await offloader.run(threading.current_thread, size=10) is main_thread
+    assert await offloader.run(threading.current_thread, size=4096) is not main_thread
+
+    assert offloader.stats["inline"] == 1
+    assert offloader.stats["offloaded"] == 1
+    assert offloader.stats["inline_block_seconds"] >= 0
+    offloader.shutdown()
+
+
+def test_large_restored_session_is_decoded_in_worker(tmp_path):
+    """
+    Test that the middleware decodes a large restored session in the worker pool and a small one inline.
+
+    ミドルウェアが復元した大きなセッションをワーカープールで、小さなセッションをその場でデコードすることをテスト
+    """
+    path = str(tmp_path / "sessions.snapshot")
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        return PlainTextResponse(f"Items: {len(session.get('cart', []))}")
+
+    store = MemoryStore()
+    app = Starlette(routes=[Route("/", endpoint=test_route)])
+    app.add_middleware(FastSessionMiddleware,
+                       secret_key='test-secret',
+                       store=store,
+                       max_age=3600,
+                       secure=False,
+                       session_cookie="sid",
+                       offload_threshold=1024
+                       )
+
+    small_client = TestClient(app)
+    large_client = TestClient(app)
+    small_client.get("/")
+    large_client.get("/")
+
+    large_session_id = [session_id for session_id in store.raw_memory_store][1]
+    store.get_store(large_session_id)["cart"] = [f"item-{i}-{i * 7919 % 10007}" for i in range(5000)]
+
+    store.snapshot(path)
+    store.raw_memory_store.clear()
+    store.restore(path)
+    offloader = app.middleware_stack.app.offloader  # ServerErrorMiddleware の内側が FastSessionMiddleware
+    offloader.stats["offloaded"] = offloader.stats["inline"] = 0
+
+    assert "Items: 0" in small_client.get("/").text
+    assert offloader.stats["offloaded"] == 0
+    assert "Items: 5000" in large_client.get("/").text
+    assert offloader.stats["offloaded"] == 1
+
+
+def test_pending_payload_size_counts_written_values():
+    """
+    Test that the pending payload size of a lazy session includes values written since it was loaded.
+
+    遅延読み込みセッションの書き戻し予定サイズに、読み込み後に書き込まれた値が含まれることをテスト
+    """
+    store = HashMemoryStore()
+    store.create_store("id-1")
+    session = LazySession(store, "id-1")
+    assert session.pending_payload_size() == 0
+
+    cart = [f"item-{i:06d}" for i in range(100000)]
+    session["cart"] = cart
+    estimate = session.pending_payload_size()
+    assert estimate == estimate_encoded_size(cart)
+    assert estimate >= 1024 * 1024
+
+    remote = RemoteSession(None, "id-2", 0)
+    remote["cart"] = cart
+    assert remote.pending_payload_size() >= 1024 * 1024
+
+
+def test_large_write_to_new_session_is_encoded_in_worker():
+    """
+    Test that the middleware encodes a large value written to a new session in the worker pool.
+
+    新しいセッションに書き込まれた大きな値を、ミドルウェアがワーカープールでエンコードすることをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        session["cart"] = [f"item-{i:06d}" for i in range(100000)]  # 約1MB
+        return PlainTextResponse("OK")
+
+    store = HashMemoryStore()
+    app = Starlette(routes=[Route("/", endpoint=test_route)])
+    app.add_middleware(FastSessionMiddleware,
+                       secret_key='test-secret',
+                       store=store,
+                       max_age=3600,
+                       secure=False,
+                       session_cookie="sid",
+                       offload_threshold=64 * 1024
+                       )
+
+    client = TestClient(app)
+    assert client.get("/").text == "OK"
+    offloader = app.middleware_stack.app.offloader  # ServerErrorMiddleware の内側が FastSessionMiddleware
+    assert offloader.stats["offloaded"] >= 1
+
+    session_id = list(store.raw_memory_store)[0]
+    assert len(store.get_store(session_id)["cart"]) == 100000
+
+
+@pytest.mark.asyncio
+async def test_lazy_session_aprefetch_decodes_large_fields_in_worker():
+    """
+    Test that aprefetch decodes large fields in the offload worker pool and small ones inline.
+
+    aprefetch が大きなフィールドをオフロード用のワーカープールで、小さなフィールドをその場でデコードすることをテスト
+    """
+    store = HashMemoryStore()
+    session = store.create_store("id-1")
+    session["small"] = 1
+    session["large"] = list(range(2000))
+    session.flush()
+
+    offloader = Offloader(threshold=1024, max_workers=1)
+    session = store.get_store("id-1")
+    session.offloader = offloader
+
+    await session.aprefetch("small")
+    assert offloader.stats == {**offloader.stats, "inline": 1, "offloaded": 0}
+    await session.aprefetch("large", "missing")
+    assert offloader.stats["offloaded"] == 1
+    assert session["large"] == list(range(2000))
+    assert "missing" not in session
+    offloader.shutdown()
@@ -0,0 +1,102 @@
+import pytest
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from fastsession import FastSessionMiddleware, HashMemoryStore, MemoryStore
+from fastsession.session_conflict import merge_sessions
+from tests.conftest import counter_route, create_client
+
+
+def test_merge_sessions():
+    """
+    Test that the three-way merge applies this request's changed keys on top of the other request's session.
+
+    3方向マージで、このリクエストが変更したキーが他のリクエストのセッションに重なることをテスト
+    """
+    base = {"cart": ["a"], "theme": "light", "tmp": 1}
+    mine = {"cart": ["a", "b"], "theme": "light"}  # cart を変更し、tmp を削除
+    theirs = {"cart": ["a"], "theme": "dark", "tmp": 1, "visits": 2}  # theme を変更し、visits を追加
+
+    assert merge_sessions(base, mine, theirs) == {"cart": ["a", "b"], "theme": "dark", "visits": 2}
+
+
+def create_race_client(store, **kwargs):
+    async def race_route(request):
+        # セッションを読み込んだ後に、別のノードのリクエストが同じセッションを保存したことを模す
+        session_mgr = request.state.session
+        session_mgr.get_session()["mine"] = "A"
+        other_store, version = store.get_store_versioned(session_mgr.get_session_id())
+        other_store["theirs"] = "B"
+        other_store["test_counter"] = 10
+        store.save_store_if_version(session_mgr.get_session_id(), other_store, version)
+        return PlainTextResponse("OK")
+
+    return create_client(store, routes=[Route("/", endpoint=counter_route), Route("/race", endpoint=race_route)], **kwargs)
+
+
+def run_race(conflict_policy):
+    store = MemoryStore()
+    client = create_race_client(store, conflict_policy=conflict_policy)
+    assert client.get("/").text == "Counter: 1"
+    client.get("/race")
+    session_id = next(iter(store.raw_memory_store))
+    return store.get_store(session_id)
+
+
+def test_versioned_session_is_saved_at_response():
+    """
+    Test that a versioned session is saved at the end of the request without calling save_session.
+
+    バージョン付きのセッションは save_session を呼ばなくてもリクエストの終わりに保存されることをテスト
+    """
+    store = MemoryStore()
+    client = create_race_client(store, conflict_policy="merge")
+
+    assert client.get("/").text == "Counter: 1"
+    assert client.get("/").text == "Counter: 2"
+    assert client.get("/").text == "Counter: 3"
+
+
+@pytest.mark.parametrize("conflict_policy, expected", [
+    ("merge", {"mine": "A", "theirs": "B", "test_counter": 10}),
+    ("overwrite", {"mine": "A", "test_counter": 1}),
+    ("discard", {"theirs": "B", "test_counter": 10}),
+])
+def test_conflict_policies(conflict_policy, expected):
+    """
+    Test how each conflict policy resolves a save that raced with another request.
+
+    他のリクエストの保存と競合したときに、各ポリシーがどう解決するかをテスト
+    """
+    session_store = run_race(conflict_policy)
+    assert {key: value for key, value in session_store.items() if key != "__cause__"} == expected
+
+
+def test_conflict_policy_callable():
+    """
+    Test that a callable conflict policy decides what is saved.
+
+    関数を指定すると、それが保存する内容を決めることをテスト
+    """
+    calls = []
+
+    def resolve(base, mine, theirs):
+        calls.append((dict(base), dict(mine), dict(theirs)))
+        return {**theirs, "mine": mine["mine"] + "+" + theirs["theirs"]}
+
+    session_store = run_race(resolve)
+    assert session_store["mine"] == "A+B"
+    assert len(calls) == 1
+    assert "mine" not in calls[0][0] and calls[0][1]["mine"] == "A"
+
+
+def test_conflict_policy_requires_versioned_store():
+    """
+    Test that conflict_policy is rejected for a store without versioned saves.
+
+    バージョン付きの保存ができないストアでは conflict_policy を指定できないことをテスト
+    """
+    with pytest.raises(ValueError):
+        FastSessionMiddleware(None, secret_key="test-secret", store=HashMemoryStore(), conflict_policy="merge")
+    with pytest.raises(ValueError):
+        FastSessionMiddleware(None, secret_key="test-secret", store=MemoryStore(), conflict_policy="first_wins")
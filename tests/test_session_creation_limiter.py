@@ -0,0 +1,82 @@
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from fastsession import FastSessionMiddleware, MemoryStore, SessionCreationLimiter
+
+
+def test_limiter_per_client_bucket():
+    """
+    Test that each client can only create up to its burst of sessions.
+
+    クライアントごとにバースト数までしかセッションを生成できないことをテスト
+    """
+    limiter = SessionCreationLimiter(per_client_rate=0.001, per_client_burst=3, global_rate=None)
+
+    client_a = {"type": "http", "client": ("10.0.0.1", 1234)}
+    client_b = {"type": "http", "client": ("10.0.0.2", 1234)}
+
+    assert [limiter.allow(client_a) for _ in range(5)] == [True, True, True, False, False]
+    assert limiter.allow(client_b)  # 別のクライアントには影響しない
+    assert limiter.stats == {"allowed": 4, "limited_by_client": 2, "limited_by_global": 0}
+
+
+def test_limiter_global_budget():
+    """
+    Test that the global budget limits session creation across clients.
+
+    全体の予算がクライアントをまたいでセッション生成を制限することをテスト
+    """
+    limiter = SessionCreationLimiter(per_client_rate=None, global_rate=0.001, global_burst=2)
+
+    results = [limiter.allow({"type": "http", "client": (f"10.0.0.{i}", 1234)}) for i in range(4)]
+    assert results == [True, True, False, False]
+    assert limiter.stats["limited_by_global"] == 2
+
+
+def test_limiter_evicts_least_recently_used_clients():
+    """
+    Test that the number of per-client buckets is bounded.
+
+    クライアントごとのバケット数に上限があることをテスト
+    """
+    limiter = SessionCreationLimiter(per_client_rate=1.0, global_rate=None, max_clients=10)
+    for i in range(100):
+        limiter.allow({"type": "http", "client": (f"10.0.{i}.1", 1234)})
+    assert len(limiter.client_buckets) == 10
+
+
+def test_over_limit_request_gets_transient_session():
+    """
+    Test that requests over the limit get a transient session that is not stored and sets no cookie.
+
+    制限を超えたリクエストには、ストアに保存されずクッキーも発行されない一時的なセッションが割り当てられることをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        return PlainTextResponse("transient" if session.get("__transient__") else "stored")
+
+    store = MemoryStore()
+    limiter = SessionCreationLimiter(per_client_rate=0.001, per_client_burst=2, global_rate=None)
+
+    app = Starlette(routes=[Route("/", endpoint=test_route)])
+    app.add_middleware(FastSessionMiddleware,
+                       secret_key='test-secret',
+                       store=store,
+                       max_age=3600,
+                       secure=False,
+                       session_cookie="sid",
+                       session_creation_limiter=limiter
+                       )
+
+    texts = []
+    for _ in range(4):
+        client = TestClient(app)  # 毎回クッキーなしでアクセスする
+        response = client.get("/")
+        texts.append((response.text, "sid" in response.cookies))
+
+    assert texts == [("stored", True), ("stored", True), ("transient", False), ("transient", False)]
+    assert len(store.raw_memory_store) == 2
+    assert limiter.stats["limited_by_client"] == 2
@@ -0,0 +1,57 @@
+import io
+
+import pytest
+
+from fastsession import MemoryStore
+from fastsession.__main__ import main
+from fastsession.session_export import export_sessions, import_sessions
+
+# CLI のテストで "tests.test_session_export:exported_store" として読み込むストア
+exported_store = MemoryStore()
+imported_store = MemoryStore()
+
+
+def test_export_and_import_ndjson():
+    """
+    Test that sessions exported as NDJSON can be imported into another store.
+
+    NDJSONとしてエクスポートしたセッションを別のストアにインポートできることをテスト
+    """
+    src = MemoryStore()
+    for i in range(3):
+        src.create_store(f"id-{i}")["user"] = f"user-{i}"
+
+    fp = io.StringIO()
+    assert export_sessions(src, fp) == 3
+    assert len(fp.getvalue().splitlines()) == 3
+
+    fp.seek(0)
+    dst = MemoryStore()
+    assert import_sessions(dst, fp) == 3
+    assert dst.get_store("id-2") == {"user": "user-2"}
+
+
+def test_cli_export_and_import(tmp_path):
+    """
+    Test the export and import commands of the command line interface.
+
+    コマンドラインインターフェイスのエクスポート・インポートをテスト
+    """
+    exported_store.create_store("cli-id")["user"] = "cli-user"
+    path = str(tmp_path / "sessions.ndjson")
+
+    assert main(["export", "tests.test_session_export:exported_store", "-o", path, "--allow-process-local"]) == 0
+    assert main(["import", "tests.test_session_export:imported_store", "-i", path, "--allow-process-local"]) == 0
+    assert imported_store.get_store("cli-id") == {"user": "cli-user"}
+
+
+def test_cli_refuses_process_local_store(tmp_path, capsys):
+    """
+    Test that the command line interface refuses a process-local store, which would be empty in its own process.
+
+    コマンドラインインターフェイスは、自身のプロセスでは空になるプロセス内のストアを断ることをテスト
+    """
+    path = str(tmp_path / "sessions.ndjson")
+    with pytest.raises(SystemExit):
+        main(["export", "tests.test_session_export:exported_store", "-o", path])
+    assert "process-local" in capsys.readouterr().err
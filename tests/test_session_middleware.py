@@ -394,3 +394,78 @@ async def test_dispatch_should_not_skip_session_management_without_skip_heade1r(
     response = await middleware.dispatch(request, call_next)
     print(f"res:{response}")
     assert hasattr(request.state, 'session')  # request.stateにsession属性が存在することを確認します
+
+
+def test_session_survives_secret_key_rotation():
+    """
+    Test that rotating the secret key keeps the session and re-signs the cookie with the new key.
+
+    秘密鍵をローテーションしてもセッションが維持され、クッキーが新しい鍵で再署名されることをテストする。
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        if "test_counter" not in session:
+            session["test_counter"] = 0
+
+        session["test_counter"] += 1
+
+        return PlainTextResponse(f"Counter: {session['test_counter']}")
+
+    store = MemoryStore()
+
+    def create_client(secret_key):
+        app = Starlette(routes=[Route("/", endpoint=test_route)])
+        app.add_middleware(FastSessionMiddleware,
+                           secret_key=secret_key,
+                           store=store,
+                           max_age=3600,
+                           secure=False,
+                           session_cookie="sid",
+                           resign_probability=1.0
+                           )
+        return TestClient(app)
+
+    old_client = create_client("old-secret")
+    response = old_client.get("/")
+    assert "Counter: 1" in response.text
+    old_cookie = response.cookies["sid"]
+
+    new_client = create_client(["new-secret", "old-secret"])
+    new_client.cookies.set("sid", old_cookie)
+    response = new_client.get("/")
+    assert "Counter: 2" in response.text  # セッションが維持されている
+    new_cookie = response.cookies["sid"]
+    assert new_cookie != old_cookie  # 新しい鍵で再署名されている
+
+    response = new_client.get("/")
+    assert "Counter: 3" in response.text
+    assert "sid" not in response.cookies  # 新しい鍵のクッキーは再署名しない
+
+
+def test_index_updated_without_save_session():
+    """
+    Test that writes to the indexed key are reflected in the index at the end of the request,
+    even when the handler never calls save_session.
+
+    ハンドラーが save_session を呼ばなくても、索引するキーへの書き込みがリクエストの終わりに索引に反映されることをテスト
+    """
+
+    async def login_route(request):
+        session = request.state.session.get_session()
+        session["user_id"] = request.query_params["user"]
+        return PlainTextResponse("OK")
+
+    store = MemoryStore(index_key="user_id")
+    app = Starlette(routes=[Route("/login", endpoint=login_route)])
+    app.add_middleware(FastSessionMiddleware, secret_key="test-secret", store=store, secure=False)
+    client = TestClient(app)
+
+    client.get("/login?user=alice")
+    client.get("/login?user=alice")
+    assert len(store.find_sessions("alice")) == 1
+
+    client.get("/login?user=bob")
+    assert store.find_sessions("alice") == []
+    assert store.revoke_user("bob") == 1
+    assert len(store.raw_memory_store) == 0
@@ -0,0 +1,153 @@
+from fastapi import APIRouter, Depends, FastAPI
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
+from starlette.testclient import TestClient
+
+from fastsession import FastSessionMiddleware, MemoryStore, SessionPolicy, session_policy
+from tests.conftest import counter_route, create_client
+
+
+@session_policy("read_only")
+async def read_route(request):
+    session_mgr = request.state.session
+    return PlainTextResponse(f"Counter: {session_mgr.get_session().get('test_counter')} read_only: {session_mgr.read_only}")
+
+
+@session_policy("none")
+async def health_route(request):
+    return PlainTextResponse(f"has_session: {hasattr(request.state, 'session')}")
+
+
+ROUTES = [
+    Route("/", endpoint=counter_route),
+    Route("/read", endpoint=read_route),
+    Route("/health", endpoint=health_route),
+]
+
+
+def test_read_only_route_does_not_create_session():
+    """
+    Test that a read-only route neither creates a session nor sets a cookie.
+
+    読み取り専用のルートではセッションが生成されず、クッキーもセットされないことをテスト
+    """
+    store = MemoryStore()
+    client = create_client(store, routes=list(ROUTES))
+
+    response = client.get("/read")
+    assert response.text == "Counter: None read_only: False"  # 一時的なセッション
+    assert "set-cookie" not in response.headers
+    assert len(store.raw_memory_store) == 0
+
+
+def test_read_only_route_reads_existing_session():
+    """
+    Test that a read-only route sees the existing session but cannot change it.
+
+    読み取り専用のルートは既存のセッションを読めるが、変更はできないことをテスト
+    """
+    store = MemoryStore()
+    client = create_client(store, routes=list(ROUTES))
+
+    assert client.get("/").text == "Counter: 1"
+    response = client.get("/read")
+    assert response.text == "Counter: 1 read_only: True"
+    assert "set-cookie" not in response.headers
+    assert client.get("/").text == "Counter: 2"
+
+
+def test_read_only_session_is_immutable():
+    """
+    Test that writing to the session on a read-only route fails.
+
+    読み取り専用のルートでセッションに書き込むと失敗することをテスト
+    """
+
+    @session_policy("read_only")
+    async def write_route(request):
+        try:
+            request.state.session.get_session()["test_counter"] = 100
+        except TypeError:
+            return PlainTextResponse("rejected")
+        return PlainTextResponse("written")
+
+    store = MemoryStore()
+    client = create_client(store, routes=list(ROUTES))
+    client.app.router.routes.append(Route("/write", endpoint=write_route))
+
+    client.get("/")
+    assert client.get("/write").text == "rejected"
+    assert client.get("/").text == "Counter: 2"
+
+
+def test_none_route_skips_session():
+    """
+    Test that a route declared "none" gets no session at all.
+
+    "none" を宣言したルートにはセッションが一切用意されないことをテスト
+    """
+    store = MemoryStore()
+    client = create_client(store, routes=list(ROUTES))
+
+    response = client.get("/health")
+    assert response.text == "has_session: False"
+    assert "set-cookie" not in response.headers
+    assert len(store.raw_memory_store) == 0
+
+
+def test_session_policy_dependency():
+    """
+    Test that the policy can be declared with a FastAPI dependency on a route or router.
+
+    FastAPI の依存関係でルートやルーターにセッションの扱いを宣言できることをテスト
+    """
+    app = FastAPI()
+    router = APIRouter(dependencies=[Depends(SessionPolicy("none"))])
+
+    @router.get("/internal/health")
+    async def health(request: Request):
+        return {"has_session": hasattr(request.state, "session")}
+
+    @app.get("/read", dependencies=[Depends(SessionPolicy("read_only"))])
+    async def read(request: Request):
+        return {"read_only": request.state.session.read_only}
+
+    @app.get("/")
+    async def counter(request: Request):
+        session = request.state.session.get_session()
+        session["test_counter"] = session.get("test_counter", 0) + 1
+        return {"counter": session["test_counter"]}
+
+    app.include_router(router)
+    store = MemoryStore()
+    app.add_middleware(FastSessionMiddleware, secret_key='test-secret', store=store, max_age=3600, secure=False)
+    client = TestClient(app)
+
+    assert client.get("/internal/health").json() == {"has_session": False}
+    assert client.get("/read").json() == {"read_only": False}
+    assert len(store.raw_memory_store) == 0
+
+    assert client.get("/").json() == {"counter": 1}
+    assert client.get("/read").json() == {"read_only": True}
+
+
+def test_policy_of_mounted_router():
+    """
+    Test that policies declared on the routes of a mounted router are resolved at startup and applied.
+
+    マウントしたルーターのルートで宣言したセッションの扱いが起動時に解決され、適用されることをテスト
+    """
+    store = MemoryStore()
+    routes = [
+        Route("/", endpoint=counter_route),
+        Mount("/api", routes=[Route("/health", endpoint=health_route), Route("/read", endpoint=read_route)]),
+    ]
+
+    with create_client(store, routes=routes) as client:  # lifespan を起動する
+        assert client.get("/api/health").text == "has_session: False"
+        assert client.get("/api/read").text == "Counter: None read_only: False"
+        assert len(store.raw_memory_store) == 0
+
+        assert client.get("/").text == "Counter: 1"
+        assert client.get("/api/read").text == "Counter: 1 read_only: True"
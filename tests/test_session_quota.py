@@ -0,0 +1,160 @@
+import logging
+
+import pytest
+
+from fastsession import MemoryStore, SessionQuotaExceeded
+from fastsession.session_quota import QuotaSessionDict, measure_field
+
+
+def test_size_is_tracked_incrementally():
+    """
+    Test that the tracked size follows every kind of change to the session.
+
+    セッションへのあらゆる変更にサイズの追跡が追従することをテスト
+    """
+    session = QuotaSessionDict()
+    session["a"] = "x" * 10
+    session["b"] = [1, 2, 3]
+    session.update({"c": {"d": 1}}, e=True)
+    session.setdefault("f", 0)
+    session["a"] = "y"
+    del session["b"]
+    session.pop("missing", None)
+    session.pop("e")
+
+    assert session.size == sum(measure_field(key, value) for key, value in session.items())
+
+    session.clear()
+    assert session.size == 0
+
+
+def test_enforce_policy_rejects_write_over_quota():
+    """
+    Test that the enforce policy rejects a write over the quota and leaves the session unchanged.
+
+    enforce では上限を超える書き込みが拒否され、セッションが変更されないことをテスト
+    """
+    session = QuotaSessionDict(max_bytes=100, policy="enforce")
+    session["small"] = "x" * 10
+
+    with pytest.raises(SessionQuotaExceeded):
+        session["large"] = "x" * 200
+
+    assert "large" not in session
+    assert session.size == measure_field("small", "x" * 10)
+
+
+def test_warn_policy_accepts_write_over_quota(caplog):
+    """
+    Test that the warn policy logs a warning but accepts the write.
+
+    warn では警告ログを出しつつ書き込みを受け付けることをテスト
+    """
+    session = QuotaSessionDict(max_bytes=100, policy="warn")
+
+    with caplog.at_level(logging.WARNING, logger="fastsession"):
+        session["large"] = "x" * 200
+
+    assert session["large"] == "x" * 200
+    assert "exceeds quota" in caplog.text
+
+
+def test_store_stats_size_histogram():
+    """
+    Test that the store reports a histogram of session sizes.
+
+    ストアがセッションサイズのヒストグラムを返すことをテスト
+    """
+    store = MemoryStore(max_session_bytes=10000)
+    store.create_store("small")["v"] = "x" * 10
+    store.create_store("medium")["v"] = "x" * 2000
+    store.create_store("empty")
+
+    stats = store.stats()
+    assert stats["sessions"] == 3
+    assert stats["size_histogram"]["<=256"] == 2
+    assert stats["size_histogram"]["<=4096"] == 1
+    assert stats["total_bytes"] == measure_field("v", "x" * 10) + measure_field("v", "x" * 2000)
+
+    with pytest.raises(SessionQuotaExceeded):
+        store.get_store("small")["v"] = "x" * 20000
+
+
+def test_middleware_bookkeeping_not_counted_against_quota():
+    """
+    Test that a session filled up to its quota keeps working, as the middleware's own
+    "__cause__" writes are not counted.
+
+    ミドルウェア自身の "__cause__" の書き込みは数えないので、上限ちょうどまで埋めたセッションも使い続けられることをテスト
+    """
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+    from starlette.testclient import TestClient
+
+    from fastsession import FastSessionMiddleware
+
+    async def fill_route(request):
+        session = request.state.session.get_session()
+        if "data" not in session:
+            session["data"] = "x" * (200 - measure_field("data", ""))
+        return PlainTextResponse(str(session.size))
+
+    store = MemoryStore(max_session_bytes=200)
+    app = Starlette(routes=[Route("/", endpoint=fill_route)])
+    app.add_middleware(FastSessionMiddleware, secret_key="test-secret", store=store, secure=False)
+    client = TestClient(app)
+
+    responses = [client.get("/") for _ in range(3)]
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert responses[-1].text == "200"
+
+
+def test_stats_count_packed_and_snapshot_sessions(tmp_path):
+    """
+    Test that packed sessions and sessions not yet decoded from a snapshot are counted with their encoded length
+    in the size histogram, without decoding them.
+
+    圧縮したセッションとスナップショットから未デコードのセッションも、デコードせずにエンコード後の長さで
+    サイズのヒストグラムに数えることをテスト
+    """
+    store = MemoryStore(max_session_bytes=10000, compress_idle_after=0, compaction_interval=None)
+    store.create_store("packed")["v"] = "x" * 2000
+    assert store.compact_idle_sessions() == 1
+    store.snapshot(str(tmp_path / "sessions.snapshot"))
+
+    stats = store.stats()
+    assert stats["size_histogram"]["<=4096"] == 1
+    assert stats["total_bytes"] > 2000
+    assert store.raw_memory_store["packed"].get("packed") is not None
+
+    restored = MemoryStore(max_session_bytes=10000)
+    restored.restore(str(tmp_path / "sessions.snapshot"))
+    assert restored.stats()["total_bytes"] > 0
+    assert restored.raw_memory_store["packed"]["store"] is None
+
+
+def test_quota_warning_goes_to_middleware_logger():
+    """
+    Test that quota warnings of the store are logged through the logger given to the middleware.
+
+    ストアの上限超過の警告が、ミドルウェアに渡したロガーに出力されることをテスト
+    """
+    from fastsession import FastSessionMiddleware
+
+    class ListLogger:
+        def __init__(self):
+            self.messages = []
+
+        def info(self, message):
+            self.messages.append(message)
+
+        def debug(self, message):
+            pass
+
+    logger = ListLogger()
+    store = MemoryStore(max_session_bytes=100, quota_policy="warn")
+    FastSessionMiddleware(None, secret_key="test-secret", store=store, logger=logger)
+
+    store.create_store("id-1")["large"] = "x" * 200
+    assert any("exceeds quota" in message for message in logger.messages)
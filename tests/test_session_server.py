@@ -0,0 +1,406 @@
+import asyncio
+import os
+import stat
+import tempfile
+import threading
+import time
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from fastsession import FastSessionMiddleware, GCCoordinator, SessionClientStore, StoreLease
+from fastsession.session_client_store import SessionServerError
+from fastsession.session_protocol import (FRAME_HEADER, OP_ACQUIRE_LEASE, OP_DELETE, OP_EXISTS, OP_SCAN, OP_SET,
+                                          STATUS_ERROR, STATUS_NOT_FOUND, STATUS_OK, decode_response,
+                                          default_socket_path, encode_request)
+from fastsession.session_server import SessionServer
+
+
+@pytest.fixture
+def session_server():
+    """
+    Run a session server on its own event loop in a background thread.
+
+    バックグラウンドスレッドの専用イベントループでセッションサーバーを動かす
+    """
+    path = os.path.join(tempfile.mkdtemp(), "fastsession.sock")
+    server = SessionServer(path)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait(5)
+    yield server
+
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+
+
+def test_client_store_operations(session_server):
+    """
+    Test the store interface of the client against the session server.
+
+    セッションサーバーに対するクライアントのストア操作をテスト
+    """
+    store = SessionClientStore(session_server.path)
+
+    session = store.create_store("test-id")
+    assert store.has_session_id("test-id")
+    assert store.get_store("test-id") == {}
+
+    session["user"] = "alice"
+    session["cart"] = list(range(1000))  # 圧縮される大きさ
+    store.save_store("test-id")
+    assert store.get_store("test-id") == {"user": "alice", "cart": list(range(1000))}
+
+    assert store.delete_store("test-id")
+    assert store.get_store("test-id") is None
+    assert store.has_no_session_id("test-id")
+
+
+def test_client_store_batches(session_server):
+    """
+    Test batched operations and that connections are reused.
+
+    バッチ操作と接続の再利用をテスト
+    """
+    store = SessionClientStore(session_server.path)
+
+    assert store.import_sessions(((f"id-{i}", {"created_at": 1000 + i, "store": {"n": i}}) for i in range(25)), batch_size=10) == 25
+    assert {session_id: dict(s) for session_id, s in store.get_many(["id-1", "id-2", "missing"]).items()} == {"id-1": {"n": 1}, "id-2": {"n": 2}}
+    assert store.count_existing(["id-1", "id-2", "missing"]) == 2
+    assert sorted(session_id for session_id, _ in store.iter_sessions(chunk_size=7)) == sorted(f"id-{i}" for i in range(25))
+    assert store.export_session("id-3")["created_at"] == 1003
+
+    replies = store.pipeline([[(OP_EXISTS, "id-4", b"")], [(OP_DELETE, "id-4", b"")], [(OP_EXISTS, "id-4", b"")]])
+    assert [results[0][0] for results in replies] == [STATUS_OK, STATUS_OK, STATUS_NOT_FOUND]  # 送った順に処理される
+
+    assert store.gc() == 24  # 全て期限切れ
+    assert store.delete_many(["id-1"]) == 0
+    assert len(store.idle_connections) == 1  # 1つの接続を使い回している
+
+
+def test_middleware_with_session_server(session_server):
+    """
+    Test that two apps (standing in for two workers) share sessions through the session server.
+
+    2つのアプリ(2つのワーカーの代わり)がセッションサーバーを通してセッションを共有することをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        session["test_counter"] = session.get("test_counter", 0) + 1
+        return PlainTextResponse(f"Counter: {session['test_counter']}")
+
+    def create_client():
+        app = Starlette(routes=[Route("/", endpoint=test_route)])
+        app.add_middleware(FastSessionMiddleware,
+                           secret_key='test-secret',
+                           store=SessionClientStore(session_server.path),
+                           max_age=3600,
+                           secure=False,
+                           session_cookie="sid"
+                           )
+        return TestClient(app)
+
+    worker1 = create_client()
+    worker2 = create_client()
+
+    assert "Counter: 1" in worker1.get("/").text
+    worker2.cookies.set("sid", worker1.cookies["sid"])
+    assert "Counter: 2" in worker2.get("/").text
+    worker1.cookies.set("sid", worker2.cookies["sid"])
+    assert "Counter: 3" in worker1.get("/").text
+
+
+def test_scan_cursor_is_stable_under_changes():
+    """
+    Test that a scan returns every session present for the whole scan exactly once,
+    while sessions are deleted and created between the calls.
+
+    呼び出しの間にセッションが削除・作成されても、走査の間ずっと存在するセッションがちょうど1回ずつ返ることをテスト
+    """
+    server = SessionServer("unused.sock")
+    for i in range(100):
+        server.add_session(f"id-{i}", 1000, b"j{}")
+
+    seen = []
+    cursor, session_ids = server.scan_order.scan(0, 10)
+    while True:
+        seen.extend(session_ids)
+        for session_id in session_ids[:8]:
+            server.remove_session(session_id)  # 返したものを削除して、詰め直しも起こす
+        server.add_session(f"new-{len(seen)}", 1000, b"j{}")
+        if cursor == 0:
+            break
+        cursor, session_ids = server.scan_order.scan(cursor, 10)
+
+    kept = [f"id-{i}" for i in range(100)]
+    assert [session_id for session_id in seen if session_id.startswith("id-")] == kept
+    assert len(server.scan_order.entries) < 100  # 削除済のエントリは詰められている
+    assert len(server.scan_order.entries) == len(server.sessions) + server.scan_order.removed_count
+
+
+def test_socket_is_private(session_server):
+    """
+    Test that only the owner can connect to the socket, and that the default path is not directly in a shared directory.
+
+    ソケットに接続できるのが所有者だけであること、デフォルトのパスが共有ディレクトリ直下でないことをテスト
+    """
+    assert stat.S_IMODE(os.stat(session_server.path).st_mode) == 0o600
+    assert os.path.dirname(default_socket_path()) != tempfile.gettempdir()
+
+
+def test_clients_coordinate_sweeping_through_server(session_server):
+    """
+    Test that two clients (standing in for two hosts) share the sweep lease and checkpoint kept by the server,
+    so only one sweeps at a time and each batch continues where the other stopped.
+
+    2つのクライアント(2つのホストの代わり)がサーバーのリースとチェックポイントを共有し、
+    同時には1つだけが掃除し、各バッチがもう一方の止めた位置から続けることをテスト
+    """
+    store_1 = SessionClientStore(session_server.path)
+    store_2 = SessionClientStore(session_server.path)
+    expired_at = 1000  # 期限切れ
+    store_1.import_sessions((f"id-{i}", {"created_at": expired_at if i % 2 == 0 else int(time.time()), "store": {}})
+                            for i in range(100))
+
+    worker_1 = GCCoordinator(store_1, StoreLease(store_1, ttl=60), batch_size=40, interval=0)
+    worker_2 = GCCoordinator(store_2, StoreLease(store_2, ttl=60), batch_size=40, interval=0)
+
+    holder = StoreLease(store_2, ttl=60)
+    assert holder.acquire()
+    assert worker_1.gc() is None  # もう一方のホストがリースを持っている
+    holder.release(None)
+
+    assert worker_1.gc() == 20
+    assert worker_2.gc() == 20  # worker_1 のチェックポイントから続ける
+    assert worker_1.gc() == 10
+    assert worker_1.stats["cycles"] == 1
+    assert sorted(session_id for session_id, _ in store_2.iter_sessions()) == sorted(f"id-{i}" for i in range(1, 100, 2))
+
+
+def test_malformed_ops_fail_alone(session_server):
+    """
+    Test that a malformed op gets STATUS_ERROR while the other ops of the batch and the connection keep working.
+
+    不正な操作は STATUS_ERROR になり、同じバッチの他の操作と接続はそのまま使えることをテスト
+    """
+    store = SessionClientStore(session_server.path)
+    store.import_sessions([("id-1", {"created_at": int(time.time()), "store": {}})])
+
+    sock = store.connect()
+    sock.sendall(encode_request([(OP_SET, "id-2", b"x"),
+                                 (OP_ACQUIRE_LEASE, "lease", b"not json"),
+                                 (OP_SCAN, "", b"short"),
+                                 (OP_EXISTS, "id-1", b"")]))
+    (length,) = FRAME_HEADER.unpack(store.read_exactly(sock, FRAME_HEADER.size))
+    results = decode_response(store.read_exactly(sock, length))
+    assert [status for status, _ in results] == [STATUS_ERROR, STATUS_ERROR, STATUS_ERROR, STATUS_OK]
+
+    sock.sendall(encode_request([(OP_EXISTS, "id-1", b"")]))  # 同じ接続を使い続けられる
+    (length,) = FRAME_HEADER.unpack(store.read_exactly(sock, FRAME_HEADER.size))
+    assert decode_response(store.read_exactly(sock, length)) == [(STATUS_OK, b"")]
+    sock.close()
+
+    with pytest.raises(SessionServerError):
+        store.execute([(OP_SET, "id-3", b"x")])
+
+
+def test_oversized_frame_is_refused(session_server):
+    """
+    Test that a frame announcing more than max_frame_length bytes is refused without reading its body.
+
+    max_frame_length を超える長さを宣言したフレームは本体を読まずに断られることをテスト
+    """
+    session_server.max_frame_length = 1024
+    store = SessionClientStore(session_server.path)
+
+    sock = store.connect()
+    sock.sendall(FRAME_HEADER.pack((1 << 32) - 1))
+    (length,) = FRAME_HEADER.unpack(store.read_exactly(sock, FRAME_HEADER.size))
+    (status, _), = decode_response(store.read_exactly(sock, length))
+    assert status == STATUS_ERROR
+    assert sock.recv(1) == b""  # 接続は閉じられる
+    sock.close()
+
+
+def test_start_refuses_unsafe_paths():
+    """
+    Test that the server refuses a socket directory other users can write to, and a socket a live server listens on.
+
+    他のユーザーが書き込めるソケットのディレクトリと、動いているサーバーのソケットを使わないことをテスト
+    """
+    directory = tempfile.mkdtemp()
+
+    async def run():
+        os.chmod(directory, 0o777)
+        with pytest.raises(PermissionError):
+            await SessionServer(os.path.join(directory, "fastsession.sock")).start()
+        os.chmod(directory, 0o700)
+
+        path = os.path.join(directory, "fastsession.sock")
+        first = SessionServer(path)
+        await first.start()
+        with pytest.raises(OSError, match="already running"):
+            await SessionServer(path).start()
+        await first.close()
+
+        stale = SessionServer(path)  # 閉じたサーバーが残したソケットは置き換える
+        await stale.start()
+        await stale.close()
+
+    asyncio.run(run())
+
+
+def test_versioned_saves_through_server(session_server):
+    """
+    Test that versioned saves are compared on the server, so two clients (standing in for two workers)
+    detect each other's saves, and that conflict_policy can be used with the client store.
+
+    バージョンの比較はサーバーで行われ、2つのクライアント(2つのワーカーの代わり)が互いの保存を検知でき、
+    クライアントのストアで conflict_policy を使えることをテスト
+    """
+    store_1 = SessionClientStore(session_server.path)
+    store_2 = SessionClientStore(session_server.path)
+    store_1.create_store("id-1")
+
+    data, version = store_1.get_store_versioned("id-1")
+    assert data == {}
+    assert store_2.save_store_if_version("id-1", {"by": "worker-2"}, version) == version + 1
+    assert store_1.save_store_if_version("id-1", {"by": "worker-1"}, version) is None  # worker-2 が先に保存した
+    assert store_1.get_store_versioned("id-1") == ({"by": "worker-2"}, version + 1)
+
+    session = store_1.get_store("id-1")
+    session["by"] = "flush"
+    session.flush()  # バージョンを比較しない保存もバージョンを進める
+    assert store_2.save_store_if_version("id-1", {}, version + 1) is None
+    assert store_1.get_store_versioned("missing") == (None, None)
+    assert store_1.save_store_if_version("missing", {}, 0) is None
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        session["test_counter"] = session.get("test_counter", 0) + 1
+        return PlainTextResponse(f"Counter: {session['test_counter']}")
+
+    app = Starlette(routes=[Route("/", endpoint=test_route)])
+    app.add_middleware(FastSessionMiddleware, secret_key='test-secret', store=store_1, max_age=3600, secure=False,
+                       session_cookie="sid", conflict_policy="merge")
+    client = TestClient(app)
+    assert "Counter: 1" in client.get("/").text
+    assert "Counter: 2" in client.get("/").text
+
+
+def test_large_remote_session_is_decoded_in_worker(session_server):
+    """
+    Test that the middleware fetches a session from the server and decodes it in the offload worker pool
+    when the received payload is large.
+
+    受け取ったペイロードが大きい場合、ミドルウェアがサーバーから取得したセッションを
+    オフロード用のワーカープールでデコードすることをテスト
+    """
+
+    async def test_route(request):
+        session = request.state.session.get_session()
+        if request.query_params.get("fill"):
+            session["cart"] = [f"item-{i}" for i in range(5000)]
+        return PlainTextResponse(f"Items: {len(session.get('cart', []))}")
+
+    app = Starlette(routes=[Route("/", endpoint=test_route)])
+    app.add_middleware(FastSessionMiddleware, secret_key='test-secret', store=SessionClientStore(session_server.path),
+                       max_age=3600, secure=False, session_cookie="sid", offload_threshold=1024)
+    client = TestClient(app)
+
+    client.get("/")
+    offloader = app.middleware_stack.app.offloader  # ServerErrorMiddleware の内側が FastSessionMiddleware
+    inline = offloader.stats["inline"]
+    client.get("/?fill=1")
+    assert offloader.stats["inline"] > inline  # 小さなセッションはその場でデコードする
+
+    store = app.middleware_stack.app.session_store
+    decoded_in = []
+    load_store_payload = store.load_store_payload
+    store.load_store_payload = lambda *args: decoded_in.append(threading.current_thread()) or load_store_payload(*args)
+    assert "Items: 5000" in client.get("/").text
+    assert decoded_in and decoded_in[0].name.startswith("fastsession-offload")
+
+
+def test_stalled_batch_is_not_retried(session_server):
+    """
+    Test that a batch the server applied before stalling past the client timeout is reported as an error,
+    not sent again on a new connection, while a reused connection closed by the server is replaced and retried.
+
+    サーバーが適用した後でクライアントのタイムアウトを超えて止まったバッチは、新しい接続で再送せずエラーにし、
+    サーバーが閉じた再利用の接続は取り替えて再試行することをテスト
+    """
+    store = SessionClientStore(session_server.path, timeout=0.2)
+    store.create_store("id-1")  # 接続をアイドルにして、次の操作で再利用させる
+
+    applied = []
+    handle_frame = session_server.handle_frame
+
+    async def stalling_handle_frame(body):
+        reply = await handle_frame(body)
+        applied.append(body)
+        await asyncio.sleep(0.5)
+        return reply
+
+    session_server.handle_frame = stalling_handle_frame
+    with pytest.raises(OSError):
+        store.save_store_if_version("id-1", {"n": 1}, 0)
+    time.sleep(0.5)
+    assert len(applied) == 1
+    assert session_server.sessions["id-1"][1] == 1
+    session_server.handle_frame = handle_frame
+
+    store.create_store("id-2")
+    loop = session_server.server.get_loop()
+    for writer in list(session_server.connections):
+        loop.call_soon_threadsafe(writer.close)  # サーバー側から接続を閉じる
+    time.sleep(0.1)
+    assert store.idle_connections
+    assert store.count_existing(["id-1", "id-2"]) == 2
+
+
+def test_touch_keeps_idle_sessions(session_server):
+    """
+    Test that with max_idle set, a touched session survives a sweep while an untouched idle one expires.
+
+    max_idle を指定した場合、touch したセッションは掃除で残り、触れていないアイドルのセッションは期限切れになることをテスト
+    """
+    session_server.max_idle = 60
+    store = SessionClientStore(session_server.path)
+    store.create_store("touched")
+    store.create_store("idle")
+    for entry in session_server.sessions.values():
+        entry[3] -= 120  # 2分前に最後にアクセスされた
+
+    assert store.touch_many(["touched", "missing"]) == 1
+    assert store.gc() == 1
+    assert store.has_session_id("touched")
+    assert not store.has_session_id("idle")
+
+
+def test_sweep_yields_between_chunks(session_server):
+    """
+    Test that a full sweep deletes expired sessions across several chunks.
+
+    全体の掃除が複数のチャンクにわたって期限切れのセッションを削除することをテスト
+    """
+    session_server.SWEEP_CHUNK_SIZE = 10
+    store = SessionClientStore(session_server.path)
+    store.import_sessions((f"id-{i}", {"created_at": 1000 if i % 2 == 0 else int(time.time()), "store": {}})
+                          for i in range(55))
+    assert store.gc() == 28
+    assert store.count_existing(f"id-{i}" for i in range(55)) == 27
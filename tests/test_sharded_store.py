@@ -0,0 +1,195 @@
+from fastsession import MemoryStore, ShardedStore
+from fastsession.sharded_store import ConsistentHashRing
+
+
+def test_sessions_are_spread_over_nodes():
+    """
+    Test that sessions are spread over every node and can be read back.
+
+    セッションが全ノードに分散され、読み出せることをテスト
+    """
+    nodes = {f"node-{i}": MemoryStore() for i in range(4)}
+    store = ShardedStore(nodes)
+
+    for i in range(400):
+        store.create_store(f"id-{i}")["n"] = i
+
+    assert all(len(node.raw_memory_store) > 50 for node in nodes.values())
+    assert store.get_store("id-123") == {"n": 123}
+    assert store.get_many(["id-1", "id-2", "missing"]) == {"id-1": {"n": 1}, "id-2": {"n": 2}}
+    assert len(list(store.iter_sessions())) == 400
+
+
+def test_adding_node_moves_about_one_nth_of_keys():
+    """
+    Test that adding a fifth node only moves about 1/5 of the keys.
+
+    5つ目のノードを追加しても、移動するキーはおよそ 1/5 であることをテスト
+    """
+    ring = ConsistentHashRing([f"node-{i}" for i in range(4)])
+    keys = [f"id-{i}" for i in range(10000)]
+    before = {key: ring.get_node(key) for key in keys}
+
+    ring.add_node("node-4")
+    moved = [key for key in keys if ring.get_node(key) != before[key]]
+
+    assert 0.1 < len(moved) / len(keys) < 0.3
+    assert all(ring.get_node(key) == "node-4" for key in moved)  # 移動先は新しいノードだけ
+
+
+def test_read_through_migration_after_adding_node():
+    """
+    Test that sessions are moved to their new owner when read after a node was added.
+
+    ノード追加後、セッションは読み出し時に新しい担当ノードへ移されることをテスト
+    """
+    store = ShardedStore({f"node-{i}": MemoryStore() for i in range(2)})
+    for i in range(100):
+        store.create_store(f"id-{i}")["n"] = i
+
+    new_node = MemoryStore()
+    store.add_node("node-2", new_node)
+    moved = [f"id-{i}" for i in range(100) if store.ring.get_node(f"id-{i}") == "node-2"]
+    assert moved and new_node.raw_memory_store == {}
+
+    assert store.get_store(moved[0]) == {"n": int(moved[0][3:])}
+    assert new_node.has_session_id(moved[0])
+    assert store.stats["migrated"] == 1
+
+    assert store.migrate_all() == len(moved) - 1
+    assert sorted(new_node.raw_memory_store) == sorted(moved)
+    assert all(store.get_store(f"id-{i}") == {"n": i} for i in range(100))
+
+
+def test_removed_node_is_readable_until_migrated():
+    """
+    Test that sessions of a removed node are still readable and move to the remaining nodes.
+
+    削除したノードのセッションが読み出せ、残りのノードへ移されることをテスト
+    """
+    nodes = {f"node-{i}": MemoryStore() for i in range(3)}
+    store = ShardedStore(nodes)
+    for i in range(60):
+        store.create_store(f"id-{i}")["n"] = i
+
+    store.remove_node("node-0")
+    assert all(store.get_store(f"id-{i}") == {"n": i} for i in range(60))
+    assert nodes["node-0"].raw_memory_store == {}
+
+
+def test_last_node_cannot_be_removed():
+    """
+    Test that removing the last node is refused, and that sweeping a store without nodes does nothing.
+
+    最後のノードの削除は断られ、ノードのないストアの掃除は何もしないことをテスト
+    """
+    import pytest
+
+    store = ShardedStore({"node-0": MemoryStore()})
+    store.create_store("id-1")["n"] = 1
+
+    with pytest.raises(ValueError):
+        store.remove_node("node-0")
+    with pytest.raises(ValueError):
+        store.remove_node("missing")
+    assert store.get_store("id-1") == {"n": 1}
+
+    assert ShardedStore({}).sweep_expired() == (0, None)
+
+
+def test_two_topology_changes_during_one_migration():
+    """
+    Test that sessions stay reachable when a second node is added before the first migration has finished,
+    including sessions already moved by read-through migration under the intermediate ring.
+
+    最初の移行が終わる前に2つ目のノードを追加しても、途中のリングで読み出し時に移したセッションを含め
+    全セッションに到達できることをテスト
+    """
+    store = ShardedStore({"n0": MemoryStore(), "n1": MemoryStore()})
+    for i in range(300):
+        store.create_store(f"id-{i}")["n"] = i
+
+    store.add_node("n2", MemoryStore())
+    assert all(store.get_store(f"id-{i}") == {"n": i} for i in range(0, 300, 2))  # 半分だけ読み出し時に移す
+
+    store.add_node("n3", MemoryStore())
+    assert all(store.has_session_id(f"id-{i}") for i in range(300))
+    assert all(store.get_store(f"id-{i}") == {"n": i} for i in range(300))
+
+    store.migrate_all()
+    assert sum(len(node.raw_memory_store) for node in store.stores.values()) == 300
+    assert all(store.get_store(f"id-{i}") == {"n": i} for i in range(300))
+
+
+def test_checked_out_sessions_are_not_compacted():
+    """
+    Test that a session checked out through the sharded store is pinned on its node, so the node's compaction
+    leaves it alone until it is released, even if the ring changes in between.
+
+    シャードストア経由で checkout したセッションはノード上で固定され、その間にリングが変わっても
+    release するまでノードの圧縮の対象にならないことをテスト
+    """
+    nodes = {f"node-{i}": MemoryStore(compress_idle_after=0, compaction_interval=None) for i in range(2)}
+    store = ShardedStore(nodes)
+    session_store = store.create_store("id-1")
+    node = nodes[store.ring.get_node("id-1")]
+
+    store.checkout("id-1")
+    store.add_node("node-2", MemoryStore())
+    assert node.compact_idle_sessions() == 0
+    session_store["n"] = 1  # 保持している側の書き込みは失われない
+    assert node.get_store("id-1") == {"n": 1}
+
+    store.release("id-1")
+    assert node.compact_idle_sessions() == 1
+    assert store.checked_out == {}
+
+
+def test_removed_nodes_are_swept_and_indexed_until_migrated():
+    """
+    Test that sweep_expired also sweeps removed nodes, and that update_index updates the index of the node
+    still holding a session not migrated yet.
+
+    sweep_expired が削除したノードも掃除し、update_index が移行していないセッションを保持しているノードの
+    索引を更新することをテスト
+    """
+    nodes = {f"node-{i}": MemoryStore(index_key="user_id", max_session_age=60) for i in range(2)}
+    store = ShardedStore(nodes, migrate_on_read=False)
+    for i in range(40):
+        store.create_store(f"id-{i}")
+    moved = [f"id-{i}" for i in range(40) if store.ring.get_node(f"id-{i}") == "node-0"]
+
+    store.remove_node("node-0")
+    nodes["node-0"].raw_memory_store[moved[0]]["store"]["user_id"] = "alice"
+    store.update_index(moved[0], store.get_store(moved[0]))
+    assert store.find_sessions("alice") == [moved[0]]
+
+    for node in nodes.values():
+        for session_info in node.raw_memory_store.values():
+            session_info["created_at"] -= 120  # 期限切れ
+    deleted, cursor = 0, None
+    while True:
+        count, cursor = store.sweep_expired(cursor, limit=10)
+        deleted += count
+        if cursor is None:
+            break
+    assert deleted == 40
+    assert nodes["node-0"].raw_memory_store == {}
+
+
+def test_ring_changes_swap_one_immutable_attribute():
+    """
+    Test that adding or removing a node replaces the ring's (hashes, owners) tuple instead of mutating it,
+    so a thread in get_node always sees a consistent pair.
+
+    ノードの追加・削除はリングの (hashes, owners) のタプルを変更せず差し替え、
+    get_node 中のスレッドが常に整合した組を見ることをテスト
+    """
+    ring = ConsistentHashRing(["a", "b"], vnodes=10)
+    points = ring.points
+    ring.add_node("c")
+    assert points is not ring.points and len(points[0]) == 20
+    assert len(ring.points[0]) == len(ring.points[1]) == 30
+    assert list(ring.points[0]) == sorted(ring.points[0])
+    ring.remove_node("a")
+    assert "a" not in ring.points[1] and len(ring.points[0]) == 20
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from fastsession import FastSessionMiddleware, HashMemoryStore, MemoryStore
+from fastsession.single_flight import SingleFlight
+from tests.conftest import CountingMemoryStore
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_result():
+    """
+    Test that concurrent calls with the same key share one call.
+
+    同じキーの同時呼び出しが1回の呼び出しを共有することをテスト
+    """
+    single_flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    results = await asyncio.gather(*[single_flight.do("key", fetch) for _ in range(10)])
+    assert results == ["result"] * 10
+    assert len(calls) == 1
+    assert single_flight.stats == {"calls": 1, "shared": 9}
+    assert single_flight.calls == {}
+
+
+async def burst(store, cookie, count=20, route=None, **kwargs):
+    async def test_route(request):
+        session_mgr = request.state.session
+        return PlainTextResponse(session_mgr.get_session_id())
+
+    app = Starlette(routes=[Route("/", endpoint=route or test_route)])
+    app.add_middleware(FastSessionMiddleware,
+                       secret_key='test-secret',
+                       store=store,
+                       max_age=3600,
+                       secure=False,
+                       session_cookie="sid",
+                       store_timeout=5,  # ストアをワーカースレッドで呼び出し、リクエストを並行させる
+                       **kwargs)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+        if cookie is None:
+            cookie = (await client.get("/")).cookies["sid"]
+        client.cookies.set("sid", cookie)
+        store.get_calls = 0
+        responses = await asyncio.gather(*[client.get("/") for _ in range(count)])
+    return responses
+
+
+@pytest.mark.asyncio
+async def test_concurrent_fetches_of_same_session_are_coalesced():
+    """
+    Test that a burst of requests with the same session cookie fetches the session once.
+
+    同じセッションクッキーを持つリクエストが同時に来ても、セッションの取得は1回であることをテスト
+    """
+    store = CountingMemoryStore(get_delay=0.2, create_delay=0.05)
+    responses = await burst(store, cookie=None)
+
+    assert len({response.text for response in responses}) == 1
+    assert store.get_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_burst_with_missing_store_creates_one_session():
+    """
+    Test that a burst of requests whose session store is gone re-creates a single session.
+
+    ストアが消えたセッションのクッキーを持つリクエストが同時に来ても、再生成されるセッションは1つであることをテスト
+    """
+    store = CountingMemoryStore(get_delay=0.2, create_delay=0.05)
+    responses = await burst(store, cookie=None)
+    store.raw_memory_store.clear()  # サーバーの再起動でストアが消えた
+    store.create_calls = 0
+    old_cookie = responses[0].request.headers["cookie"].split("=", 1)[1]
+
+    responses = await burst(store, cookie=old_cookie)
+
+    assert store.create_calls == 1
+    assert len({response.text for response in responses}) == 1
+    assert len({response.cookies["sid"] for response in responses}) == 1
+
+
+class PayloadStore(MemoryStore):
+    """
+    MemoryStore that serializes sessions itself, like SessionClientStore, counting payload fetches and decodes.
+
+    SessionClientStore のようにセッションを自らシリアライズし、ペイロードの取得とデコードの回数を数える MemoryStore
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.get_calls = 0
+        self.decode_calls = 0
+
+    def fetch_store_payload(self, session_id):
+        self.get_calls += 1
+        time.sleep(0.2)
+        session_store = super().get_store(session_id)
+        return json.dumps(dict(session_store)).encode("utf-8") if session_store is not None else None
+
+    def load_store_payload(self, session_id, payload):
+        self.decode_calls += 1
+        return json.loads(payload)
+
+
+class SlowHashMemoryStore(HashMemoryStore):
+    def __init__(self):
+        super().__init__()
+        self.get_calls = 0
+
+    def get_store(self, session_id):
+        self.get_calls += 1
+        time.sleep(0.2)
+        return super().get_store(session_id)
+
+
+@pytest.mark.asyncio
+async def test_coalesced_fetches_give_each_request_its_own_session():
+    """
+    Test that requests sharing one fetch each get their own session object: only the encoded payload is shared
+    and decoded per request, and per-call session objects such as LazySession are forked.
+
+    1回の取得を共有したリクエストがそれぞれ自分のセッションオブジェクトを受け取ることをテスト。
+    共有するのはエンコード済ペイロードだけでリクエストごとにデコードし、LazySession のような呼び出しごとのオブジェクトは複製する
+    """
+    for store in [PayloadStore(), SlowHashMemoryStore()]:
+        sessions = []
+
+        async def test_route(request):
+            sessions.append(request.state.session.get_session())
+            return PlainTextResponse(request.state.session.get_session_id())
+
+        responses = await burst(store, cookie=None, route=test_route, count=5)
+        assert store.get_calls == 1
+        assert len({response.text for response in responses}) == 1
+        assert len({id(session) for session in sessions[-5:]}) == 5
+
+
+@pytest.mark.asyncio
+async def test_burst_with_missing_store_shares_one_inline_session():
+    """
+    Test that with inline sessions enabled, a burst of requests whose session store is gone
+    is given a single new session ID.
+
+    インラインセッションを有効にしても、ストアが消えたセッションのクッキーを持つリクエストが同時に来たら
+    1つの新しいセッションIDを共有することをテスト
+    """
+    store = CountingMemoryStore(get_delay=0.2, create_delay=0.05)
+    middleware = FastSessionMiddleware(None, secret_key='test-secret', store=store)
+    old_cookie = middleware.sign_session_id("gone")
+
+    responses = await burst(store, cookie=old_cookie, inline_session_max_bytes=4096)
+    assert len({response.text for response in responses}) == 1
+    assert responses[0].text != "gone"
+
+
+@pytest.mark.asyncio
+async def test_burst_with_expired_cookie_creates_one_session():
+    """
+    Test that a burst of requests carrying the same authentic but expired cookie renews into a single session.
+
+    同じ正しい署名の期限切れのクッキーを持つリクエストが同時に来ても、更新されるセッションは1つであることをテスト
+    """
+    store = CountingMemoryStore(get_delay=0.2, create_delay=0.05)
+    middleware = FastSessionMiddleware(None, secret_key='test-secret', store=store, max_age=3600)
+    expired_cookie = middleware.serializer.encode({"sid": "old"}, timestamp=time.time() - 7200)
+
+    responses = await burst(store, cookie=expired_cookie)
+    assert store.create_calls == 1
+    assert len({response.text for response in responses}) == 1
+    assert len({response.cookies["sid"] for response in responses}) == 1
@@ -0,0 +1,240 @@
+import time
+
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from fastsession import CircuitBreaker, MemoryStore
+from tests.conftest import create_client
+
+
+class SlowMemoryStore(MemoryStore):
+    """
+    MemoryStore whose calls stall while `slow` is True.
+
+    slow が True の間、呼び出しが詰まる MemoryStore
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.slow = False
+
+    def stall(self):
+        if self.slow:
+            time.sleep(0.5)
+
+    def get_store(self, session_id):
+        self.stall()
+        return super().get_store(session_id)
+
+    def create_store(self, session_id):
+        self.stall()
+        return super().create_store(session_id)
+
+
+async def read_only_counter_route(request):
+    session_mgr = request.state.session
+    session = session_mgr.get_session()
+    session["test_counter"] = session.get("test_counter", 0) + 1
+    return PlainTextResponse(f"Counter: {session['test_counter']} read_only: {session_mgr.read_only}")
+
+
+ROUTES = [Route("/", endpoint=read_only_counter_route)]
+
+
+def test_circuit_breaker_transitions():
+    """
+    Test that the circuit opens after consecutive failures and closes after a successful probe.
+
+    連続した失敗で回路が開き、試しの呼び出しの成功で閉じることをテスト
+    """
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+    time.sleep(0.15)
+    assert breaker.allow_request()  # 半開状態の試しの呼び出し
+    assert breaker.state == "half_open"
+    assert not breaker.allow_request()  # 試しの呼び出しは1つだけ
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    assert breaker.stats["transitions"] == {"closed->open": 1, "open->half_open": 1, "half_open->closed": 1}
+
+
+def test_store_timeout_falls_back_to_transient_session():
+    """
+    Test that a stalled store times out and the request is served with a transient session.
+
+    ストアが詰まるとタイムアウトし、一時的なセッションでリクエストが処理されることをテスト
+    """
+    store = SlowMemoryStore()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    client = create_client(store, routes=ROUTES, store_timeout=0.1, circuit_breaker=breaker)
+
+    with client:
+        assert "Counter: 1" in client.get("/").text
+        assert "Counter: 2" in client.get("/").text
+
+        store.slow = True
+        started = time.monotonic()
+        response = client.get("/")
+        assert time.monotonic() - started < 0.4
+        assert "Counter: 1" in response.text  # 一時的なセッション
+        assert "sid" not in response.cookies  # 既存のクッキーはそのまま
+        assert breaker.state == "open"
+
+        response = client.get("/")  # 回路が開いているのでストアを呼ばない
+        assert "Counter: 1" in response.text
+        assert breaker.stats["transitions"] == {"closed->open": 1}
+
+
+def test_fail_fast_mode_returns_503():
+    """
+    Test that the fail_fast degraded mode returns 503 while the store is unavailable.
+
+    fail_fast の縮退モードではストアが使えない間 503 を返すことをテスト
+    """
+    store = SlowMemoryStore()
+    store.slow = True
+    client = create_client(store, routes=ROUTES, store_timeout=0.1, degraded_mode="fail_fast")
+
+    response = client.get("/")
+    assert response.status_code == 503
+
+
+def test_read_only_mode_serves_existing_session():
+    """
+    Test that the read_only degraded mode still reads existing sessions while the circuit is open.
+
+    read_only の縮退モードでは回路が開いている間も既存のセッションを読み出すことをテスト
+    """
+    store = SlowMemoryStore()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    client = create_client(store, routes=ROUTES, store_timeout=0.1, circuit_breaker=breaker, degraded_mode="read_only")
+
+    assert "Counter: 1 read_only: False" in client.get("/").text
+
+    breaker.record_failure()  # 回路を開く
+    assert breaker.state == "open"
+    assert "Counter: 2 read_only: True" in client.get("/").text
+    assert breaker.state == "open"  # 回路を迂回した読み出しでは閉じない
+
+
+def test_concurrency_bound_holds_while_stalled_threads_run():
+    """
+    Test that a timed out call keeps its slot until its worker thread finishes, so calls in flight
+    on the backend never exceed max_concurrency.
+
+    タイムアウトした呼び出しはワーカースレッドが終わるまで枠を持ち続け、
+    バックエンドへの同時呼び出し数が max_concurrency を超えないことをテスト
+    """
+    import asyncio
+    import threading
+
+    from fastsession.store_guard import StoreGuard, StoreUnavailable
+
+    lock = threading.Lock()
+    state = {"in_flight": 0, "max_in_flight": 0}
+
+    def stalled_call():
+        with lock:
+            state["in_flight"] += 1
+            state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        time.sleep(0.3)
+        with lock:
+            state["in_flight"] -= 1
+
+    async def main():
+        guard = StoreGuard(timeout=0.05, max_concurrency=2)
+        for _ in range(3):
+            results = await asyncio.gather(*(guard.call(stalled_call) for _ in range(4)), return_exceptions=True)
+            assert all(isinstance(result, StoreUnavailable) for result in results)
+        await asyncio.sleep(0.7)
+        guard.shutdown()
+
+    asyncio.run(main())
+    assert state["max_in_flight"] == 2
+
+
+def test_memory_store_gc_during_concurrent_creates():
+    """
+    Test that MemoryStore's cleanup does not break while other threads create sessions.
+
+    他のスレッドがセッションを作成している間も MemoryStore の掃除が壊れないことをテスト
+    """
+    import threading
+
+    store = MemoryStore(index_key="user_id")
+    for i in range(50000):
+        store.create_store(f"id-{i}")
+    errors = []
+    stop = threading.Event()
+
+    def create_loop(worker):
+        i = 0
+        while not stop.is_set():
+            store.create_store(f"w{worker}-{i}")["user_id"] = f"user-{i % 10}"
+            store.save_store(f"w{worker}-{i}")
+            i += 1
+
+    threads = [threading.Thread(target=create_loop, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(5):
+            store.cleanup_old_sessions()
+            store.find_sessions("user-1")
+    except RuntimeError as e:
+        errors.append(e)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+
+
+def test_queueing_is_not_a_backend_failure():
+    """
+    Test that calls waiting for a slot of a healthy backend are not timed out by the queue wait,
+    and that calls that find no slot and caller errors do not open the circuit.
+
+    正常なバックエンドの枠を待つ呼び出しが待ち時間でタイムアウトしないこと、
+    枠を得られない呼び出しと呼び出し側の誤りでは回路が開かないことをテスト
+    """
+    import asyncio
+
+    import pytest
+
+    from fastsession.store_guard import StoreGuard, StoreOverloaded
+
+    def healthy_call():
+        time.sleep(0.06)
+        return "ok"
+
+    def caller_error():
+        raise TypeError("Object of type set is not JSON serializable")
+
+    async def main():
+        breaker = CircuitBreaker(failure_threshold=3)
+        guard = StoreGuard(timeout=0.1, max_concurrency=1, circuit_breaker=breaker)
+
+        results = await asyncio.gather(*(guard.call(healthy_call) for _ in range(6)), return_exceptions=True)
+        assert results.count("ok") >= 2
+        assert all(result == "ok" or isinstance(result, StoreOverloaded) for result in results)
+        assert guard.stats["timeouts"] == 0
+        assert guard.stats["overloaded"] == 6 - results.count("ok")
+
+        for _ in range(5):
+            with pytest.raises(TypeError):
+                await guard.call(caller_error)
+
+        assert breaker.state == "closed"
+        assert await guard.call(healthy_call) == "ok"
+        guard.shutdown()
+
+    asyncio.run(main())
@@ -21,3 +21,211 @@ def test_get_store():
     store.create_store("test-id")
     assert store.get_store("test-id") == {}
     assert store.get_store("nonexistent-id") is None
+
+def test_get_many_and_delete_many():
+    """
+    Test getting and deleting several stores at once.
+
+    複数のストアのまとめての取得と削除をテスト
+    """
+    store = MemoryStore()
+    for i in range(5):
+        store.create_store(f"id-{i}")["n"] = i
+
+    stores = store.get_many(["id-1", "id-3", "nonexistent-id"])
+    assert stores == {"id-1": {"n": 1}, "id-3": {"n": 3}}
+
+    assert store.delete_many(["id-1", "id-3", "nonexistent-id"]) == 2
+    assert store.get_store("id-1") is None
+    assert store.get_store("id-0") == {"n": 0}
+
+def test_iter_sessions_while_writing():
+    """
+    Test that iterating sessions is safe while sessions are created and deleted.
+
+    セッションの作成・削除をしながらでも安全に列挙できることをテスト
+    """
+    store = MemoryStore()
+    for i in range(10):
+        store.create_store(f"id-{i}")
+
+    seen = []
+    for session_id, session_info in store.iter_sessions(chunk_size=3):
+        seen.append(session_id)
+        store.create_store(f"new-{session_id}")
+        store.delete_store("id-9")
+
+    assert seen == [f"id-{i}" for i in range(9)]
+
+def test_import_sessions_from_another_store():
+    """
+    Test migrating sessions between stores with iter_sessions and import_sessions.
+
+    iter_sessions と import_sessions でストア間のセッション移行をテスト
+    """
+    src = MemoryStore()
+    for i in range(25):
+        src.create_store(f"id-{i}")["n"] = i
+
+    dst = MemoryStore()
+    assert dst.import_sessions(src.iter_sessions(chunk_size=7), batch_size=10) == 25
+    assert dst.get_store("id-24") == {"n": 24}
+    assert dst.raw_memory_store["id-0"]["created_at"] == src.raw_memory_store["id-0"]["created_at"]
+
+def test_find_sessions_and_revoke_user():
+    """
+    Test finding and revoking all sessions of a user through the secondary index.
+
+    索引を使ったユーザーの全セッションの検索と削除をテスト
+    """
+    store = MemoryStore(index_key="user_id")
+    for i in range(6):
+        store.create_store(f"id-{i}")["user_id"] = "alice" if i % 2 == 0 else "bob"
+        store.save_store(f"id-{i}")
+    store.create_store("anonymous")
+
+    assert sorted(store.find_sessions("alice")) == ["id-0", "id-2", "id-4"]
+
+    # ユーザーが変わったら索引も追従する
+    store.get_store("id-4")["user_id"] = "bob"
+    store.save_store("id-4")
+    assert sorted(store.find_sessions("alice")) == ["id-0", "id-2"]
+
+    assert store.revoke_user("bob") == 4
+    assert store.find_sessions("bob") == []
+    assert store.get_store("id-1") is None
+    assert store.get_store("id-0") == {"user_id": "alice"}
+    assert store.get_store("anonymous") == {}
+
+def test_index_cleaned_up_on_gc():
+    """
+    Test that expired sessions are removed from the secondary index by gc.
+
+    期限切れのセッションが gc で索引からも削除されることをテスト
+    """
+    store = MemoryStore(index_key="user_id")
+    for i in range(100):
+        store.create_store(f"id-{i}")["user_id"] = "alice"
+        store.save_store(f"id-{i}")
+        store.raw_memory_store[f"id-{i}"]["created_at"] -= 3600 * 13  # 期限切れにする
+
+    store.gc()
+    assert store.find_sessions("alice") == []
+    assert store.index == {}
+
+
+def test_save_store_if_version():
+    """
+    Test that a versioned save only succeeds while nobody else saved the session.
+
+    バージョン付きの保存は、他に誰も保存していない間だけ成功することをテスト
+    """
+    store = MemoryStore()
+    store.create_store("id-1")["n"] = 1
+
+    session_store, version = store.get_store_versioned("id-1")
+    other_store, other_version = store.get_store_versioned("id-1")
+    assert session_store == {"n": 1}
+    assert session_store is not store.get_store("id-1")  # 複製を返す
+
+    session_store["n"] = 2
+    new_version = store.save_store_if_version("id-1", session_store, version)
+    assert new_version == version + 1
+    assert store.get_store("id-1") == {"n": 2}
+
+    other_store["n"] = 3
+    assert store.save_store_if_version("id-1", other_store, other_version) is None  # 競合
+    assert store.get_store("id-1") == {"n": 2}
+
+    store.save_store("id-1")  # バージョンを比較しない保存もバージョンを進める
+    assert store.save_store_if_version("id-1", session_store, new_version) is None
+    assert store.get_store_versioned("missing") == (None, None)
+
+
+def test_compact_idle_sessions():
+    """
+    Test that idle sessions are packed into compressed bytes and re-inflated on the next access.
+
+    アクセスのないセッションが圧縮したバイト列にまとめられ、次のアクセス時に展開されることをテスト
+    """
+    store = MemoryStore(compress_idle_after=0, compaction_interval=None)
+    store.create_store("id-1").update({"cart": ["item"] * 100, "user_id": "user-1"})
+    store.create_store("id-2")["when"] = (1, 2)  # JSONを経由するとリストになるので圧縮しない
+
+    assert store.compact_idle_sessions() == 1
+    assert store.raw_memory_store["id-1"]["store"] is None
+    assert store.stats()["packed_sessions"] == 1
+    assert store.stats()["packed_bytes"] < store.stats()["packed_raw_bytes"]
+    assert store.payload_size_hint("id-1") == store.stats()["packed_raw_bytes"]
+
+    assert store.get_store("id-1") == {"cart": ["item"] * 100, "user_id": "user-1"}
+    assert store.get_store("id-2") == {"when": (1, 2)}
+    assert store.stats()["packed_sessions"] == 0
+    assert store.payload_size_hint("id-1") == 0
+
+
+def test_recently_accessed_sessions_are_not_compacted():
+    """
+    Test that sessions accessed within compress_idle_after are left as they are.
+
+    compress_idle_after 以内にアクセスしたセッションは圧縮しないことをテスト
+    """
+    store = MemoryStore(compress_idle_after=3600, compaction_interval=None)
+    store.create_store("id-1")["n"] = 1
+
+    assert store.compact_idle_sessions() == 0
+    assert store.get_store("id-1") == {"n": 1}
+
+
+def test_iterating_keeps_sessions_packed(tmp_path):
+    """
+    Test that iterating, exporting and snapshotting read packed sessions without re-inflating them in the store.
+
+    列挙・エクスポート・スナップショットが、圧縮したセッションをストアの中で展開せずに読むことをテスト
+    """
+    from fastsession.session_export import export_sessions
+
+    store = MemoryStore(compress_idle_after=0, compaction_interval=None)
+    for i in range(50):
+        store.create_store(f"id-{i}")["n"] = i
+    assert store.compact_idle_sessions() == 50
+
+    assert {session_id: dict(info["store"]) for session_id, info in store.iter_sessions(chunk_size=7)} == \
+           {f"id-{i}": {"n": i} for i in range(50)}
+    assert store.export_session("id-3")["store"] == {"n": 3}
+    store.snapshot(str(tmp_path / "sessions.snapshot"))
+    with open(tmp_path / "sessions.ndjson", "w") as f:
+        export_sessions(store, f)
+    assert store.stats()["packed_sessions"] == 50
+
+    restored = MemoryStore()
+    assert restored.restore(str(tmp_path / "sessions.snapshot")) == 50
+    assert dict(restored.iter_sessions())["id-7"]["store"] == {"n": 7}
+    assert restored.raw_memory_store["id-7"]["store"] is None  # スナップショットから未デコードのまま
+    assert restored.get_store("id-7") == {"n": 7}
+
+
+def test_sessions_put_directly_into_raw_memory_store(tmp_path):
+    """
+    Test that sessions put into or removed from raw_memory_store directly are iterated, swept and snapshotted.
+
+    raw_memory_store に直接置いた・取り除いたセッションも列挙・掃除・スナップショットの対象になることをテスト
+    """
+    import time
+
+    store = MemoryStore(max_session_age=60)
+    store.create_store("created")
+    store.create_store("removed")
+    del store.raw_memory_store["removed"]
+    store.raw_memory_store["direct"] = {"created_at": int(time.time()), "store": {"n": 1}}
+    store.raw_memory_store["direct-expired"] = {"created_at": int(time.time()) - 120, "store": {}}
+
+    assert sorted(session_id for session_id, _ in store.iter_sessions()) == ["created", "direct", "direct-expired"]
+
+    store.snapshot(str(tmp_path / "sessions.snapshot"))
+    restored = MemoryStore()
+    restored.restore(str(tmp_path / "sessions.snapshot"))
+    assert restored.get_store("direct") == {"n": 1}
+
+    assert store.sweep_expired() == (1, None)
+    assert sorted(store.raw_memory_store) == ["created", "direct"]
@@ -46,3 +46,55 @@ def test_token_tampering():
     tampered_token = token[:-1] + 'a'
     data, err = serializer.decode(tampered_token)
     assert data is None and err == "InvalidSignature", "Tampered token did not cause an error as expected."
+
+
+def test_token_signed_with_old_key_in_key_ring():
+    """
+    Test that a token signed with an old key is still valid after the key is rotated.
+
+    鍵をローテーションしても旧い鍵で署名されたトークンが有効であることをテストする。
+    """
+    old_serializer = TimedSignatureSerializer('OLD_SECRET_KEY', expired_in=3600)
+    token = old_serializer.encode({'session_id': 999})
+
+    serializer = TimedSignatureSerializer(['NEW_SECRET_KEY', 'OLD_SECRET_KEY'], expired_in=3600)
+    data, err, info = serializer.decode_with_info(token)
+    assert err is None and data['session_id'] == 999
+    assert info['key_id'] == TimedSignatureSerializer.make_key_id('OLD_SECRET_KEY')
+    assert not info['is_active_key']
+
+    new_token = serializer.encode({'session_id': 999}, timestamp=info['timestamp'])
+    data, err, new_info = serializer.decode_with_info(new_token)
+    assert err is None and data['session_id'] == 999
+    assert new_info['is_active_key']
+    assert new_info['timestamp'] == info['timestamp']  # 再署名しても署名時刻は変わらない
+
+
+def test_token_signed_with_removed_key():
+    """
+    Test that a token signed with a key removed from the key ring becomes invalid.
+
+    鍵リングから外した鍵で署名されたトークンが無効になることをテストする。
+    """
+    old_serializer = TimedSignatureSerializer('OLD_SECRET_KEY', expired_in=3600)
+    token = old_serializer.encode({'session_id': 999})
+
+    serializer = TimedSignatureSerializer(['NEW_SECRET_KEY'], expired_in=3600)
+    data, err = serializer.decode(token)
+    assert data is None and err == "InvalidSignature"
+
+
+def test_legacy_token_without_key_id():
+    """
+    Test that a token issued before key IDs were introduced can still be decoded.
+
+    キーIDが導入される前に発行されたトークンもデコードできることをテストする。
+    """
+    from itsdangerous import URLSafeTimedSerializer
+
+    legacy_token = URLSafeTimedSerializer('MY_SECRET_KEY').dumps({'session_id': 999})
+
+    serializer = TimedSignatureSerializer('MY_SECRET_KEY', expired_in=3600)
+    data, err, info = serializer.decode_with_info(legacy_token)
+    assert err is None and data['session_id'] == 999
+    assert not info['is_active_key']  # 旧形式なので再署名の対象
@@ -0,0 +1,155 @@
+import pytest
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+from fastsession import MemoryStore
+from tests.conftest import CountingMemoryStore, counter_route, create_client
+
+
+async def counter_websocket(websocket):
+    await websocket.accept()
+    session_mgr = websocket.state.session
+    session = session_mgr.get_session()
+    async for message in websocket.iter_text():
+        if message == "save":
+            session_mgr.save_session()
+            await websocket.send_text("saved")
+            continue
+        session["test_counter"] = session.get("test_counter", 0) + 1
+        await websocket.send_text(f"Counter: {session['test_counter']}")
+
+
+async def rejecting_websocket(websocket):
+    websocket.state.session.get_session()["rejected"] = True
+    await websocket.close(code=1008)
+
+
+ROUTES = [Route("/", endpoint=counter_route), WebSocketRoute("/ws", endpoint=counter_websocket),
+          WebSocketRoute("/ws-reject", endpoint=rejecting_websocket)]
+
+
+def test_websocket_shares_http_session():
+    """
+    Test that a WebSocket sees the session of the HTTP requests, loaded once for the whole connection.
+
+    WebSocket が HTTP リクエストのセッションを参照でき、接続全体で一度だけ読み込まれることをテスト
+    """
+    store = CountingMemoryStore()
+    client = create_client(store, routes=ROUTES)
+    assert client.get("/").text == "Counter: 1"
+
+    store.get_calls = 0
+    with client.websocket_connect("/ws") as websocket:
+        for expected in (2, 3, 4):
+            websocket.send_text("increment")
+            assert websocket.receive_text() == f"Counter: {expected}"
+        assert store.get_calls == 1  # メッセージごとには読み込まない
+
+    assert client.get("/").text == "Counter: 5"
+
+
+def test_websocket_creates_session_with_cookie_on_handshake():
+    """
+    Test that a WebSocket without a session cookie gets a new session, whose cookie is set on the handshake.
+
+    セッションクッキーの無い WebSocket には新しいセッションが生成され、ハンドシェイクでクッキーがセットされることをテスト
+    """
+    store = MemoryStore()
+    client = create_client(store, routes=ROUTES)
+
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_text("increment")
+        assert websocket.receive_text() == "Counter: 1"
+        headers = dict(websocket.extra_headers)
+
+    assert headers[b"set-cookie"].startswith(b"sid=")
+    session_id = next(iter(store.raw_memory_store))
+    assert store.get_store(session_id)["test_counter"] == 1
+
+
+def test_websocket_session_saved_explicitly_and_at_close():
+    """
+    Test that a versioned session is saved when the handler saves it and when the connection ends.
+
+    バージョン付きのセッションが、ハンドラーが保存したときと接続の終了時に保存されることをテスト
+    """
+    store = MemoryStore()
+    client = create_client(store, routes=ROUTES, conflict_policy="merge")
+    assert client.get("/").text == "Counter: 1"
+    session_id = next(iter(store.raw_memory_store))
+
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_text("increment")
+        assert websocket.receive_text() == "Counter: 2"
+        websocket.send_text("save")
+        assert websocket.receive_text() == "saved"
+        assert store.get_store(session_id)["test_counter"] == 2
+
+        websocket.send_text("increment")
+        assert websocket.receive_text() == "Counter: 3"
+        assert store.get_store(session_id)["test_counter"] == 2  # 接続中は保存されない
+
+    assert store.get_store(session_id)["test_counter"] == 3
+    assert client.get("/").text == "Counter: 4"
+
+
+def test_open_websocket_session_is_not_compacted():
+    """
+    Test that the session of an open WebSocket connection is not packed, so messages after a compaction pass
+    are still saved, and that it is packed once the connection ends.
+
+    WebSocket接続中のセッションは圧縮されず、圧縮の後のメッセージも保存されること、接続の終了後は圧縮されることをテスト
+    """
+    store = MemoryStore(compress_idle_after=0, compaction_interval=None)
+    client = create_client(store, routes=ROUTES)
+
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_text("increment")
+        assert websocket.receive_text() == "Counter: 1"
+        assert store.compact_idle_sessions() == 0
+        websocket.send_text("increment")
+        assert websocket.receive_text() == "Counter: 2"
+
+    session_id = list(store.raw_memory_store)[0]
+    assert store.compact_idle_sessions() == 1
+    assert store.get_store(session_id)["test_counter"] == 2
+
+
+def test_rejected_handshake_creates_no_session():
+    """
+    Test that a new session is only created in the store once the handshake is accepted.
+
+    新しいセッションはハンドシェイクが受け付けられてから初めてストアに生成されることをテスト
+    """
+    store = MemoryStore()
+    client = create_client(store, routes=ROUTES)
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/ws-reject"):
+            pass
+    assert store.raw_memory_store == {}
+
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_text("increment")
+        assert websocket.receive_text() == "Counter: 1"
+    assert len(store.raw_memory_store) == 1
+
+
+def test_websocket_origin_allow_list():
+    """
+    Test that with websocket_allowed_origins set, handshakes from other origins or without an Origin are rejected.
+
+    websocket_allowed_origins を指定すると、他のオリジンや Origin の無いハンドシェイクは拒否されることをテスト
+    """
+    store = MemoryStore()
+    client = create_client(store, routes=ROUTES, websocket_allowed_origins=["https://example.com"])
+
+    with client.websocket_connect("/ws", headers={"origin": "https://example.com"}) as websocket:
+        websocket.send_text("increment")
+        assert websocket.receive_text() == "Counter: 1"
+
+    for headers in [{"origin": "https://evil.example"}, {}]:
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect("/ws", headers=headers):
+                pass
+    assert len(store.raw_memory_store) == 1